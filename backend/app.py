@@ -3,13 +3,31 @@ from flask_cors import CORS
 from chat_manager import ChatManager
 from profile_manager import ProfileManager
 from prompt_manager import PromptManager
+from db_manager import PendingWritesError, get_pool_stats
+from process_local import ProcessLocal
+from metrics import registry as metrics_registry, record_error
+from reply_streams import ReplyInProgressError
+from scheduler import QueueFullError
+from stream_events import ErrorEvent, sse_frame
 from logger import logger
+import hmac
 import uuid
 import os
-import json
 
 # initialize variables
 MISSING_USER_ID = "Missing user_id"
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'Connection': 'keep-alive',
+    'X-Accel-Buffering': 'no',  # Disable buffering in nginx
+    'Content-Encoding': 'none'  # Required for some proxies
+}
+PROMPT_CACHE_MAX_AGE = int(os.getenv('PROMPT_CACHE_MAX_AGE', '60'))
+DEFAULT_PAGE_SIZE = 50
+DEFAULT_SEARCH_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 200
+# Bearer token for admin routes such as /api/prompts/reload; unset disables them
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', '')
 
 app = Flask(__name__, 
             static_folder='../frontend/static',
@@ -25,15 +43,50 @@ CORS(app, resources={
     }
 })
 
-# Initialize managers
-chat_manager = ChatManager()
-profile_manager = ProfileManager()
-prompt_manager = PromptManager()
+# Managers are created in each worker process on first use (see create_app)
+chat_manager = ProcessLocal(ChatManager)
+profile_manager = ProcessLocal(ProfileManager)
+prompt_manager = ProcessLocal(PromptManager)
+
+def backend_gauge(key):
+    """Collect a per-backend value from the Ollama pool stats for /metrics."""
+    return lambda: {(backend['url'],): int(backend[key]) for backend in chat_manager.backends.stats()['backends']}
+
+# Values read from the managers when /metrics is scraped
+metrics_registry.gauge('ollama_requests_in_flight', 'Requests generating on each Ollama backend.', backend_gauge('in_flight'), ('backend',))
+metrics_registry.gauge('ollama_queue_depth', 'Requests waiting for a slot on each Ollama backend.', backend_gauge('queued'), ('backend',))
+metrics_registry.gauge('ollama_backend_healthy', 'Whether each Ollama backend is in rotation.', backend_gauge('healthy'), ('backend',))
+metrics_registry.gauge('reply_streams_active', 'Replies being generated.', lambda: chat_manager.streams.stats()['active'])
+metrics_registry.gauge('sse_connections_active', 'Clients connected to reply streams.', lambda: chat_manager.streams.stats()['readers'])
+metrics_registry.gauge('mongo_connections_in_use', 'MongoDB connections checked out of the pool, by client.', lambda: {
+    (client,): stats['in_use'] for client, stats in get_pool_stats().items()
+}, ('client',))
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
+def reply_stream_sse(stream, after=0):
+    """SSE frames of a reply stream, starting after the event numbered `after`."""
+    try:
+        # The generator is closed when the client disconnects; generation goes on
+        # for STREAM_DISCONNECT_GRACE seconds in case the client resumes
+        for event_id, event in stream.follow(after):
+            yield sse_frame(event, event_id)
+            if event.type == 'error':
+                logger.log_backend("error", f"Error in chat stream: {event.content}")
+            elif event.type == 'done':
+                logger.log_chat("info", f"Assistant response streamed: {stream.chars} chars", user_id=stream.user_id, chat_id=stream.chat_id)
+            elif event.type == 'cancelled':
+                logger.log_chat("info", f"Assistant response cancelled ({event.reason}) after {stream.chars} chars", user_id=stream.user_id, chat_id=stream.chat_id)
+        
+        yield "data: [DONE]\n\n"
+        
+    except Exception as e:
+        error_msg = f"Error in reply stream: {str(e)}"
+        logger.log_backend("error", error_msg)
+        yield sse_frame(ErrorEvent(error_msg))
+
 @app.route('/api/chat', methods=['POST', 'OPTIONS'])
 def chat():
     if request.method == 'OPTIONS':
@@ -44,6 +97,7 @@ def chat():
         response.headers.add('Access-Control-Allow-Methods', 'POST, OPTIONS')
         return response
         
+    ticket = None
     try:
         data = request.json
         user_id = data.get('user_id')
@@ -52,80 +106,70 @@ def chat():
         
         if not user_id or not message:
             return jsonify({"error": "Missing user_id or message"}), 400
+        if chat_manager.draining:
+            # This worker is shutting down; a retry goes to another one
+            response = jsonify({"error": "The server is restarting. Please retry.", "retry_after": 1})
+            response.headers['Retry-After'] = '1'
+            return response, 503
+        requested_model = data.get('model')
+        if requested_model and requested_model not in chat_manager.models:
+            return jsonify({"error": f"Unknown model: {requested_model}"}), 400
+        # Without a requested model, simple messages may go to the small model
+        model = chat_manager.models.choose(message, requested_model)
         
-        # Create a new chat if no chat_id provided
-        if not chat_id:
-            chat_title = chat_manager.generate_title(message)
-            chat_id = chat_manager.create_chat(user_id, chat_title)
-        
-        # Add user message to chat
-        chat_manager.add_message(user_id, chat_id, "user", message)
-        
-        # Get chat history
-        messages = chat_manager.get_chat_messages(user_id, chat_id)
+        # Take a place in the queue for Ollama, or fail fast when it is too deep
+        try:
+            ticket = chat_manager.admit(user_id, chat_id or None, model)
+        except QueueFullError as e:
+            record_error('chat', e)
+            logger.log_backend("warning", f"Chat request rejected, queue full: user {user_id}")
+            response = jsonify({"error": str(e), "retry_after": e.retry_after})
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response, 429
         
         # Get profile context
         profile_context = profile_manager.get_profile_prompt(user_id)
         
+        # Add the user message (creating the chat if no chat_id was provided) and
+        # get the chat history that fits in the model's context budget
+        chat_title = chat_manager.generate_title(message)
+        try:
+            chat_id, messages = chat_manager.start_turn(
+                user_id, chat_id or None, message, model=model, profile_context=profile_context, title=chat_title
+            )
+        except PendingWritesError as e:
+            chat_manager.release(ticket)
+            record_error('chat', e)
+            response = jsonify({"error": str(e), "retry_after": e.retry_after})
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response, 503
+        except ReplyInProgressError as e:
+            chat_manager.release(ticket)
+            record_error('chat', e)
+            return jsonify({"error": str(e)}), 409
+        if messages is None:
+            chat_manager.release(ticket)
+            return jsonify({"error": "Chat not found"}), 404
+        
+        # Keep later turns of the chat on the same Ollama backend
+        chat_manager.bind_chat(chat_id, ticket)
+        
+        # Canned catalog prompts opening a chat can be answered from the response cache
+        cacheable = len(messages) == 1 and prompt_manager.is_catalog_prompt(message)
+        
         # Log the chat
-        logger.log_chat("info", f"User message: {message}", user_id=user_id, chat_id=chat_id)
+        logger.log_chat("info", f"User message ({model}): {message}", user_id=user_id, chat_id=chat_id)
         
-        def generate():
-            try:
-                assistant_response = ""
-                for chunk in chat_manager.send_to_ollama(messages, profile_context=profile_context):
-                    # Check if the client disconnected using a more reliable method
-                    # Remove the request.environ check as it's not available in this context
-                    # Instead, we'll rely on the generator being closed when client disconnets
-                    
-                    try:
-                        chunk_data = json.loads(chunk)
-                        
-                        if chunk_data.get('type') == 'content':
-                            content = chunk_data['content']
-                            assistant_response += content
-                            # Send immediately without buffering
-                            yield f"data: {json.dumps({'type': 'content', 'content': content})}\n\n"
-                        
-                        elif chunk_data.get('type') == 'error':
-                            error_msg = chunk_data.get('content', 'Unknown error')
-                            yield f"data: {json.dumps({'type': 'error', 'content': error_msg})}\n\n"
-                            logger.log_backend("error", f"Error in chat stream: {error_msg}")
-                            break
-                        
-                        elif chunk_data.get('type') == 'done':
-                            # Save assistant response to chat history
-                            if assistant_response.strip():  # Only save if we have content
-                                chat_manager.add_message(user_id, chat_id, "assistant", assistant_response)
-                                logger.log_chat("info", f"Assistant response saved: {len(assistant_response)} chars", user_id=user_id, chat_id=chat_id)
-                            yield f"data: {json.dumps({'type': 'done'})}\n\n"
-                            break
-                            
-                    except json.JSONDecodeError as e:
-                        logger.log_backend("error", f"JSON decode error in chat stream: {str(e)}")
-                        continue
-                    except Exception as e:
-                        logger.log_backend("error", f"Error processing chunk: {str(e)}")
-                        yield f"data: {json.dumps({'type': 'error', 'content': 'An error occurred while processing the response'})}\n\n"
-                        break
-                
-                yield "data: [DONE]\n\n"
-                
-            except Exception as e:
-                error_msg = f"Error in generate(): {str(e)}"
-                logger.log_backend("error", error_msg)
-                yield f"data: {json.dumps({'type': 'error', 'content': error_msg})}\n\n"
+        # Generate in the background; the client reads the buffered stream
+        stream = chat_manager.start_reply(
+            user_id, chat_id, messages, model=model, profile_context=profile_context, cache=cacheable, ticket=ticket
+        )
         
         # Create response with streaming headers
         response = Response(
-            generate(),
+            reply_stream_sse(stream),
             mimetype='text/event-stream',
-            headers={
-                'Cache-Control': 'no-cache',
-                'Connection': 'keep-alive',
-                'X-Accel-Buffering': 'no',  # Disable buffering in nginx
-                'Content-Encoding': 'none'  # Required for some proxies
-            }
+            headers=SSE_HEADERS
         )
         
         # Add CORS headers
@@ -135,9 +179,48 @@ def chat():
         return response
     
     except Exception as e:
+        if ticket is not None:
+            chat_manager.release(ticket)
+        record_error('chat', e)
         logger.log_backend("error", f"Error in chat endpoint: {str(e)}")
         return jsonify({"error": str(e)}), 500
     
+@app.route('/api/chat/<chat_id>/stream', methods=['GET'])
+def resume_chat_stream(chat_id):
+    """Resume reading a reply after a dropped connection, from the Last-Event-ID on."""
+    user_id = request.args.get('user_id')
+    if not user_id:
+        return jsonify({"error": MISSING_USER_ID}), 400
+    
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    stream, after = chat_manager.streams.resume_point(user_id, chat_id, last_event_id)
+    if stream is None:
+        # The reply has finished and is no longer buffered; it is in the chat history
+        return jsonify({"error": "Stream not found"}), 404
+    
+    logger.log_chat("info", f"Reply stream resumed after event {after}", user_id=user_id, chat_id=chat_id)
+    response = Response(
+        reply_stream_sse(stream, after),
+        mimetype='text/event-stream',
+        headers=SSE_HEADERS
+    )
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    return response
+    
+@app.route('/api/chat/<chat_id>/cancel', methods=['POST'])
+def cancel_chat_reply(chat_id):
+    """Stop generating the reply for a chat; the part generated so far is kept."""
+    data = request.json or {}
+    user_id = data.get('user_id')
+    if not user_id:
+        return jsonify({"error": MISSING_USER_ID}), 400
+    
+    if not chat_manager.cancel_reply(user_id, chat_id):
+        return jsonify({"error": "No reply is being generated"}), 404
+    
+    logger.log_chat("info", "Reply cancelled by user", user_id=user_id, chat_id=chat_id)
+    return jsonify({"status": "cancelled"})
+    
 @app.route('/api/chats', methods=['GET', 'POST'])
 def handle_chats():
     if request.method == 'POST':
@@ -169,12 +252,37 @@ def handle_chats():
             return jsonify({"error": MISSING_USER_ID}), 400
 
         try:
+            # Summary mode returns only what the sidebar needs; 'since' makes it a delta
+            since = request.args.get('since')
+            if request.args.get('summary') or since:
+                return jsonify(chat_manager.get_chat_summaries(user_id, since=since))
             chats = chat_manager.get_user_chats(user_id)
             return jsonify(chats)
         except Exception as e:
             logger.log_backend("error", f"Error getting chats: {str(e)}")
             return jsonify({"error": str(e)}), 500
 
+@app.route('/api/chats/search', methods=['GET'])
+def search_chats():
+    """Search the text of a user's messages.
+    
+    Query parameters: 'user_id', 'q', optional 'offset' (next_offset returned
+    by the previous page) and optional 'limit'.
+    """
+    user_id = request.args.get('user_id')
+    query = (request.args.get('q') or '').strip()
+    if not user_id or not query:
+        return jsonify({"error": "Missing user_id or q"}), 400
+
+    try:
+        offset = max(0, request.args.get('offset', 0, type=int))
+        limit = request.args.get('limit', DEFAULT_SEARCH_PAGE_SIZE, type=int)
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        return jsonify(chat_manager.search_messages(user_id, query, offset=offset, limit=limit))
+    except Exception as e:
+        logger.log_backend("error", f"Error searching chats: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/chats/<chat_id>/title', methods=['PUT'])
 def update_chat_title(chat_id):
     """Update the title of a chat.
@@ -194,6 +302,27 @@ def update_chat_title(chat_id):
         return jsonify({"message": "Chat title updated successfully"})
     return jsonify({"error": "Failed to update chat title"}), 400
 
+@app.route('/api/chats/<chat_id>/messages', methods=['GET'])
+def get_chat_messages(chat_id):
+    """Get a page of messages for a chat, newest page first.
+    
+    Query parameters: 'user_id', optional 'before' (cursor returned by the
+    previous page) and optional 'limit'.
+    """
+    user_id = request.args.get('user_id')
+    if not user_id:
+        return jsonify({"error": MISSING_USER_ID}), 400
+
+    try:
+        before = request.args.get('before', type=int)
+        limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        page = chat_manager.get_chat_messages_page(user_id, chat_id, before=before, limit=limit)
+        return jsonify(page)
+    except Exception as e:
+        logger.log_backend("error", f"Error getting chat messages: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/chats/<chat_id>', methods=['DELETE'])
 def delete_chat(chat_id):
     user_id = request.args.get('user_id')
@@ -236,25 +365,94 @@ def manage_profile():
             return jsonify(profile)
         return jsonify({"error": "Profile not found"}), 404
 
+def catalog_response(body, catalog):
+    """Serve a prompt catalog body with its ETag, answering 304 when it is unchanged."""
+    response = Response(body, mimetype='application/json')
+    response.set_etag(catalog.version)
+    response.headers['Cache-Control'] = f"public, max-age={PROMPT_CACHE_MAX_AGE}"
+    return response.make_conditional(request)
+
 @app.route('/api/prompts', methods=['GET'])
 def get_prompts():
+    catalog = prompt_manager.catalog
     category = request.args.get('category')
     if category:
-        prompts = prompt_manager.get_prompts_by_category(category)
-    else:
-        prompts = prompt_manager.prompts
-    return jsonify(prompts)
+        return catalog_response(catalog.category_json(category), catalog)
+    return catalog_response(catalog.all_json, catalog)
 
 @app.route('/api/prompts/categories', methods=['GET'])
 def get_categories():
-    categories = prompt_manager.get_all_categories()
-    return jsonify(categories)
+    catalog = prompt_manager.catalog
+    return catalog_response(catalog.categories_json, catalog)
+
+def is_admin_request():
+    """Whether the request carries the ADMIN_TOKEN bearer token."""
+    if not ADMIN_TOKEN:
+        return False
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    return scheme.lower() == 'bearer' and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+@app.route('/api/prompts/reload', methods=['POST'])
+def reload_prompts():
+    if not is_admin_request():
+        logger.log_backend("warning", "Rejected prompt reload without a valid admin token")
+        return jsonify({"error": "Forbidden"}), 403
+    try:
+        version = prompt_manager.reload()
+        return jsonify({"status": "success", "version": version})
+    except Exception as e:
+        logger.log_backend("error", f"Error reloading prompts: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/stats/db-pool', methods=['GET'])
+def db_pool_stats():
+    return jsonify(get_pool_stats())
+
+@app.route('/api/stats/ollama', methods=['GET'])
+def ollama_stats():
+    return jsonify(chat_manager.backends.stats())
+
+@app.route('/api/models', methods=['GET'])
+def list_models():
+    """The models /api/chat accepts, and the backends each one is loaded on."""
+    return jsonify(chat_manager.model_status())
+
+@app.route('/api/stats/streams', methods=['GET'])
+def stream_stats():
+    return jsonify(chat_manager.streams.stats())
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(metrics_registry.render(), mimetype='text/plain; version=0.0.4')
+
+def create_app():
+    """Entry point for production WSGI servers (see gunicorn.conf.py).
+    
+    Nothing here connects to MongoDB or Ollama, so a pre-fork server can load
+    the app once and fork its workers; each worker creates its own managers
+    in start_worker or on its first request.
+    """
+    os.makedirs('data', exist_ok=True)
+    return app
+
+def start_worker():
+    """Create the managers of a worker process before it takes requests."""
+    chat_manager.get()
+    profile_manager.get()
+    prompt_manager.get()
+    logger.log_backend("info", f"Worker {os.getpid()} started")
+
+def shutdown(timeout):
+    """Drain the reply streams of this process before it exits (see ChatManager.shutdown)."""
+    if chat_manager.created:
+        chat_manager.shutdown(timeout)
+        logger.log_backend("info", f"Worker {os.getpid()} drained")
 
 if __name__ == '__main__':
     # Create data directory if it doesn't exist
     os.makedirs('data', exist_ok=True)
     os.makedirs('logs', exist_ok=True)
     
-    # Run the application with development settings
+    # Run the application with development settings; use gunicorn.conf.py in production
     logger.log_backend("info", "Starting AI Chat Server")
     app.run(host='0.0.0.0', port=5000, debug=True, use_reloader=True, threaded=True)
\ No newline at end of file
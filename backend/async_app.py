@@ -0,0 +1,198 @@
+"""Asyncio serving mode.
+
+/api/chat is served natively on the event loop, with async clients for Ollama
+and MongoDB, so an open stream costs a coroutine instead of a thread. Every
+other route is handled by the Flask app from app.py.
+
+Run with:
+    uvicorn async_app:create_app --factory --host 0.0.0.0 --port 5000
+
+Run a single worker, as with gunicorn.conf.py: reply streams, the Ollama
+queue and the prompt catalog live in the worker process. On shutdown the
+replies still being generated once the open connections are closed
+(--timeout-graceful-shutdown) are cancelled and saved.
+"""
+import asyncio
+from contextlib import asynccontextmanager
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+from app import app as flask_app, chat_manager as sync_chat_manager, profile_manager, prompt_manager, shutdown, start_worker, MISSING_USER_ID, SSE_HEADERS
+from async_chat_manager import AsyncChatManager
+from async_db_manager import close_async_mongo_client
+from db_manager import PendingWritesError
+from logger import logger
+from metrics import record_error
+from process_local import ProcessLocal
+from reply_streams import ReplyInProgressError
+from scheduler import QueueFullError
+from stream_events import ErrorEvent, sse_frame
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Headers': 'Content-Type'
+}
+
+chat_manager = ProcessLocal(lambda: AsyncChatManager(sync_chat_manager.get(), profile_manager.get()))
+
+async def reply_stream_sse(stream, after=0):
+    """SSE frames of a reply stream, starting after the event numbered `after`."""
+    try:
+        async for event_id, event in stream.afollow(after):
+            yield sse_frame(event, event_id)
+            if event.type == 'error':
+                logger.log_backend("error", f"Error in chat stream: {event.content}")
+            elif event.type == 'done':
+                logger.log_chat("info", f"Assistant response streamed: {stream.chars} chars", user_id=stream.user_id, chat_id=stream.chat_id)
+            elif event.type == 'cancelled':
+                logger.log_chat("info", f"Assistant response cancelled ({event.reason}) after {stream.chars} chars", user_id=stream.user_id, chat_id=stream.chat_id)
+
+        yield "data: [DONE]\n\n"
+
+    except Exception as e:
+        error_msg = f"Error in reply stream: {str(e)}"
+        logger.log_backend("error", error_msg)
+        yield sse_frame(ErrorEvent(error_msg))
+
+async def chat(request):
+    if request.method == 'OPTIONS':
+        # Handle preflight request
+        return JSONResponse(
+            {'status': 'ok'},
+            headers={**CORS_HEADERS, 'Access-Control-Allow-Methods': 'POST, OPTIONS'}
+        )
+
+    ticket = None
+    try:
+        data = await request.json()
+        user_id = data.get('user_id')
+        chat_id = data.get('chat_id')
+        message = data.get('message')
+
+        if not user_id or not message:
+            return JSONResponse({"error": "Missing user_id or message"}, status_code=400)
+        if sync_chat_manager.draining:
+            # This worker is shutting down; a retry goes to another one
+            return JSONResponse(
+                {"error": "The server is restarting. Please retry.", "retry_after": 1},
+                status_code=503,
+                headers={**CORS_HEADERS, 'Retry-After': '1'}
+            )
+        requested_model = data.get('model')
+        if requested_model and requested_model not in sync_chat_manager.models:
+            return JSONResponse({"error": f"Unknown model: {requested_model}"}, status_code=400)
+        model = sync_chat_manager.models.choose(message, requested_model)
+
+        # Take a place in the queue for Ollama, or fail fast when it is too deep
+        try:
+            ticket = chat_manager.admit(user_id, chat_id or None, model)
+        except QueueFullError as e:
+            record_error('chat', e)
+            logger.log_backend("warning", f"Chat request rejected, queue full: user {user_id}")
+            return JSONResponse(
+                {"error": str(e), "retry_after": e.retry_after},
+                status_code=429,
+                headers={**CORS_HEADERS, 'Retry-After': str(e.retry_after)}
+            )
+
+        # Get profile context
+        profile_context = await chat_manager.get_profile_prompt(user_id)
+
+        # Add the user message (creating the chat if no chat_id was provided) and
+        # get the chat history that fits in the model's context budget
+        chat_title = chat_manager.generate_title(message)
+        try:
+            chat_id, messages = await chat_manager.start_turn(
+                user_id, chat_id or None, message, model=model, profile_context=profile_context, title=chat_title
+            )
+        except PendingWritesError as e:
+            chat_manager.release(ticket)
+            record_error('chat', e)
+            return JSONResponse(
+                {"error": str(e), "retry_after": e.retry_after},
+                status_code=503,
+                headers={**CORS_HEADERS, 'Retry-After': str(e.retry_after)}
+            )
+        except ReplyInProgressError as e:
+            chat_manager.release(ticket)
+            record_error('chat', e)
+            return JSONResponse({"error": str(e)}, status_code=409, headers=CORS_HEADERS)
+        if messages is None:
+            chat_manager.release(ticket)
+            return JSONResponse({"error": "Chat not found"}, status_code=404)
+
+        # Keep later turns of the chat on the same Ollama backend
+        chat_manager.bind_chat(chat_id, ticket)
+
+        # Canned catalog prompts opening a chat can be answered from the response cache
+        cacheable = len(messages) == 1 and prompt_manager.is_catalog_prompt(message)
+
+        # Log the chat
+        logger.log_chat("info", f"User message ({model}): {message}", user_id=user_id, chat_id=chat_id)
+
+        # Generate in a background task; the client reads the buffered stream
+        stream = chat_manager.start_reply(
+            user_id, chat_id, messages, model=model, profile_context=profile_context, cache=cacheable, ticket=ticket
+        )
+
+        return StreamingResponse(
+            reply_stream_sse(stream),
+            media_type='text/event-stream',
+            headers={**SSE_HEADERS, **CORS_HEADERS}
+        )
+
+    except Exception as e:
+        if ticket is not None:
+            chat_manager.release(ticket)
+        record_error('chat', e)
+        logger.log_backend("error", f"Error in chat endpoint: {str(e)}")
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+async def resume_chat_stream(request):
+    """Resume reading a reply after a dropped connection (see app.resume_chat_stream)."""
+    chat_id = request.path_params['chat_id']
+    user_id = request.query_params.get('user_id')
+    if not user_id:
+        return JSONResponse({"error": MISSING_USER_ID}, status_code=400)
+
+    last_event_id = request.headers.get('Last-Event-ID') or request.query_params.get('last_event_id')
+    stream, after = sync_chat_manager.streams.resume_point(user_id, chat_id, last_event_id)
+    if stream is None:
+        return JSONResponse({"error": "Stream not found"}, status_code=404)
+
+    logger.log_chat("info", f"Reply stream resumed after event {after}", user_id=user_id, chat_id=chat_id)
+    return StreamingResponse(
+        reply_stream_sse(stream, after),
+        media_type='text/event-stream',
+        headers={**SSE_HEADERS, **CORS_HEADERS}
+    )
+
+@asynccontextmanager
+async def lifespan(app):
+    start_worker()
+    chat_manager.get()
+    yield
+    # uvicorn has already waited for the open connections; cancel and save what is
+    # left, on a thread because those replies are generated on this event loop
+    await asyncio.to_thread(shutdown, 0)
+    await chat_manager.close()
+    await close_async_mongo_client()
+
+app = Starlette(
+    routes=[
+        Route('/api/chat', chat, methods=['POST', 'OPTIONS']),
+        Route('/api/chat/{chat_id}/stream', resume_chat_stream, methods=['GET']),
+        Mount('/', app=WSGIMiddleware(flask_app))
+    ],
+    lifespan=lifespan
+)
+
+def create_app():
+    """Entry point for uvicorn --factory."""
+    return app
+
+if __name__ == '__main__':
+    import uvicorn
+    logger.log_backend("info", "Starting AI Chat Server (asyncio mode)")
+    uvicorn.run(app, host='0.0.0.0', port=5000)
@@ -0,0 +1,314 @@
+import asyncio
+import os
+import time
+import httpx
+from async_db_manager import AsyncDatabaseManager
+from cache import MISSING
+from chat_manager import DEFAULT_MODEL, SYSTEM_PROMPT, build_ollama_payload, parse_ollama_line
+from context_builder import estimate_tokens, recent_newest_first
+from logger import logger
+from metrics import QUEUE_WAIT_SECONDS, GenerationTimer, record_error
+from profile_manager import render_profile_prompt
+from reply_streams import SUPERSEDE_WAIT, ReplyInProgressError, cancellation_message
+from response_cache import replay_chunks
+from scheduler import POSITION_POLL_INTERVAL
+from stream_events import CancelledEvent, ContentEvent, DoneEvent, ErrorEvent, QueuedEvent, acoalesce
+
+class AsyncChatManager:
+    """Asyncio version of the ChatManager operations used by /api/chat.
+
+    Configuration (Ollama URL, context budgets, summaries) comes from the sync
+    ChatManager it wraps, which also runs the occasional background summary.
+    Rendered profile prompts share the ProfileManager's cache when one is given.
+    """
+
+    def __init__(self, sync_manager, profile_manager=None):
+        self.sync_manager = sync_manager
+        self.profile_manager = profile_manager
+        self.db_manager = AsyncDatabaseManager(sync_manager.db_manager)
+        self.backends = sync_manager.backends
+        self.context_builder = sync_manager.context_builder
+        settings = sync_manager.http_settings
+        self.http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(settings['read_timeout'], connect=settings['connect_timeout']),
+            limits=httpx.Limits(
+                max_connections=int(os.getenv('OLLAMA_MAX_CONNECTIONS', '100')),
+                max_keepalive_connections=settings['pool_size']
+            ),
+            # httpx retries only failed connects, matching the sync session
+            transport=httpx.AsyncHTTPTransport(retries=settings['connect_retries'])
+        )
+        self._reply_tasks = set()
+
+    async def close(self):
+        await self.http_client.aclose()
+
+    async def get_profile_prompt(self, user_id):
+        if self.profile_manager is None:
+            return render_profile_prompt(await self.db_manager.get_profile(user_id))
+        prompt = self.profile_manager.prompt_cache.get(user_id)
+        if prompt is MISSING:
+            generation = self.profile_manager.prompt_cache.generation()
+            prompt = render_profile_prompt(await self.db_manager.get_profile(user_id))
+            self.profile_manager.prompt_cache.set(user_id, prompt, generation)
+        return prompt
+
+    def generate_title(self, user_message):
+        return self.sync_manager.generate_title(user_message)
+
+    async def start_turn(self, user_id, chat_id, message, model=DEFAULT_MODEL, profile_context="", title="New Chat"):
+        """Add the user's message and assemble the context for the reply (see ChatManager.start_turn)."""
+        previous = self.sync_manager.streams.get(user_id, chat_id) if chat_id is not None else None
+        if previous is not None and not previous.finished:
+            # Saving the cancelled reply happens on this loop; wait for it in a thread
+            previous.cancel("superseded")
+            if not await asyncio.to_thread(previous.wait_finished, SUPERSEDE_WAIT):
+                raise ReplyInProgressError()
+        chat_id, chat = await self.db_manager.append_message_with_context(
+            user_id, chat_id, "user", message, tokens=estimate_tokens(message), title=title
+        )
+        if chat is None:
+            return chat_id, None
+
+        summary, summarized_through = "", 0
+        if self.sync_manager.summarize_context:
+            summary, summarized_through = chat.get('summary', ""), chat.get('summarized_through', 0)
+        reserved_tokens = estimate_tokens(SYSTEM_PROMPT + profile_context) + estimate_tokens(summary)
+
+        recent = recent_newest_first(chat.get('recent', []), chat['message_count'])
+        remaining = self.context_builder.budget_for(model) - reserved_tokens
+        remaining -= sum(self.context_builder.message_tokens(m) for m in recent)
+        first_seq = recent[-1]['seq'] if recent else chat['message_count'] + 1
+        start_seq = chat.get('context_start')
+        # Only read older messages when the whole cached tail fits and the window starts before it
+        if remaining >= 0 and first_seq > (start_seq or 1):
+            recent += await self._read_recent(user_id, chat_id, remaining, before=first_seq, start_seq=start_seq)
+
+        window, evicted_through, uncached = self.context_builder.build(recent, model, reserved_tokens, start_seq)
+        if uncached:
+            await self.db_manager.set_message_tokens(chat_id, uncached)
+        context_start = evicted_through + 1 if evicted_through else None
+        if context_start != start_seq:
+            await self.db_manager.set_context_start(user_id, chat_id, context_start)
+
+        return chat_id, self.sync_manager.finish_context(user_id, chat_id, model, window, evicted_through, summary, summarized_through)
+
+    def save_reply(self, user_id, chat_id, content):
+        """Persist an assistant reply in the background, without delaying the stream."""
+        self.db_manager.message_writer.submit_append(
+            user_id, chat_id, "assistant", content, tokens=estimate_tokens(content)
+        )
+
+    def start_reply(self, user_id, chat_id, messages, model=DEFAULT_MODEL, profile_context="", cache=False, ticket=None):
+        """Generate a reply in a background task and return its ReplyStream (see ChatManager.start_reply)."""
+        stream = self.sync_manager.streams.start(user_id, chat_id, token_limit=self.sync_manager.models.token_limit(model))
+        events = acoalesce(stream.acount_generated(self.send_to_ollama(messages, model, profile_context, cache, ticket)))
+        task = asyncio.create_task(self._run_reply(stream, events))
+        # Keep a reference so the task is not garbage collected while it runs
+        self._reply_tasks.add(task)
+        task.add_done_callback(self._reply_tasks.discard)
+        return stream
+
+    async def _run_reply(self, stream, events):
+        parts = []
+        seq = None
+        completed = False
+        last_checkpoint = time.monotonic()
+        # Cancelling the task closes the request to Ollama wherever it is
+        # waiting; once the reply is being saved it is left to finish
+        task = asyncio.current_task()
+        loop = asyncio.get_running_loop()
+        generating = True
+
+        def stop():
+            if generating:
+                task.cancel()
+
+        stream.cancellation.add_callback(lambda: loop.call_soon_threadsafe(stop))
+        try:
+            async for event in events:
+                stream.publish(event)
+                if event.type == "content":
+                    parts.append(event.content)
+                    if time.monotonic() - last_checkpoint >= self.sync_manager.checkpoint_interval:
+                        seq = await self.checkpoint_reply(stream, seq, "".join(parts))
+                        last_checkpoint = time.monotonic()
+                elif event.type == "done":
+                    completed = True
+                    break
+                elif event.type == "error":
+                    break
+                if stream.check_abandoned():
+                    break
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.log_backend("error", f"Error generating reply for chat {stream.chat_id}: {e}")
+            stream.publish(ErrorEvent(f"An unexpected error occurred: {str(e)}"))
+        finally:
+            generating = False
+            await events.aclose()
+            content = "".join(parts)
+            if stream.cancellation.is_set and not completed:
+                self.sync_manager.streams.record_cancellation(stream)
+                logger.log_backend("info", cancellation_message(stream))
+                stream.publish(CancelledEvent(stream.cancellation.reason))
+            elif completed:
+                self.sync_manager.streams.record_completion()
+            await self.finish_reply(stream, seq, content, completed)
+            stream.finish()
+
+    async def checkpoint_reply(self, stream, seq, content):
+        """Save the reply generated so far; returns the seq of the stored message."""
+        try:
+            if seq is None:
+                return await self.db_manager.begin_reply(
+                    stream.user_id, stream.chat_id, stream.id, content, estimate_tokens(content)
+                )
+            await self.db_manager.update_reply(
+                stream.user_id, stream.chat_id, seq, stream.id, content, estimate_tokens(content)
+            )
+        except Exception as e:
+            logger.log_backend("error", f"Error checkpointing reply for chat {stream.chat_id}: {e}")
+        return seq
+
+    async def finish_reply(self, stream, seq, content, completed):
+        """Save the final reply, or what was generated of it if generation stopped early."""
+        try:
+            if seq is not None:
+                await self.db_manager.update_reply(
+                    stream.user_id, stream.chat_id, seq, stream.id, content, estimate_tokens(content), final=completed
+                )
+            elif content.strip():
+                if completed:
+                    self.save_reply(stream.user_id, stream.chat_id, content)
+                else:
+                    await self.checkpoint_reply(stream, None, content)
+        except Exception as e:
+            logger.log_backend("error", f"Error saving reply for chat {stream.chat_id}: {e}")
+
+    async def _read_recent(self, user_id, chat_id, remaining, before=None, start_seq=None):
+        """Read messages newest first until `remaining` tokens are used up or start_seq is passed."""
+        recent = []
+        cursor = self.db_manager.iter_recent_messages(user_id, chat_id, before=before)
+        try:
+            async for message in cursor:
+                if start_seq is not None and message['seq'] < start_seq:
+                    break
+                recent.append(message)
+                remaining -= self.context_builder.message_tokens(message)
+                if remaining < 0:
+                    break
+        finally:
+            await cursor.close()
+        return recent
+
+    def admit(self, user_id, chat_id=None, model=DEFAULT_MODEL):
+        """Reserve a place in a backend queue shared with the sync ChatManager (see ChatManager.admit)."""
+        return self.sync_manager.admit(user_id, chat_id, model)
+
+    def release(self, ticket):
+        self.sync_manager.release(ticket)
+
+    def bind_chat(self, chat_id, ticket):
+        self.sync_manager.bind_chat(chat_id, ticket)
+
+    async def wait_for_slot(self, ticket):
+        """Wait for a ticket to be granted without blocking the event loop, yielding QueuedEvents."""
+        scheduler = ticket.backend.scheduler
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def mark_granted():
+            if not granted.done():
+                granted.set_result(True)
+
+        scheduler.on_grant(ticket, lambda: loop.call_soon_threadsafe(mark_granted))
+        deadline = loop.time() + scheduler.queue_timeout
+        last_position = None
+        while not ticket.granted:
+            position = scheduler.position(ticket)
+            if position and position != last_position:
+                yield QueuedEvent(position)
+                last_position = position
+            if loop.time() >= deadline:
+                return
+            await asyncio.wait({granted}, timeout=POSITION_POLL_INTERVAL)
+
+    async def send_to_ollama(self, messages, model=DEFAULT_MODEL, profile_context="", cache=False, ticket=None):
+        try:
+            async for chunk in self._stream_reply(messages, model, profile_context, cache, ticket):
+                yield chunk
+        finally:
+            if ticket is not None:
+                self.release(ticket)
+
+    async def _stream_reply(self, messages, model, profile_context, cache, ticket):
+        # Replay a cached response for cacheable requests (canned catalog prompts)
+        cache_key = self.sync_manager.cached_response_key(messages, model, profile_context) if cache else None
+        response_cache = self.sync_manager.response_cache
+        if cache_key:
+            cached = response_cache.get(cache_key)
+            if cached is not None:
+                for piece in replay_chunks(cached):
+                    yield ContentEvent(piece)
+                yield DoneEvent()
+                return
+        response_parts = []
+
+        # Wait for a free slot on the model server
+        if ticket is not None:
+            async for event in self.wait_for_slot(ticket):
+                yield event
+            if not ticket.granted:
+                record_error('ollama', 'QueueTimeout')
+                yield ErrorEvent("The server is busy. Please try again shortly.")
+                return
+            QUEUE_WAIT_SECONDS.observe(ticket.granted_at - ticket.enqueued_at)
+
+        backend = ticket.backend if ticket is not None else self.backends.choose()
+        payload = build_ollama_payload(messages, model, profile_context, self.sync_manager.models.request_settings(model))
+        timer = GenerationTimer(model)
+
+        try:
+            async with self.http_client.stream("POST", f"{backend.url}/api/chat", json=payload) as response:
+                response.raise_for_status()
+
+                async for line in response.aiter_lines():
+                    if line:
+                        try:
+                            event = parse_ollama_line(line)
+                        except ValueError:
+                            continue
+                        except Exception as e:
+                            logger.log_backend("error", f"Error processing response: {e}")
+                            continue
+
+                        if event is None:
+                            continue
+                        if event.type == "done":
+                            backend.record_success()
+                            timer.finish()
+                            if cache_key and response_parts:
+                                response_cache.set(cache_key, "".join(response_parts))
+                            yield event
+                            break
+                        timer.token()
+                        if cache_key:
+                            response_parts.append(event.content)
+                        yield event
+
+        except httpx.TimeoutException as e:
+            record_error('ollama', e)
+            error_msg = "Error: Request to Ollama timed out."
+            yield ErrorEvent(error_msg)
+        except httpx.HTTPError as e:
+            record_error('ollama', e)
+            if isinstance(e, httpx.TransportError):
+                backend.record_failure(e)
+            error_msg = f"Error connecting to Ollama: {str(e)}"
+            yield ErrorEvent(error_msg)
+        except Exception as e:
+            record_error('ollama', e)
+            error_msg = f"An unexpected error occurred: {str(e)}"
+            yield ErrorEvent(error_msg)
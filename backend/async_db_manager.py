@@ -0,0 +1,169 @@
+import asyncio
+import os
+from datetime import datetime
+import uuid
+from pymongo import AsyncMongoClient, DESCENDING, ReturnDocument, UpdateOne
+from db_manager import (
+    DatabaseManager, MESSAGE_PROJECTION, CHAT_CONTEXT_PROJECTION, SNIPPET_LENGTH, PendingWritesError,
+    get_legacy_layout, mongo_client_options, chat_append_update, message_document
+)
+from logger import logger
+from metrics import MONGO_OPERATION_SECONDS, timed_methods
+
+_async_client = None
+
+def get_async_mongo_client():
+    """Return the process-wide asyncio MongoDB client, creating it on first use."""
+    global _async_client
+    if _async_client is None:
+        mongo_uri = os.getenv('MONGO_URI', 'mongodb://localhost:27017/')
+        _async_client = AsyncMongoClient(mongo_uri, **mongo_client_options('async'))
+    return _async_client
+
+async def close_async_mongo_client():
+    """Close the process-wide asyncio MongoDB client."""
+    global _async_client
+    if _async_client is not None:
+        await _async_client.close()
+        _async_client = None
+
+# rehydrate_chat is timed by the sync manager it delegates to
+@timed_methods(MONGO_OPERATION_SECONDS, exclude=('iter_recent_messages', 'rehydrate_chat'))
+class AsyncDatabaseManager:
+    """Asyncio counterpart of DatabaseManager for the operations on the chat path."""
+
+    def __init__(self, sync_db_manager=None):
+        self.client = get_async_mongo_client()
+        self.db = self.client['ai_chat_app']
+        self.chat_collection = self.db['chat_history']  # legacy one-document-per-user layout
+        self.chats_collection = self.db['chats']
+        self.messages_collection = self.db['messages']
+        self.profile_collection = self.db['profiles']
+        # Used for the rare legacy-user migration (run in a thread) and for the
+        # background MessageWriter shared with the sync code
+        self.sync_db_manager = sync_db_manager or DatabaseManager()
+
+    async def _ensure_migrated(self, user_id):
+        """See DatabaseManager._ensure_migrated; the state is shared with the sync managers."""
+        legacy = get_legacy_layout()
+        if legacy.check_due():
+            legacy.record_check(await self.chat_collection.find_one({}, {'_id': 1}) is None)
+        if not legacy.needs_migration(user_id):
+            return
+        if await self.chat_collection.find_one({'_id': user_id}, {'_id': 1}):
+            await asyncio.to_thread(self.sync_db_manager.migrate_legacy_user, user_id)
+        legacy.mark_migrated(user_id)
+
+    async def rehydrate_chat(self, user_id, chat_id):
+        """Move an archived chat's messages back; rare, so run in a thread like the migration."""
+        return await asyncio.to_thread(self.sync_db_manager.rehydrate_chat, user_id, chat_id)
+
+    # Chat History Methods
+    async def append_message_with_context(self, user_id, chat_id, role, content, tokens=None, title="New Chat"):
+        """Add a message and read back its chat's context fields in one round-trip.
+
+        See DatabaseManager.append_message_with_context; the message document is
+        handed to the same background MessageWriter.
+        """
+        await self._ensure_migrated(user_id)
+        # A reply to the previous turn may still be queued; it must get the earlier seq
+        if chat_id is not None and self.message_writer.has_pending(chat_id):
+            if not await asyncio.to_thread(self.message_writer.wait_for_chat, chat_id):
+                logger.log_backend("warning", f"Turn rejected, earlier messages of chat {chat_id} still unwritten")
+                raise PendingWritesError()
+        now = datetime.now().isoformat()
+        update = chat_append_update(role, content, tokens, now)
+        create = chat_id is None
+        if create:
+            chat_id = str(uuid.uuid4())
+            update['$setOnInsert'] = {'title': title, 'created_at': now}
+
+        chat = await self.chats_collection.find_one_and_update(
+            {'_id': chat_id, 'user_id': user_id},
+            update,
+            projection=CHAT_CONTEXT_PROJECTION,
+            upsert=create,
+            return_document=ReturnDocument.AFTER
+        )
+        if not chat:
+            return chat_id, None
+        if chat.get('archived_at') and await self.rehydrate_chat(user_id, chat_id):
+            chat = await self.chats_collection.find_one({'_id': chat_id}, CHAT_CONTEXT_PROJECTION)
+
+        self.message_writer.submit_message(
+            message_document(user_id, chat_id, chat['message_count'], role, content, now, tokens)
+        )
+        return chat_id, chat
+
+    async def begin_reply(self, user_id, chat_id, stream_id, content, tokens=None):
+        """Store the first checkpoint of a reply (see DatabaseManager.begin_reply)."""
+        now = datetime.now().isoformat()
+        update = chat_append_update("assistant", content, tokens, now)
+        update['$push']['recent']['$each'][0]['stream_id'] = stream_id
+        chat = await self.chats_collection.find_one_and_update(
+            {'_id': chat_id, 'user_id': user_id},
+            update,
+            projection={'message_count': 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if not chat:
+            return None
+
+        document = message_document(user_id, chat_id, chat['message_count'], "assistant", content, now, tokens)
+        document.update({'stream_id': stream_id, 'partial': True})
+        await self.messages_collection.insert_one(document)
+        return chat['message_count']
+
+    async def update_reply(self, user_id, chat_id, seq, stream_id, content, tokens=None, final=False):
+        """Replace the content of a checkpointed reply (see DatabaseManager.update_reply)."""
+        message_update = {'$set': {'content': content, 'tokens': tokens}}
+        if final:
+            message_update['$unset'] = {'partial': ""}
+        await self.messages_collection.update_one({'chat_id': chat_id, 'seq': seq}, message_update)
+        await self.chats_collection.update_one(
+            {'_id': chat_id, 'user_id': user_id, 'recent.stream_id': stream_id},
+            {'$set': {
+                'recent.$.content': content,
+                'recent.$.tokens': tokens,
+                'last_message': content[:SNIPPET_LENGTH],
+                # The snippet changed, so delta syncs must pick the chat up again
+                'updated_at': datetime.now().isoformat()
+            }}
+        )
+
+    @property
+    def message_writer(self):
+        return self.sync_db_manager.message_writer
+
+    def iter_recent_messages(self, user_id, chat_id, before=None, batch_size=50):
+        """Async cursor over a chat's messages newest first, with seq and cached token counts."""
+        query = {'chat_id': chat_id, 'user_id': user_id}
+        if before is not None:
+            query['seq'] = {'$lt': before}
+        return self.messages_collection.find(
+            query,
+            {**MESSAGE_PROJECTION, 'seq': 1, 'tokens': 1}
+        ).sort('seq', DESCENDING).batch_size(batch_size)
+
+    async def set_message_tokens(self, chat_id, tokens_by_seq):
+        """Cache token counts on stored messages."""
+        operations = [
+            UpdateOne({'chat_id': chat_id, 'seq': seq}, {'$set': {'tokens': tokens}})
+            for seq, tokens in tokens_by_seq.items()
+        ]
+        if operations:
+            await self.messages_collection.bulk_write(operations, ordered=False)
+
+    async def set_context_start(self, user_id, chat_id, seq):
+        """Record where the chat's window starts (see DatabaseManager.set_context_start)."""
+        update = {'$set': {'context_start': seq}} if seq is not None else {'$unset': {'context_start': ""}}
+        await self.chats_collection.update_one({'_id': chat_id, 'user_id': user_id}, update)
+
+    # Profile Methods
+    async def get_profile(self, user_id):
+        """Get user profile."""
+        profile = await self.profile_collection.find_one({'_id': user_id})
+        if profile:
+            profile.pop('_id', None)
+            return profile
+        return {}
@@ -0,0 +1,84 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Returned by TTLCache.get when a key is absent, so falsy values can be cached
+MISSING = object()
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after `ttl` seconds.
+
+    A value read from the source while an invalidation happens may be stale.
+    Take generation() before the read and pass it to set(), which then skips
+    the value if the key was invalidated since.
+    """
+
+    def __init__(self, maxsize=1000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # Generation of each key's last invalidation, for the newest maxsize keys;
+        # keys dropped from it count as invalidated at _floor
+        self._generation = 0
+        self._invalidated = OrderedDict()
+        self._floor = 0
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def generation(self):
+        """Counter to pass to set() for a value about to be read from the source."""
+        with self._lock:
+            return self._generation
+
+    def set(self, key, value, generation=None):
+        """Cache a value; returns False if it was read before the key's last invalidation."""
+        with self._lock:
+            if generation is not None and self._invalidated.get(key, self._floor) > generation:
+                return False
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            return True
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            self._generation += 1
+            self._invalidated[key] = self._generation
+            self._invalidated.move_to_end(key)
+            while len(self._invalidated) > self.maxsize:
+                _, generation = self._invalidated.popitem(last=False)
+                self._floor = max(self._floor, generation)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._generation += 1
+            self._invalidated.clear()
+            self._floor = self._generation
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses
+            }
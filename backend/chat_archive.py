@@ -0,0 +1,91 @@
+"""Cold storage for chats that have not been used in a long time.
+
+An archived chat keeps its document in the chats collection (title, counts,
+summary) so it still shows in the chat list, but its messages are moved out
+of the messages collection into one compressed blob in chat_archive, and its
+cached recent messages are dropped. Opening or writing to the chat moves the
+messages back (DatabaseManager.rehydrate_chat).
+"""
+import json
+import os
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+from logger import logger
+
+try:
+    import zstandard
+except ImportError:  # optional (installed with pymongo[zstd]); zlib is used instead
+    zstandard = None
+
+ARCHIVE_CODEC = os.getenv('CHAT_ARCHIVE_CODEC', 'zstd' if zstandard else 'zlib').lower()
+ZSTD_LEVEL = 10
+ZLIB_LEVEL = 9
+
+def compress_messages(messages, codec=None):
+    """Compress a list of message documents; returns (codec, blob)."""
+    codec = codec or ARCHIVE_CODEC
+    raw = json.dumps(messages, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ValueError("zstd archives need the zstandard package")
+        return codec, zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(raw)
+    if codec == 'zlib':
+        return codec, zlib.compress(raw, ZLIB_LEVEL)
+    raise ValueError(f"Unknown archive codec: {codec}")
+
+def decompress_messages(codec, blob):
+    """Inverse of compress_messages."""
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ValueError("zstd archives need the zstandard package")
+        raw = zstandard.ZstdDecompressor().decompress(blob)
+    elif codec == 'zlib':
+        raw = zlib.decompress(blob)
+    else:
+        raise ValueError(f"Unknown archive codec: {codec}")
+    return json.loads(raw)
+
+class ChatArchiver:
+    """Archive chats idle for more than CHAT_ARCHIVE_AFTER_DAYS on a background thread.
+
+    Runs every CHAT_ARCHIVE_INTERVAL seconds, CHAT_ARCHIVE_BATCH chats at a
+    time. Every worker process may run one; a chat is only archived if it
+    was not written to while it was being archived.
+    """
+
+    def __init__(self, db_manager, idle_days=None, interval=None, batch_size=None):
+        self.db_manager = db_manager
+        if idle_days is None:
+            idle_days = float(os.getenv('CHAT_ARCHIVE_AFTER_DAYS', '90'))
+        if interval is None:
+            interval = float(os.getenv('CHAT_ARCHIVE_INTERVAL', '3600'))
+        if batch_size is None:
+            batch_size = int(os.getenv('CHAT_ARCHIVE_BATCH', '200'))
+        self.idle_days = idle_days
+        self.interval = interval
+        self.batch_size = batch_size
+        if self.idle_days > 0 and self.interval > 0:
+            threading.Thread(target=self._archive_periodically, daemon=True).start()
+
+    def run_once(self):
+        """Archive every chat that is currently idle; returns how many were archived."""
+        idle_before = (datetime.now() - timedelta(days=self.idle_days)).isoformat()
+        total = 0
+        while True:
+            archived = self.db_manager.archive_idle_chats(idle_before, self.batch_size)
+            total += archived
+            # A short batch means no candidates are left (or some were skipped until next run)
+            if archived < self.batch_size:
+                return total
+
+    def _archive_periodically(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                archived = self.run_once()
+                if archived:
+                    logger.log_backend("info", f"Archived {archived} idle chats")
+            except Exception as e:
+                logger.log_backend("error", f"Error archiving idle chats: {e}")
@@ -1,27 +1,283 @@
-import json
+import itertools
+import os
+import threading
+import time
 import uuid
 from datetime import datetime
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from db_manager import DatabaseManager
+from logger import logger
+from metrics import QUEUE_WAIT_SECONDS, GenerationTimer, record_error
+from context_builder import ContextBuilder, estimate_tokens, parse_model_budgets, recent_newest_first, CHARS_PER_TOKEN
+from cache import MISSING, TTLCache
+from model_registry import DEFAULT_MODEL, ModelRegistry, ollama_model_name
+from response_cache import ResponseCache, replay_chunks
+from ollama_pool import OllamaPool, parse_backend_urls
+from scheduler import QueueFullError, POSITION_POLL_INTERVAL
+from reply_streams import ReplyInProgressError, ReplyStreamRegistry, cancellation_message
+from chat_archive import ChatArchiver
+from stream_events import CancelledEvent, ContentEvent, DoneEvent, ErrorEvent, QueuedEvent, coalesce, json_loads
+
+SYSTEM_PROMPT = "You are a helpful AI assistant. "
+SUMMARY_PROMPT = (
+    "Summarize the conversation below in a few sentences. Keep facts, decisions "
+    "and user preferences that later replies may need. Reply with the summary only."
+)
+
+def build_ollama_payload(messages, model=DEFAULT_MODEL, profile_context="", settings=None):
+    """Build the streaming /api/chat request body for Ollama.
+    
+    The system message comes first and only depends on the profile, so
+    consecutive turns of a chat share their prompt prefix and Ollama can
+    reuse its evaluation. settings adds the model's keep_alive and options.
+    """
+    # Add profile context to the system message if provided
+    system_message = {
+        "role": "system",
+        "content": SYSTEM_PROMPT + profile_context
+    }
+    payload = {
+        "model": model,
+        "messages": [system_message] + messages,
+        "stream": True
+    }
+    if settings:
+        payload.update(settings)
+    return payload
+
+def parse_ollama_line(line):
+    """Turn one line of Ollama's streaming response into a stream event.
+    
+    Returns None for lines that carry no content. Raises ValueError (such as
+    json.JSONDecodeError) for lines that are not valid JSON.
+    """
+    if isinstance(line, bytes):
+        line = line.decode('utf-8')
+    if line.startswith('data: '):
+        line = line[6:].strip()
+    
+    if line == '[DONE]':
+        return DoneEvent()
+    
+    data = json_loads(line)
+    
+    if data.get('done', False):
+        return DoneEvent()
+    
+    if data.get('message') and data['message'].get('content'):
+        return ContentEvent(data['message']['content'])
+    return None
+
+def ollama_http_settings():
+    """Connection settings for the HTTP client pool to Ollama.
+    
+    Configured with OLLAMA_POOL_SIZE, OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT
+    and OLLAMA_CONNECT_RETRIES. The read timeout applies between streamed chunks,
+    not to the whole generation.
+    """
+    return {
+        'pool_size': int(os.getenv('OLLAMA_POOL_SIZE', '20')),
+        'connect_timeout': float(os.getenv('OLLAMA_CONNECT_TIMEOUT', '5')),
+        'read_timeout': float(os.getenv('OLLAMA_READ_TIMEOUT', '300')),
+        'connect_retries': int(os.getenv('OLLAMA_CONNECT_RETRIES', '2'))
+    }
 
 class ChatManager:
-    def __init__(self, ollama_url=None):
+    def __init__(self, ollama_url=None, summarize_context=None):
         self.db_manager = DatabaseManager()
-        self.ollama_url = ollama_url or f"http://localhost:11434"
-        print(f"Connecting to Ollama at: {self.ollama_url}")  # For debugging
+        # ollama_url may list several backends separated by commas
+        self.backends = OllamaPool(parse_backend_urls(ollama_url) or None)
+        self.http_settings = ollama_http_settings()
+        self.timeout = (self.http_settings['connect_timeout'], self.http_settings['read_timeout'])
+        self.session = self._create_session()
+        self.models = ModelRegistry()
+        # CONTEXT_TOKEN_BUDGETS still overrides the budgets of registered models
+        self.context_builder = ContextBuilder(model_budgets={
+            **self.models.token_budgets(), **parse_model_budgets(os.getenv('CONTEXT_TOKEN_BUDGETS', ''))
+        })
+        self._loaded_models = TTLCache(maxsize=len(self.backends.backends), ttl=float(os.getenv('OLLAMA_PS_TTL', '5')))
+        if summarize_context is None:
+            summarize_context = os.getenv('CONTEXT_SUMMARY', 'false').lower() in ('1', 'true', 'yes')
+        self.summarize_context = summarize_context
+        self._summaries_in_progress = set()
+        self._summary_lock = threading.Lock()
+        self.streams = ReplyStreamRegistry()
+        self.checkpoint_interval = float(os.getenv('REPLY_CHECKPOINT_INTERVAL', '2'))
+        self.archiver = ChatArchiver(self.db_manager)
+        # Set once the process is shutting down; new chats go to other workers
+        self.draining = False
+        self.response_cache = None
+        if os.getenv('RESPONSE_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes'):
+            self.response_cache = ResponseCache()
+        logger.log_backend("info", f"Connecting to Ollama at: {', '.join(self.backends.urls)}")
+        # Load the models before the first chat needs them, without delaying startup
+        if os.getenv('OLLAMA_WARMUP', 'true').lower() in ('1', 'true', 'yes'):
+            threading.Thread(target=self.warm_up_models, daemon=True).start()
+    
+    def _create_session(self):
+        """Create the keep-alive session shared by all requests to Ollama."""
+        # Retry only failed connects; a generation that was already sent is never replayed
+        retries = Retry(
+            total=None,
+            connect=self.http_settings['connect_retries'],
+            read=0,
+            redirect=0,
+            status=0,
+            other=0,
+            backoff_factor=0.2
+        )
+        adapter = HTTPAdapter(
+            pool_connections=len(self.backends.backends),
+            pool_maxsize=self.http_settings['pool_size'],
+            max_retries=retries
+        )
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update({"Content-Type": "application/json"})
+        return session
+    
+    def close(self):
+        """Release the pooled connections to Ollama."""
+        self.session.close()
+    
+    def shutdown(self, timeout):
+        """Stop taking chats and drain the replies being generated, before the process exits.
+        
+        Replies still being generated after timeout seconds are cancelled and
+        keep what was generated so far; pending message writes are flushed.
+        """
+        if self.draining:
+            return
+        self.draining = True
+        cancelled = self.streams.drain(timeout)
+        if cancelled:
+            logger.log_backend("warning", f"Cancelled {cancelled} replies still being generated at shutdown")
+        self.db_manager.message_writer.flush()
+        self.close()
+    
+    def warm_up_models(self, models=None):
+        """Load models on the backends serving them, with the keep_alive and options used for chats.
+        
+        Defaults to every registered model. An /api/chat request without
+        messages only loads the model.
+        """
+        for backend in self.backends.backends:
+            for model in models or self.models.names:
+                allowed = self.models.backends_for(model)
+                if allowed is not None and backend.url not in allowed:
+                    continue
+                try:
+                    response = self.session.post(
+                        f"{backend.url}/api/chat",
+                        json={"model": model, "messages": [], "stream": False, **self.models.request_settings(model)},
+                        timeout=self.timeout
+                    )
+                    response.raise_for_status()
+                    logger.log_backend("info", f"Loaded {model} on {backend.url}")
+                except requests.exceptions.RequestException as e:
+                    logger.log_backend("warning", f"Error loading {model} on {backend.url}: {e}")
+    
+    def loaded_models(self, backend):
+        """Models loaded on a backend (Ollama's /api/ps) by name, cached for a few seconds."""
+        loaded = self._loaded_models.get(backend.url)
+        if loaded is MISSING:
+            try:
+                response = self.session.get(f"{backend.url}/api/ps", timeout=self.backends.health_timeout)
+                response.raise_for_status()
+                loaded = {model.get('name'): model for model in response.json().get('models', [])}
+            except (requests.exceptions.RequestException, ValueError) as e:
+                logger.log_backend("warning", f"Error listing models on {backend.url}: {e}")
+                loaded = None
+            self._loaded_models.set(backend.url, loaded)
+        return loaded
+    
+    def model_status(self):
+        """The registered models, with the backends each one is loaded (warm) on."""
+        loaded = {backend.url: self.loaded_models(backend) for backend in self.backends.backends}
+        models = []
+        for name in self.models.names:
+            config = self.models.get(name)
+            serving = [url for url in loaded if config.backends is None or url in config.backends]
+            warm_on = [
+                url for url in serving
+                if loaded[url] is not None and ollama_model_name(name) in loaded[url]
+            ]
+            models.append({
+                **config.to_dict(),
+                'backends': serving,
+                'loaded_on': warm_on,
+                'warm': bool(warm_on),
+                'expires_at': {url: loaded[url][ollama_model_name(name)].get('expires_at') for url in warm_on}
+            })
+        return {
+            'default': self.models.default_model,
+            'small_model': self.models.small_model,
+            'models': models,
+            'unreachable': [url for url, models_loaded in loaded.items() if models_loaded is None]
+        }
+    
+    def admit(self, user_id, chat_id=None, model=DEFAULT_MODEL):
+        """Reserve a place in the queue of an Ollama backend, to be passed to send_to_ollama.
+        
+        Only backends serving the model are considered; turns of an existing
+        chat go to the backend that served it before.
+        
+        Raises:
+            QueueFullError: If the queue is too deep; retry_after says when to try again
+        """
+        return self.backends.admit(user_id, chat_id, self.models.backends_for(model))
+    
+    def release(self, ticket):
+        """Give back a ticket from admit; safe to call more than once."""
+        self.backends.release(ticket)
+    
+    def bind_chat(self, chat_id, ticket):
+        """Route later turns of a chat (e.g. one just created) to the ticket's backend."""
+        self.backends.pin(chat_id, ticket.backend)
+    
+    def wait_for_slot(self, ticket, cancel=None):
+        """Wait for a ticket to be granted, yielding QueuedEvents with its position.
+        
+        Returns True once granted, False if the queue timeout ran out or the
+        request was cancelled.
+        """
+        scheduler = ticket.backend.scheduler
+        deadline = time.monotonic() + scheduler.queue_timeout
+        last_position = None
+        while not ticket.granted:
+            position = scheduler.position(ticket)
+            if position and position != last_position:
+                yield QueuedEvent(position)
+                last_position = position
+            if time.monotonic() >= deadline or (cancel is not None and cancel.is_set):
+                return False
+            ticket.wait(POSITION_POLL_INTERVAL)
+        return True
     
     def get_user_chats(self, user_id):
         return self.db_manager.get_user_chats(user_id)
     
+    def get_chat_summaries(self, user_id, since=None):
+        return self.db_manager.get_chat_summaries(user_id, since)
+    
     def create_chat(self, user_id, title="New Chat"):
         return self.db_manager.create_chat(user_id, title)
     
     def add_message(self, user_id, chat_id, role, content):
-        return self.db_manager.add_message(user_id, chat_id, role, content)
+        return self.db_manager.add_message(user_id, chat_id, role, content, tokens=estimate_tokens(content))
     
     def get_chat_messages(self, user_id, chat_id):
         return self.db_manager.get_chat_messages(user_id, chat_id)
     
+    def get_chat_messages_page(self, user_id, chat_id, before=None, limit=50):
+        return self.db_manager.get_chat_messages_page(user_id, chat_id, before, limit)
+    
+    def search_messages(self, user_id, query, offset=0, limit=20):
+        return self.db_manager.search_messages(user_id, query, offset, limit)
+    
     def delete_chat(self, user_id, chat_id):
         return self.db_manager.delete_chat(user_id, chat_id)
     
@@ -41,73 +297,327 @@ class ChatManager:
         """
         return self.db_manager.update_chat_title(user_id, chat_id, new_title)
     
+    def start_turn(self, user_id, chat_id, message, model=DEFAULT_MODEL, profile_context="", title="New Chat"):
+        """Add the user's message and assemble the context for the reply.
+        
+        The message is recorded and the chat's cached recent messages and
+        summary are read back by one database operation, which also creates
+        the chat when chat_id is None. Older messages are only read when the
+        whole cached tail fits in the budget. The window starts where the
+        previous turn's did while it fits (see ContextBuilder), so Ollama can
+        reuse the prompt it already evaluated for the chat.
+        
+        A reply still being generated for the chat is cancelled and saved
+        first, so it stays before the new message and in its context.
+        
+        Returns:
+            tuple: (chat_id, messages) where messages is None if the chat does not exist
+        
+        Raises:
+            ReplyInProgressError: if the previous reply could not be stopped in time
+        """
+        if chat_id is not None and not self.streams.supersede(user_id, chat_id):
+            raise ReplyInProgressError()
+        chat_id, chat = self.db_manager.append_message_with_context(
+            user_id, chat_id, "user", message, tokens=estimate_tokens(message), title=title
+        )
+        if chat is None:
+            return chat_id, None
+        
+        summary, summarized_through = "", 0
+        if self.summarize_context:
+            summary, summarized_through = chat.get('summary', ""), chat.get('summarized_through', 0)
+        reserved_tokens = estimate_tokens(SYSTEM_PROMPT + profile_context) + estimate_tokens(summary)
+        
+        recent = recent_newest_first(chat.get('recent', []), chat['message_count'])
+        first_seq = recent[-1]['seq'] if recent else chat['message_count'] + 1
+        start_seq = chat.get('context_start')
+        # Lazy cursor: only queried if the builder runs past the cached messages
+        older = self.db_manager.iter_recent_messages(user_id, chat_id, before=first_seq)
+        try:
+            window, evicted_through, uncached = self.context_builder.build(
+                itertools.chain(recent, older), model, reserved_tokens, start_seq
+            )
+        finally:
+            older.close()
+        
+        if uncached:
+            self.db_manager.set_message_tokens(chat_id, uncached)
+        self.save_context_start(user_id, chat_id, start_seq, evicted_through)
+        
+        return chat_id, self.finish_context(user_id, chat_id, model, window, evicted_through, summary, summarized_through)
+    
+    def save_context_start(self, user_id, chat_id, start_seq, evicted_through):
+        """Store where the chat's window now starts, when it moved."""
+        context_start = evicted_through + 1 if evicted_through else None
+        if context_start != start_seq:
+            self.db_manager.set_context_start(user_id, chat_id, context_start)
+    
+    def save_reply(self, user_id, chat_id, content):
+        """Persist an assistant reply in the background, without delaying the stream."""
+        self.db_manager.message_writer.submit_append(
+            user_id, chat_id, "assistant", content, tokens=estimate_tokens(content)
+        )
+    
+    def start_reply(self, user_id, chat_id, messages, model=DEFAULT_MODEL, profile_context="", cache=False, ticket=None):
+        """Generate a reply in the background and return the ReplyStream clients read it from.
+        
+        Generation does not depend on any client staying connected: the
+        reply is checkpointed to the chat every checkpoint_interval seconds
+        and saved when it completes, and a client that drops can resume
+        reading the stream where it stopped.
+        """
+        stream = self.streams.start(user_id, chat_id, token_limit=self.models.token_limit(model))
+        events = coalesce(stream.count_generated(
+            self.send_to_ollama(messages, model, profile_context, cache, ticket, stream.cancellation)
+        ))
+        threading.Thread(target=self._run_reply, args=(stream, events), daemon=True).start()
+        return stream
+    
+    def _run_reply(self, stream, events):
+        parts = []
+        seq = None
+        completed = False
+        last_checkpoint = time.monotonic()
+        try:
+            for event in events:
+                stream.publish(event)
+                if event.type == "content":
+                    parts.append(event.content)
+                    if time.monotonic() - last_checkpoint >= self.checkpoint_interval:
+                        seq = self.checkpoint_reply(stream, seq, "".join(parts))
+                        last_checkpoint = time.monotonic()
+                elif event.type == "done":
+                    completed = True
+                    break
+                elif event.type == "error":
+                    break
+                # Stop generating once every client has been gone for the grace period
+                if stream.check_abandoned():
+                    break
+        except Exception as e:
+            logger.log_backend("error", f"Error generating reply for chat {stream.chat_id}: {e}")
+            stream.publish(ErrorEvent(f"An unexpected error occurred: {str(e)}"))
+        finally:
+            events.close()
+            content = "".join(parts)
+            if stream.cancellation.is_set and not completed:
+                self.streams.record_cancellation(stream)
+                logger.log_backend("info", cancellation_message(stream))
+                stream.publish(CancelledEvent(stream.cancellation.reason))
+            elif completed:
+                self.streams.record_completion()
+            self.finish_reply(stream, seq, content, completed)
+            stream.finish()
+    
+    def cancel_reply(self, user_id, chat_id, reason="user"):
+        """Stop the reply being generated for a chat; returns False if there is none."""
+        stream = self.streams.get(user_id, chat_id)
+        if stream is None or stream.finished:
+            return False
+        return stream.cancel(reason)
+    
+    def checkpoint_reply(self, stream, seq, content):
+        """Save the reply generated so far; returns the seq of the stored message."""
+        try:
+            if seq is None:
+                return self.db_manager.begin_reply(
+                    stream.user_id, stream.chat_id, stream.id, content, estimate_tokens(content)
+                )
+            self.db_manager.update_reply(
+                stream.user_id, stream.chat_id, seq, stream.id, content, estimate_tokens(content)
+            )
+        except Exception as e:
+            logger.log_backend("error", f"Error checkpointing reply for chat {stream.chat_id}: {e}")
+        return seq
+    
+    def finish_reply(self, stream, seq, content, completed):
+        """Save the final reply, or what was generated of it if generation stopped early."""
+        try:
+            if seq is not None:
+                self.db_manager.update_reply(
+                    stream.user_id, stream.chat_id, seq, stream.id, content, estimate_tokens(content), final=completed
+                )
+            elif content.strip():
+                if completed:
+                    self.save_reply(stream.user_id, stream.chat_id, content)
+                else:
+                    self.checkpoint_reply(stream, None, content)
+        except Exception as e:
+            logger.log_backend("error", f"Error saving reply for chat {stream.chat_id}: {e}")
+    
+    def finish_context(self, user_id, chat_id, model, window, evicted_through, summary, summarized_through):
+        """Schedule a summary of newly evicted turns and prepend the current one."""
+        if self.summarize_context and evicted_through and evicted_through > summarized_through:
+            self.schedule_summary(user_id, chat_id, model, summary, summarized_through, evicted_through)
+        
+        if summary:
+            window.insert(0, {"role": "system", "content": f"Summary of the earlier conversation: {summary}"})
+        return window
+    
+    def schedule_summary(self, user_id, chat_id, model, summary, after_seq, through_seq):
+        with self._summary_lock:
+            if chat_id in self._summaries_in_progress:
+                return
+            self._summaries_in_progress.add(chat_id)
+        threading.Thread(
+            target=self._summarize_evicted,
+            args=(user_id, chat_id, model, summary, after_seq, through_seq),
+            daemon=True
+        ).start()
+    
+    def _summarize_evicted(self, user_id, chat_id, model, summary, after_seq, through_seq):
+        """Fold the evicted turns after_seq < seq <= through_seq into the chat summary."""
+        try:
+            evicted = self.db_manager.get_messages_range(user_id, chat_id, after_seq, through_seq)
+            transcript = "\n".join(f"{m['role']}: {m['content']}" for m in evicted)
+            # Keep the summarization request itself well inside the model budget
+            max_chars = self.context_builder.budget_for(model) * CHARS_PER_TOKEN // 2
+            transcript = transcript[-max_chars:]
+            if summary:
+                transcript = f"Earlier summary: {summary}\n\n{transcript}"
+            
+            # Summaries take a slot like any chat request; skip this round if busy
+            try:
+                ticket = self.admit(user_id, chat_id, model)
+            except QueueFullError:
+                return
+            try:
+                if not ticket.wait(ticket.backend.scheduler.queue_timeout):
+                    return
+                response = self.session.post(
+                    f"{ticket.backend.url}/api/chat",
+                    json={
+                        "model": model,
+                        "messages": [
+                            {"role": "system", "content": SUMMARY_PROMPT},
+                            {"role": "user", "content": transcript}
+                        ],
+                        "stream": False,
+                        **self.models.request_settings(model)
+                    },
+                    timeout=self.timeout
+                )
+            finally:
+                self.release(ticket)
+            response.raise_for_status()
+            new_summary = response.json().get('message', {}).get('content', '').strip()
+            if new_summary:
+                self.db_manager.update_chat_summary(user_id, chat_id, new_summary, through_seq)
+        except Exception as e:
+            logger.log_backend("error", f"Error summarizing chat {chat_id}: {e}")
+        finally:
+            with self._summary_lock:
+                self._summaries_in_progress.discard(chat_id)
+    
     def generate_title(self, user_message):
         if len(user_message) > 30:
             return user_message[:27] + "..."
         return user_message
     
-    def send_to_ollama(self, messages, model="llama3.1:8b", profile_context=""):
-        # Add profile context to the system message if provided
-        system_message = {
-            "role": "system",
-            "content": "You are a helpful AI assistant. " + profile_context
-        }
+    def cached_response_key(self, messages, model=DEFAULT_MODEL, profile_context=""):
+        """Response cache key for a request, or None when caching is disabled."""
+        if self.response_cache is None:
+            return None
+        return self.response_cache.key(model, SYSTEM_PROMPT + profile_context, messages)
+    
+    def send_to_ollama(self, messages, model=DEFAULT_MODEL, profile_context="", cache=False, ticket=None, cancel=None):
+        """Stream the reply to messages as ContentEvent, QueuedEvent, ErrorEvent and DoneEvent objects.
+        
+        Setting the cancel Cancellation closes the request to Ollama, which
+        stops the generation there; the stream then ends without an event.
+        """
+        try:
+            yield from self._stream_reply(messages, model, profile_context, cache, ticket, cancel)
+        finally:
+            if ticket is not None:
+                self.release(ticket)
+    
+    def _stream_reply(self, messages, model, profile_context, cache, ticket, cancel):
+        # Replay a cached response for cacheable requests (canned catalog prompts)
+        cache_key = self.cached_response_key(messages, model, profile_context) if cache else None
+        if cache_key:
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                for piece in replay_chunks(cached):
+                    yield ContentEvent(piece)
+                yield DoneEvent()
+                return
+        response_parts = []
+        
+        # Wait for a free slot on the model server
+        if ticket is not None:
+            if not (yield from self.wait_for_slot(ticket, cancel)):
+                if cancel is None or not cancel.is_set:
+                    record_error('ollama', 'QueueTimeout')
+                    yield ErrorEvent("The server is busy. Please try again shortly.")
+                return
+            QUEUE_WAIT_SECONDS.observe(ticket.granted_at - ticket.enqueued_at)
+        
+        backend = ticket.backend if ticket is not None else self.backends.choose()
         
         # Prepare the payload for Ollama
-        payload = {
-            "model": model,
-            "messages": [system_message] + messages,
-            "stream": True
-        }
+        payload = build_ollama_payload(messages, model, profile_context, self.models.request_settings(model))
+        close_response = None
+        timer = GenerationTimer(model)
         
         try:
-            # Make request to Ollama with streaming
-            response = requests.post(
-                f"{self.ollama_url}/api/chat",
+            # Make request to Ollama with streaming over the pooled session
+            with self.session.post(
+                f"{backend.url}/api/chat",
                 json=payload,
                 stream=True,
-                timeout=300,
-                headers={"Content-Type": "application/json"},
-                verify=False
-            )
-            response.raise_for_status()
-            
-            for line in response.iter_lines():
-                if line:
-                    try:
-                        line = line.decode('utf-8')
-                        if line.startswith('data: '):
-                            line = line[6:].strip()
-                        
-                        if line == '[DONE]':
-                            yield json.dumps({"type": "done"})
-                            break
-                            
-                        data = json.loads(line)
+                timeout=self.timeout
+            ) as response:
+                response.raise_for_status()
+                # Closing the response drops the connection, so Ollama stops generating
+                if cancel is not None:
+                    close_response = response.close
+                    cancel.add_callback(close_response)
+                
+                for line in response.iter_lines():
+                    if cancel is not None and cancel.is_set:
+                        return
+                    if line:
+                        try:
+                            event = parse_ollama_line(line)
+                        except ValueError:
+                            continue
+                        except Exception as e:
+                            logger.log_backend("error", f"Error processing response: {e}")
+                            continue
                         
-                        if data.get('done', False):
-                            yield json.dumps({"type": "done"})
+                        if event is None:
+                            continue
+                        if event.type == "done":
+                            # Read the end of the body so the connection goes back to the pool
+                            response.raw.drain_conn()
+                            response.raw.release_conn()
+                            backend.record_success()
+                            timer.finish()
+                            if cache_key and response_parts:
+                                self.response_cache.set(cache_key, "".join(response_parts))
+                            yield event
                             break
-                            
-                        if data.get('message') and data['message'].get('content'):
-                            chunk = data['message']['content']
-                            yield json.dumps({
-                                "type": "content",
-                                "content": chunk
-                            })
-                            
-                    except json.JSONDecodeError:
-                        continue
-                    except Exception as e:
-                        print(f"Error processing response: {e}")
-                        continue
+                        timer.token()
+                        if cache_key:
+                            response_parts.append(event.content)
+                        yield event
             
-        except requests.exceptions.Timeout:
-            error_msg = "Error: Request to Ollama timed out."
-            yield json.dumps({"type": "error", "content": error_msg})
-        except requests.exceptions.RequestException as e:
-            error_msg = f"Error connecting to Ollama: {str(e)}"
-            yield json.dumps({"type": "error", "content": error_msg})
         except Exception as e:
-            error_msg = f"An unexpected error occurred: {str(e)}"
-            yield json.dumps({"type": "error", "content": error_msg})
\ No newline at end of file
+            if cancel is not None and cancel.is_set:
+                # The response was closed under the reader to cancel it
+                return
+            record_error('ollama', e)
+            if isinstance(e, requests.exceptions.Timeout):
+                error_msg = "Error: Request to Ollama timed out."
+            elif isinstance(e, requests.exceptions.RequestException):
+                if isinstance(e, requests.exceptions.ConnectionError):
+                    backend.record_failure(e)
+                error_msg = f"Error connecting to Ollama: {str(e)}"
+            else:
+                error_msg = f"An unexpected error occurred: {str(e)}"
+            yield ErrorEvent(error_msg)
+        finally:
+            if close_response is not None:
+                cancel.remove_callback(close_response)
@@ -0,0 +1,116 @@
+import os
+
+# Rough token estimate used for budgeting; close enough for llama-family tokenizers
+CHARS_PER_TOKEN = 4
+MESSAGE_OVERHEAD_TOKENS = 4
+
+def estimate_tokens(text):
+    """Estimate the number of tokens in a piece of text."""
+    if not text:
+        return 0
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+def parse_model_budgets(spec):
+    """Parse a 'model=tokens,model=tokens' string into a dict."""
+    budgets = {}
+    for entry in (spec or "").split(','):
+        if '=' not in entry:
+            continue
+        model, tokens = entry.rsplit('=', 1)
+        try:
+            budgets[model.strip()] = int(tokens)
+        except ValueError:
+            continue
+    return budgets
+
+def recent_newest_first(recent, message_count):
+    """Number the messages cached on a chat document and return them newest first."""
+    first_seq = message_count - len(recent) + 1
+    messages = [{**message, 'seq': first_seq + i} for i, message in enumerate(recent)]
+    messages.reverse()
+    return messages
+
+class ContextBuilder:
+    """Chooses the messages of a chat sent with each turn.
+
+    The window keeps starting at the same message from turn to turn for as
+    long as everything from there fits in the budget, so the prompt prefix
+    Ollama has already evaluated for the chat stays byte-identical. When it
+    no longer fits, the window moves forward by a whole chunk: it restarts
+    with only `refill` of the budget (CONTEXT_REFILL), leaving room for the
+    next turns before it has to move again. A refill of 1 slides the window
+    by a message at a time.
+    """
+
+    def __init__(self, default_budget=None, model_budgets=None, refill=None):
+        self.default_budget = default_budget or int(os.getenv('CONTEXT_TOKEN_BUDGET', '4096'))
+        if model_budgets is None:
+            model_budgets = parse_model_budgets(os.getenv('CONTEXT_TOKEN_BUDGETS', ''))
+        self.model_budgets = model_budgets
+        if refill is None:
+            refill = float(os.getenv('CONTEXT_REFILL', '0.6'))
+        self.refill = min(max(refill, 0.0), 1.0)
+
+    def budget_for(self, model):
+        return self.model_budgets.get(model, self.default_budget)
+
+    def message_tokens(self, message):
+        """Token count of a message, using the count cached on it when present."""
+        tokens = message.get('tokens')
+        if tokens is None:
+            tokens = estimate_tokens(message.get('content', ''))
+        return tokens + MESSAGE_OVERHEAD_TOKENS
+
+    def build(self, recent_messages, model, reserved_tokens=0, start_seq=None):
+        """Select the newest messages that fit in the model's token budget.
+
+        Args:
+            recent_messages: Iterable of stored messages, newest first
+            model: Model the context is built for
+            reserved_tokens: Tokens already taken by the system prompt and summary
+            start_seq: seq of the first message of the chat's previous window;
+                the window starts there again if everything from it fits
+
+        Returns:
+            tuple: (window, evicted_through, uncached) where window is the list of
+            messages in chronological order, evicted_through is the seq of the
+            newest message left out (None if nothing was left out) and uncached
+            maps seq to token count for messages that had no cached count
+        """
+        budget = self.budget_for(model) - reserved_tokens
+        used = 0
+        selected = []  # (message, tokens), newest first
+        uncached = {}
+        evicted_through = None
+        if start_seq is not None and start_seq > 1:
+            evicted_through = start_seq - 1
+
+        for message in recent_messages:
+            seq = message.get('seq')
+            if start_seq is not None and seq is not None and seq < start_seq:
+                if selected:
+                    break
+                # A start past the newest message is stale; fall back to a fresh window
+                start_seq = evicted_through = None
+            tokens = self.message_tokens(message)
+            if message.get('tokens') is None and seq is not None:
+                uncached[seq] = tokens - MESSAGE_OVERHEAD_TOKENS
+            # Always keep the newest message, even if it alone exceeds the budget
+            if selected and used + tokens > budget:
+                # Move the window forward by a chunk rather than by this one message
+                refill_budget = budget * self.refill
+                used = 0
+                for index, (kept, kept_tokens) in enumerate(selected):
+                    if index and used + kept_tokens > refill_budget:
+                        evicted_through = kept.get('seq')
+                        selected = selected[:index]
+                        break
+                    used += kept_tokens
+                else:
+                    evicted_through = seq
+                break
+            used += tokens
+            selected.append((message, tokens))
+
+        window = [{'role': message['role'], 'content': message['content']} for message, _ in reversed(selected)]
+        return window, evicted_through, uncached
@@ -1,116 +1,952 @@
+import atexit
 import os
-from pymongo import MongoClient
+import queue
+import threading
+import time
+from pymongo import MongoClient, ASCENDING, DESCENDING, TEXT, ReturnDocument, UpdateOne
+from pymongo import monitoring
+from pymongo.errors import DuplicateKeyError
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timedelta
 import uuid
+from cache import MISSING, TTLCache
+from logger import logger
+from metrics import CHAT_ARCHIVE_OPERATIONS, MONGO_OPERATION_SECONDS, record_error, timed_methods
+from chat_archive import compress_messages, decompress_messages
 
 # Load environment variables
 load_dotenv()
 
+# Fields returned for a stored message; internal keys stay in the database
+MESSAGE_PROJECTION = {'_id': 0, 'role': 1, 'content': 1, 'timestamp': 1}
+
+# Chat list summaries kept up to date on every write
+SUMMARY_PROJECTION = {'title': 1, 'updated_at': 1, 'message_count': 1, 'last_message': 1}
+SNIPPET_LENGTH = 100
+# How long deleted chat ids are kept for delta sync
+TOMBSTONE_RETENTION = timedelta(days=30)
+# Overlap between delta syncs so writes racing a sync are not missed
+SYNC_OVERLAP = timedelta(seconds=5)
+# How often the legacy chat_history collection is checked for users left to migrate
+LEGACY_CHECK_INTERVAL = 300
+# Newest messages cached on each chat document for building the context window
+RECENT_MESSAGES = int(os.getenv('CONTEXT_RECENT_MESSAGES', '50'))
+CHAT_CONTEXT_PROJECTION = {
+    'message_count': 1, 'recent': 1, 'summary': 1, 'summarized_through': 1, 'context_start': 1, 'archived_at': 1
+}
+# Fields of a message kept in its chat's archive blob
+ARCHIVE_PROJECTION = {'_id': 0, 'chat_id': 0, 'user_id': 0}
+# Characters of message text shown around the first match of a search
+SEARCH_SNIPPET_LENGTH = 160
+SEARCH_MAX_OFFSET = 1000
+
+def chat_append_update(role, content, tokens, now):
+    """Update that records a new message on its chat document."""
+    entry = {'role': role, 'content': content}
+    if tokens is not None:
+        entry['tokens'] = tokens
+    return {
+        '$inc': {'message_count': 1},
+        '$set': {'updated_at': now, 'last_message': content[:SNIPPET_LENGTH]},
+        '$push': {'recent': {'$each': [entry], '$slice': -RECENT_MESSAGES}}
+    }
+
+def recent_entry(message):
+    """Entry cached in a chat document's recent array for a stored message."""
+    entry = {'role': message.get('role'), 'content': message.get('content', '')}
+    if message.get('tokens') is not None:
+        entry['tokens'] = message['tokens']
+    return entry
+
+def archive_search_entry(user_id, chat_id, message):
+    """Copy of an archived message kept in chat_archive_search so text search still finds it."""
+    return {
+        'chat_id': chat_id,
+        'user_id': user_id,
+        'seq': message['seq'],
+        'role': message.get('role'),
+        'content': message.get('content', ''),
+        'timestamp': message.get('timestamp')
+    }
+
+def search_snippet(content, terms, length=SEARCH_SNIPPET_LENGTH):
+    """Part of a message around the first occurrence of any search term."""
+    lowered = content.lower()
+    positions = [lowered.find(term) for term in terms]
+    positions = [position for position in positions if position >= 0]
+    start = max(0, min(positions) - length // 4) if positions else 0
+    end = min(len(content), start + length)
+    start = max(0, end - length)
+    snippet = content[start:end].strip()
+    return ("..." if start > 0 else "") + snippet + ("..." if end < len(content) else "")
+
+def message_document(user_id, chat_id, seq, role, content, now, tokens=None):
+    """Document stored in the messages collection."""
+    document = {
+        'chat_id': chat_id,
+        'user_id': user_id,
+        'seq': seq,
+        'role': role,
+        'content': content,
+        'timestamp': now
+    }
+    if tokens is not None:
+        document['tokens'] = tokens
+    return document
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """Collect connection pool statistics from pymongo's pool events."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats = {
+            'open_connections': 0,
+            'in_use': 0,
+            'connections_created': 0,
+            'connections_closed': 0,
+            'checkouts': 0,
+            'checkout_failures': 0,
+            'pool_clears': 0
+        }
+
+    def _update(self, **changes):
+        with self._lock:
+            for key, delta in changes.items():
+                self.stats[key] += delta
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._update(pool_clears=1)
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._update(open_connections=1, connections_created=1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._update(open_connections=-1, connections_closed=1)
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self._update(checkout_failures=1)
+
+    def connection_checked_out(self, event):
+        self._update(in_use=1, checkouts=1)
+
+    def connection_checked_in(self, event):
+        self._update(in_use=-1)
+
+_client = None
+_client_lock = threading.Lock()
+# Pool statistics of each MongoDB client of the process, by client name
+_pool_stats = {'sync': PoolStatsListener()}
+
+def pool_stats_listener(client):
+    """The pool listener of a named client ('sync', 'async'), created on first use."""
+    return _pool_stats.setdefault(client, PoolStatsListener())
+
+def mongo_client_options(client='sync'):
+    """Connection pool and compression options shared by every MongoDB client.
+    
+    Pool size, wait queue timeout and wire compression are configured with the
+    MONGO_MAX_POOL_SIZE, MONGO_MIN_POOL_SIZE, MONGO_WAIT_QUEUE_TIMEOUT_MS and
+    MONGO_COMPRESSORS environment variables. Compressors whose Python package
+    is not installed are skipped by pymongo. client names the listener the
+    client's pool events are counted in, so each client has its own stats.
+    """
+    return {
+        'maxPoolSize': int(os.getenv('MONGO_MAX_POOL_SIZE', '50')),
+        'minPoolSize': int(os.getenv('MONGO_MIN_POOL_SIZE', '2')),
+        'waitQueueTimeoutMS': int(os.getenv('MONGO_WAIT_QUEUE_TIMEOUT_MS', '2000')),
+        'compressors': os.getenv('MONGO_COMPRESSORS', 'zstd,zlib'),
+        'event_listeners': [pool_stats_listener(client)]
+    }
+
+def get_mongo_client():
+    """Return the process-wide MongoDB client, creating it on first use."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            mongo_uri = os.getenv('MONGO_URI', 'mongodb://localhost:27017/')
+            _client = MongoClient(mongo_uri, **mongo_client_options())
+        return _client
+
+def close_mongo_client():
+    """Close the process-wide MongoDB client."""
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
+
+def get_pool_stats():
+    """Get connection pool statistics of each process-wide client, by client name."""
+    return {client: listener.snapshot() for client, listener in list(_pool_stats.items())}
+
+class PendingWritesError(Exception):
+    """Raised when a chat's earlier messages are still waiting to be written."""
+
+    def __init__(self, retry_after=1):
+        super().__init__(f"The previous reply is still being saved. Please retry in {retry_after} seconds.")
+        self.retry_after = retry_after
+
+class MessageWriter:
+    """Persist messages on a background thread, in submission order and in batches.
+    
+    Used for writes the client does not need to wait for, such as the message
+    documents of a turn whose chat document was already updated.
+    """
+
+    def __init__(self, chats_collection, messages_collection, batch_size=100):
+        self.chats_collection = chats_collection
+        self.messages_collection = messages_collection
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+        # Appends not yet written, by chat_id, so a new turn can keep message order
+        self._pending = {}
+        self._pending_changed = threading.Condition()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit_message(self, document):
+        """Insert a message document whose chat document is already updated."""
+        self.queue.put(('message', document))
+
+    def submit_append(self, user_id, chat_id, role, content, tokens=None):
+        """Append a message to a chat: update the chat document, then insert the message."""
+        with self._pending_changed:
+            self._pending[chat_id] = self._pending.get(chat_id, 0) + 1
+        self.queue.put(('append', (user_id, chat_id, role, content, tokens)))
+
+    def has_pending(self, chat_id):
+        with self._pending_changed:
+            return chat_id in self._pending
+
+    def wait_for_chat(self, chat_id, timeout=5):
+        """Wait until the appends submitted for a chat have been written; returns False on timeout."""
+        with self._pending_changed:
+            return self._pending_changed.wait_for(lambda: chat_id not in self._pending, timeout)
+
+    def flush(self, timeout=10):
+        """Wait until every submitted write has been attempted."""
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            started = time.monotonic()
+            try:
+                self._write(batch)
+            except Exception as e:
+                record_error('mongo', e)
+                logger.log_backend("error", f"Error writing messages: {e}")
+            finally:
+                MONGO_OPERATION_SECONDS.observe(time.monotonic() - started, 'message_writer')
+                with self._pending_changed:
+                    for kind, payload in batch:
+                        if kind == 'append':
+                            chat_id = payload[1]
+                            self._pending[chat_id] -= 1
+                            if not self._pending[chat_id]:
+                                del self._pending[chat_id]
+                    self._pending_changed.notify_all()
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _write(self, batch):
+        documents = []
+        for kind, payload in batch:
+            if kind == 'message':
+                documents.append(payload)
+                continue
+            user_id, chat_id, role, content, tokens = payload
+            now = datetime.now().isoformat()
+            chat = self.chats_collection.find_one_and_update(
+                {'_id': chat_id, 'user_id': user_id},
+                chat_append_update(role, content, tokens, now),
+                projection={'message_count': 1},
+                return_document=ReturnDocument.AFTER
+            )
+            if chat:
+                documents.append(message_document(user_id, chat_id, chat['message_count'], role, content, now, tokens))
+        if documents:
+            self.messages_collection.insert_many(documents, ordered=False)
+
+class LegacyLayout:
+    """What is known of the legacy chat_history collection, shared by the managers of a process.
+
+    Once the collection holds no user documents, the per-user migration check
+    is skipped. It is checked again every LEGACY_CHECK_INTERVAL seconds, so
+    legacy data imported later is still migrated. While users are left, those
+    already checked are remembered in a bounded cache.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.migrated_users = TTLCache(maxsize=maxsize, ttl=LEGACY_CHECK_INTERVAL)
+        self.empty = False
+        self.checked_at = None
+
+    def check_due(self):
+        return self.checked_at is None or time.monotonic() - self.checked_at >= LEGACY_CHECK_INTERVAL
+
+    def record_check(self, empty):
+        self.empty = empty
+        self.checked_at = time.monotonic()
+
+    def needs_migration(self, user_id):
+        """Whether user_id may still have a chat_history document."""
+        return not self.empty and self.migrated_users.get(user_id) is MISSING
+
+    def mark_migrated(self, user_id):
+        self.migrated_users.set(user_id, True)
+
+_legacy_layout = LegacyLayout()
+
+def get_legacy_layout():
+    return _legacy_layout
+
+_message_writer = None
+
+def get_message_writer(db):
+    """Return the process-wide MessageWriter, creating it on first use."""
+    global _message_writer
+    with _client_lock:
+        if _message_writer is None:
+            _message_writer = MessageWriter(db['chats'], db['messages'])
+            atexit.register(_message_writer.flush)
+        return _message_writer
+
+def _forget_parent_client():
+    """Drop the client and writer a forked worker inherited; it creates its own on first use."""
+    global _client, _client_lock, _message_writer, _pool_stats, _legacy_layout
+    _client_lock = threading.Lock()
+    _client = None
+    _message_writer = None
+    _legacy_layout = LegacyLayout()
+    _pool_stats = {'sync': PoolStatsListener()}
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_parent_client)
+
+# Latency of each public method is exported at /metrics
+@timed_methods(MONGO_OPERATION_SECONDS, exclude=('close_connection', 'iter_recent_messages'))
 class DatabaseManager:
     def __init__(self):
         """Initialize the database manager with MongoDB connection."""
-        mongo_uri = os.getenv('MONGO_URI', 'mongodb://localhost:27017/')
-        self.client = MongoClient(mongo_uri)
+        self.client = get_mongo_client()
         self.db = self.client['ai_chat_app']
-        self.chat_collection = self.db['chat_history']
+        self.chat_collection = self.db['chat_history']  # legacy one-document-per-user layout
+        self.chats_collection = self.db['chats']
+        self.messages_collection = self.db['messages']
+        self.deleted_chats_collection = self.db['deleted_chats']
+        self.archive_collection = self.db['chat_archive']  # compressed messages of idle chats
+        self.archive_search_collection = self.db['chat_archive_search']  # text of archived messages, for search
         self.profile_collection = self.db['profiles']
         self.prompt_collection = self.db['prompts']
+        self.ensure_indexes()
+    
+    @property
+    def message_writer(self):
+        return get_message_writer(self.db)
     
     def close_connection(self):
-        """Close the MongoDB connection."""
-        self.client.close()
+        """Close the MongoDB connection shared by all managers."""
+        close_mongo_client()
     
+    def ensure_indexes(self):
+        """Create the indexes used by the chats/messages layout."""
+        self.chats_collection.create_index([('user_id', ASCENDING), ('updated_at', DESCENDING)])
+        # Finds chats that are not archived yet and idle, oldest first
+        self.chats_collection.create_index([('archived_at', ASCENDING), ('updated_at', ASCENDING)])
+        self.messages_collection.create_index([('chat_id', ASCENDING), ('seq', ASCENDING)], unique=True)
+        # Text search is scoped to one user by the equality prefix on user_id
+        self.messages_collection.create_index([('user_id', ASCENDING), ('content', TEXT)], name='user_content_text')
+        self.archive_search_collection.create_index([('user_id', ASCENDING), ('content', TEXT)], name='user_content_text')
+        self.archive_search_collection.create_index('chat_id')
+        self.deleted_chats_collection.create_index([('user_id', ASCENDING), ('deleted_at', ASCENDING)])
+        self.deleted_chats_collection.create_index('expires', expireAfterSeconds=0)
+
+    # Legacy Layout Migration
+    def migrate_legacy_user(self, user_id, legacy_doc=None, keep_legacy=False):
+        """Copy a user's chat_history document into the chats/messages collections.
+
+        The copy is idempotent (chats and messages are upserted on their keys),
+        so it is safe to run while the app is serving traffic.
+        """
+        if legacy_doc is None:
+            legacy_doc = self.chat_collection.find_one({'_id': user_id})
+        if not legacy_doc:
+            get_legacy_layout().mark_migrated(user_id)
+            return 0
+
+        migrated = 0
+        for chat_id, chat_data in legacy_doc.items():
+            if chat_id == '_id' or not isinstance(chat_data, dict):
+                continue
+            messages = chat_data.get('messages', [])
+            self.chats_collection.update_one(
+                {'_id': chat_id},
+                {
+                    '$setOnInsert': {
+                        'user_id': user_id,
+                        'title': chat_data.get('title', 'New Chat'),
+                        'created_at': chat_data.get('created_at', datetime.now().isoformat()),
+                        'updated_at': chat_data.get('updated_at', datetime.now().isoformat()),
+                        'message_count': len(messages),
+                        'last_message': messages[-1].get('content', '')[:SNIPPET_LENGTH] if messages else '',
+                        'recent': [
+                            {'role': message.get('role'), 'content': message.get('content', '')}
+                            for message in messages[-RECENT_MESSAGES:]
+                        ]
+                    }
+                },
+                upsert=True
+            )
+            operations = [
+                UpdateOne(
+                    {'chat_id': chat_id, 'seq': seq},
+                    {'$setOnInsert': {'user_id': user_id, **message}},
+                    upsert=True
+                )
+                for seq, message in enumerate(messages, start=1)
+            ]
+            if operations:
+                self.messages_collection.bulk_write(operations, ordered=False)
+            migrated += 1
+
+        if not keep_legacy:
+            self.chat_collection.delete_one({'_id': user_id})
+        get_legacy_layout().mark_migrated(user_id)
+        return migrated
+
+    def _ensure_migrated(self, user_id):
+        """Lazily move a user off the legacy layout the first time they are seen."""
+        legacy = get_legacy_layout()
+        if legacy.check_due():
+            legacy.record_check(self.chat_collection.find_one({}, {'_id': 1}) is None)
+        if legacy.needs_migration(user_id):
+            self.migrate_legacy_user(user_id)
+
     # Chat History Methods
     def get_user_chats(self, user_id):
         """Get all chats for a user."""
-        user_doc = self.chat_collection.find_one({'_id': user_id})
-        if user_doc:
-            # Remove the _id field and return the rest
-            user_doc.pop('_id', None)
-            return user_doc
-        return {}
+        self._ensure_migrated(user_id)
+        chats = {}
+        for chat in self.chats_collection.find(
+            {'user_id': user_id},
+            {'recent': 0, 'summary': 0}
+        ).sort('updated_at', DESCENDING):
+            chat_id = chat.pop('_id')
+            chats[chat_id] = {
+                'title': chat.get('title'),
+                'created_at': chat.get('created_at'),
+                'updated_at': chat.get('updated_at'),
+                'messages': []
+            }
+            # Archived messages stay compressed until the chat is opened
+            if chat.get('archived_at'):
+                chats[chat_id]['archived'] = True
+        hot_chat_ids = [chat_id for chat_id, chat in chats.items() if not chat.get('archived')]
+        if hot_chat_ids:
+            for message in self.messages_collection.find(
+                {'chat_id': {'$in': hot_chat_ids}},
+                {**MESSAGE_PROJECTION, 'chat_id': 1}
+            ).sort([('chat_id', ASCENDING), ('seq', ASCENDING)]):
+                chats[message.pop('chat_id')]['messages'].append(message)
+        return chats
     
     def create_chat(self, user_id, title="New Chat"):
         """Create a new chat for a user."""
+        self._ensure_migrated(user_id)
         chat_id = str(uuid.uuid4())
-        chat_data = {
-            "title": title,
-            "created_at": datetime.now().isoformat(),
-            "updated_at": datetime.now().isoformat(),
-            "messages": []
-        }
-        
-        # Update the user document or create if it doesn't exist
-        self.chat_collection.update_one(
-            {'_id': user_id},
-            {
-                '$set': {f'{chat_id}': chat_data},
-                '$setOnInsert': {'_id': user_id}
-            },
-            upsert=True
-        )
+        now = datetime.now().isoformat()
+        self.chats_collection.insert_one({
+            '_id': chat_id,
+            'user_id': user_id,
+            'title': title,
+            'created_at': now,
+            'updated_at': now,
+            'message_count': 0,
+            'last_message': '',
+            'recent': []
+        })
         
         return chat_id
     
-    def add_message(self, user_id, chat_id, role, content):
+    def add_message(self, user_id, chat_id, role, content, tokens=None):
         """Add a message to a chat."""
-        message = {
+        self._ensure_migrated(user_id)
+        now = datetime.now().isoformat()
+        chat = self.chats_collection.find_one_and_update(
+            {'_id': chat_id, 'user_id': user_id},
+            chat_append_update(role, content, tokens, now),
+            projection={'message_count': 1, 'archived_at': 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if not chat:
+            return None
+        if chat.get('archived_at'):
+            self.rehydrate_chat(user_id, chat_id)
+
+        self.messages_collection.insert_one(
+            message_document(user_id, chat_id, chat['message_count'], role, content, now, tokens)
+        )
+        
+        return {
             "role": role,
             "content": content,
-            "timestamp": datetime.now().isoformat()
+            "timestamp": now
         }
+    
+    def begin_reply(self, user_id, chat_id, stream_id, content, tokens=None):
+        """Store the first checkpoint of an assistant reply that is still being generated.
         
-        result = self.chat_collection.update_one(
-            {'_id': user_id},
-            {
-                '$push': {f'{chat_id}.messages': message},
-                '$set': {f'{chat_id}.updated_at': datetime.now().isoformat()}
-            }
+        The message is marked partial and tagged with stream_id, so later
+        checkpoints can update it in place with update_reply.
+        
+        Returns:
+            int: seq of the stored message, or None if the chat does not exist
+        """
+        now = datetime.now().isoformat()
+        update = chat_append_update("assistant", content, tokens, now)
+        update['$push']['recent']['$each'][0]['stream_id'] = stream_id
+        chat = self.chats_collection.find_one_and_update(
+            {'_id': chat_id, 'user_id': user_id},
+            update,
+            projection={'message_count': 1},
+            return_document=ReturnDocument.AFTER
         )
+        if not chat:
+            return None
         
-        return message if result.modified_count > 0 else None
+        document = message_document(user_id, chat_id, chat['message_count'], "assistant", content, now, tokens)
+        document.update({'stream_id': stream_id, 'partial': True})
+        self.messages_collection.insert_one(document)
+        return chat['message_count']
+    
+    def update_reply(self, user_id, chat_id, seq, stream_id, content, tokens=None, final=False):
+        """Replace the content of a reply stored by begin_reply; final clears its partial flag."""
+        message_update = {'$set': {'content': content, 'tokens': tokens}}
+        if final:
+            message_update['$unset'] = {'partial': ""}
+        self.messages_collection.update_one({'chat_id': chat_id, 'seq': seq}, message_update)
+        self.chats_collection.update_one(
+            {'_id': chat_id, 'user_id': user_id, 'recent.stream_id': stream_id},
+            {'$set': {
+                'recent.$.content': content,
+                'recent.$.tokens': tokens,
+                'last_message': content[:SNIPPET_LENGTH],
+                # The snippet changed, so delta syncs must pick the chat up again
+                'updated_at': datetime.now().isoformat()
+            }}
+        )
+    
+    def append_message_with_context(self, user_id, chat_id, role, content, tokens=None, title="New Chat"):
+        """Add a message and read back what is needed to build the context, in one round-trip.
+        
+        A single find_one_and_update on the chat document records the message
+        (creating the chat when chat_id is None) and returns its message count,
+        cached recent messages and summary. The message document itself is
+        inserted by the background MessageWriter.
+        
+        Returns:
+            tuple: (chat_id, chat) where chat is None if the chat does not exist
+        
+        Raises:
+            PendingWritesError: if the chat's queued messages were not written in time
+        """
+        self._ensure_migrated(user_id)
+        # A reply to the previous turn may still be queued; it must get the earlier seq
+        if chat_id is not None and self.message_writer.has_pending(chat_id):
+            if not self.message_writer.wait_for_chat(chat_id):
+                logger.log_backend("warning", f"Turn rejected, earlier messages of chat {chat_id} still unwritten")
+                raise PendingWritesError()
+        now = datetime.now().isoformat()
+        update = chat_append_update(role, content, tokens, now)
+        create = chat_id is None
+        if create:
+            chat_id = str(uuid.uuid4())
+            update['$setOnInsert'] = {'title': title, 'created_at': now}
+        
+        chat = self.chats_collection.find_one_and_update(
+            {'_id': chat_id, 'user_id': user_id},
+            update,
+            projection=CHAT_CONTEXT_PROJECTION,
+            upsert=create,
+            return_document=ReturnDocument.AFTER
+        )
+        if not chat:
+            return chat_id, None
+        if chat.get('archived_at') and self.rehydrate_chat(user_id, chat_id):
+            chat = self.chats_collection.find_one({'_id': chat_id}, CHAT_CONTEXT_PROJECTION)
+        
+        self.message_writer.submit_message(
+            message_document(user_id, chat_id, chat['message_count'], role, content, now, tokens)
+        )
+        return chat_id, chat
     
     def get_chat_messages(self, user_id, chat_id):
         """Get messages for a specific chat."""
-        user_doc = self.chat_collection.find_one({'_id': user_id})
-        if user_doc and chat_id in user_doc:
-            return user_doc[chat_id].get('messages', [])
-        return []
+        self._ensure_migrated(user_id)
+        query = {'chat_id': chat_id, 'user_id': user_id}
+        messages = list(self.messages_collection.find(query, MESSAGE_PROJECTION).sort('seq', ASCENDING))
+        # An archived chat has no stored messages until it is rehydrated
+        if not messages and self.rehydrate_chat(user_id, chat_id):
+            messages = list(self.messages_collection.find(query, MESSAGE_PROJECTION).sort('seq', ASCENDING))
+        return messages
     
-    def delete_chat(self, user_id, chat_id):
-        """Delete a specific chat."""
-        result = self.chat_collection.update_one(
-            {'_id': user_id},
-            {'$unset': {chat_id: ""}}
+    def get_chat_messages_page(self, user_id, chat_id, before=None, limit=50):
+        """Get one window of messages older than the `before` cursor.
+
+        Only the requested window is read, newest first on the (chat_id, seq)
+        index, and returned in chronological order together with the cursor
+        for the next older page (None when the start of the chat is reached).
+        """
+        self._ensure_migrated(user_id)
+        query = {'chat_id': chat_id, 'user_id': user_id}
+        if before is not None:
+            query['seq'] = {'$lt': before}
+
+        def read_window():
+            return list(self.messages_collection.find(
+                query,
+                {**MESSAGE_PROJECTION, 'seq': 1}
+            ).sort('seq', DESCENDING).limit(limit + 1))
+
+        messages = read_window()
+        # Opening an archived chat moves its messages back first
+        if not messages and self.rehydrate_chat(user_id, chat_id):
+            messages = read_window()
+
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        messages.reverse()
+        return {
+            'messages': messages,
+            'next_cursor': messages[0]['seq'] if has_more else None
+        }
+    
+    def search_messages(self, user_id, query, offset=0, limit=20):
+        """Find a user's messages matching a text query, best matches first.
+        
+        Uses the (user_id, content) text indexes of the messages and
+        chat_archive_search collections, so the cost depends on the matching
+        messages rather than the size of the user's history. Returns
+        hits with chat_id, chat title, seq and a snippet around the match,
+        and the offset of the next page (None on the last page).
+        """
+        self._ensure_migrated(user_id)
+        offset = max(0, min(offset, SEARCH_MAX_OFFSET))
+        # Archived chats are searched through their copy in chat_archive_search
+        matches = {}
+        for collection in (self.messages_collection, self.archive_search_collection):
+            cursor = collection.find(
+                {'user_id': user_id, '$text': {'$search': query}},
+                {'_id': 0, 'chat_id': 1, 'seq': 1, 'role': 1, 'content': 1, 'timestamp': 1, 'score': {'$meta': 'textScore'}}
+            ).sort([('score', {'$meta': 'textScore'})]).limit(offset + limit + 1)
+            for hit in cursor:
+                # A chat being archived or rehydrated can briefly be in both
+                matches.setdefault((hit['chat_id'], hit['seq']), hit)
+        hits = sorted(matches.values(), key=lambda hit: hit['score'], reverse=True)[offset:offset + limit + 1]
+        has_more = len(hits) > limit
+        hits = hits[:limit]
+        
+        titles = {
+            chat['_id']: chat.get('title', 'New Chat') for chat in self.chats_collection.find(
+                {'_id': {'$in': list({hit['chat_id'] for hit in hits})}, 'user_id': user_id},
+                {'title': 1}
+            )
+        }
+        terms = [term.strip('"').lower() for term in query.split() if not term.startswith('-')]
+        results = []
+        for hit in hits:
+            content = hit.pop('content', '')
+            hit['title'] = titles.get(hit['chat_id'], 'New Chat')
+            hit['snippet'] = search_snippet(content, [term for term in terms if term])
+            hit['score'] = round(hit['score'], 3)
+            results.append(hit)
+        return {
+            'results': results,
+            'next_offset': offset + limit if has_more else None
+        }
+    
+    def iter_recent_messages(self, user_id, chat_id, before=None, batch_size=50):
+        """Iterate over a chat's messages newest first, with seq and cached token counts.
+        
+        The query is only sent once iteration starts.
+        """
+        self._ensure_migrated(user_id)
+        query = {'chat_id': chat_id, 'user_id': user_id}
+        if before is not None:
+            query['seq'] = {'$lt': before}
+        return self.messages_collection.find(
+            query,
+            {**MESSAGE_PROJECTION, 'seq': 1, 'tokens': 1}
+        ).sort('seq', DESCENDING).batch_size(batch_size)
+    
+    def get_messages_range(self, user_id, chat_id, after_seq, through_seq):
+        """Get the messages with after_seq < seq <= through_seq in chronological order."""
+        cursor = self.messages_collection.find(
+            {'chat_id': chat_id, 'user_id': user_id, 'seq': {'$gt': after_seq, '$lte': through_seq}},
+            MESSAGE_PROJECTION
+        ).sort('seq', ASCENDING)
+        return list(cursor)
+    
+    def set_message_tokens(self, chat_id, tokens_by_seq):
+        """Cache token counts on stored messages."""
+        operations = [
+            UpdateOne({'chat_id': chat_id, 'seq': seq}, {'$set': {'tokens': tokens}})
+            for seq, tokens in tokens_by_seq.items()
+        ]
+        if operations:
+            self.messages_collection.bulk_write(operations, ordered=False)
+    
+    def set_context_start(self, user_id, chat_id, seq):
+        """Record the seq of the first message sent with the chat's turns (None for the first message)."""
+        update = {'$set': {'context_start': seq}} if seq is not None else {'$unset': {'context_start': ""}}
+        self.chats_collection.update_one({'_id': chat_id, 'user_id': user_id}, update)
+    
+    def update_chat_summary(self, user_id, chat_id, summary, through_seq):
+        """Store a rolling summary unless a newer one has already been stored."""
+        result = self.chats_collection.update_one(
+            {
+                '_id': chat_id,
+                'user_id': user_id,
+                '$or': [
+                    {'summarized_through': {'$exists': False}},
+                    {'summarized_through': {'$lt': through_seq}}
+                ]
+            },
+            {'$set': {'summary': summary, 'summarized_through': through_seq}}
         )
         return result.modified_count > 0
     
+    def get_chat_summaries(self, user_id, since=None):
+        """Get the sidebar summaries of a user's chats, newest first.
+        
+        With `since` (a timestamp returned by a previous call), only chats
+        changed and ids of chats deleted after it are returned.
+        """
+        self._ensure_migrated(user_id)
+        synced_at = (datetime.now() - SYNC_OVERLAP).isoformat()
+        query = {'user_id': user_id}
+        if since:
+            query['updated_at'] = {'$gt': since}
+        
+        chats = []
+        for chat in self.chats_collection.find(query, SUMMARY_PROJECTION).sort('updated_at', DESCENDING):
+            chat['chat_id'] = chat.pop('_id')
+            chats.append(chat)
+        
+        deleted = []
+        if since:
+            deleted = [
+                tombstone['chat_id'] for tombstone in self.deleted_chats_collection.find(
+                    {'user_id': user_id, 'deleted_at': {'$gt': since}},
+                    {'_id': 0, 'chat_id': 1}
+                )
+            ]
+        return {'chats': chats, 'deleted': deleted, 'synced_at': synced_at}
+    
+    def _record_deleted_chats(self, user_id, chat_ids):
+        """Keep tombstones so delta syncs can report deleted chats."""
+        if not chat_ids:
+            return
+        now = datetime.now()
+        self.deleted_chats_collection.insert_many([
+            {
+                'chat_id': chat_id,
+                'user_id': user_id,
+                'deleted_at': now.isoformat(),
+                'expires': now + TOMBSTONE_RETENTION
+            }
+            for chat_id in chat_ids
+        ])
+    
+    def delete_chat(self, user_id, chat_id):
+        """Delete a specific chat."""
+        self._ensure_migrated(user_id)
+        result = self.chats_collection.delete_one({'_id': chat_id, 'user_id': user_id})
+        if result.deleted_count > 0:
+            self.messages_collection.delete_many({'chat_id': chat_id})
+            self.archive_collection.delete_one({'_id': chat_id})
+            self.archive_search_collection.delete_many({'chat_id': chat_id})
+            self._record_deleted_chats(user_id, [chat_id])
+            return True
+        return False
+    
     def delete_all_chats(self, user_id):
         """Delete all chats for a user."""
-        result = self.chat_collection.update_one(
-            {'_id': user_id},
-            {'$set': {}}
-        )
-        return result.modified_count > 0
+        self._ensure_migrated(user_id)
+        chat_ids = [chat['_id'] for chat in self.chats_collection.find({'user_id': user_id}, {'_id': 1})]
+        result = self.chats_collection.delete_many({'user_id': user_id})
+        self.messages_collection.delete_many({'user_id': user_id})
+        self.archive_collection.delete_many({'user_id': user_id})
+        self.archive_search_collection.delete_many({'user_id': user_id})
+        self._record_deleted_chats(user_id, chat_ids)
+        return result.deleted_count > 0
     
     def update_chat_title(self, user_id, chat_id, new_title):
         """Update the title of a chat."""
         if not new_title or not new_title.strip():
             return False
             
-        result = self.chat_collection.update_one(
-            {'_id': user_id},
+        self._ensure_migrated(user_id)
+        result = self.chats_collection.update_one(
+            {'_id': chat_id, 'user_id': user_id},
             {
                 '$set': {
-                    f'{chat_id}.title': new_title.strip(),
-                    f'{chat_id}.updated_at': datetime.now().isoformat()
+                    'title': new_title.strip(),
+                    'updated_at': datetime.now().isoformat()
                 }
             }
         )
         
         return result.modified_count > 0
     
+    # Archive Methods
+    def archive_idle_chats(self, idle_before, limit=200):
+        """Archive up to `limit` chats neither updated nor opened since idle_before.
+        
+        Returns:
+            int: number of chats archived
+        """
+        archived = 0
+        candidates = self.chats_collection.find(
+            {
+                'archived_at': {'$exists': False},
+                'updated_at': {'$lt': idle_before},
+                'rehydrated_at': {'$not': {'$gte': idle_before}}
+            },
+            {'user_id': 1, 'updated_at': 1, 'rehydrated_at': 1}
+        ).sort('updated_at', ASCENDING).limit(limit)
+        for chat in list(candidates):
+            if self.archive_chat(chat['user_id'], chat['_id'], chat['updated_at'], chat.get('rehydrated_at')):
+                archived += 1
+        return archived
+    
+    def archive_chat(self, user_id, chat_id, updated_at, rehydrated_at=None):
+        """Move a chat's messages into a compressed blob in chat_archive.
+        
+        The chat is only marked archived if it was not written to or opened
+        since it was selected, so a request that races the archiver wins and
+        the archive is discarded.
+        
+        Returns:
+            bool: True if the chat was archived
+        """
+        if self.message_writer.has_pending(chat_id):
+            return False
+        messages = list(self.messages_collection.find({'chat_id': chat_id}, ARCHIVE_PROJECTION).sort('seq', ASCENDING))
+        through_seq = messages[-1]['seq'] if messages else 0
+        codec, blob = compress_messages(messages)
+        now = datetime.now().isoformat()
+        try:
+            self.archive_collection.insert_one({
+                '_id': chat_id,
+                'user_id': user_id,
+                'codec': codec,
+                'messages': blob,
+                'message_count': len(messages),
+                'through_seq': through_seq,
+                'archived_at': now
+            })
+        except DuplicateKeyError:
+            # Another archiver got there first
+            return False
+        if messages:
+            self.archive_search_collection.insert_many(
+                [archive_search_entry(user_id, chat_id, message) for message in messages], ordered=False
+            )
+        result = self.chats_collection.update_one(
+            {
+                '_id': chat_id,
+                'updated_at': updated_at,
+                'rehydrated_at': rehydrated_at,
+                'archived_at': {'$exists': False}
+            },
+            {'$set': {'archived_at': now}, '$unset': {'recent': ""}}
+        )
+        if not result.modified_count:
+            self.archive_search_collection.delete_many({'chat_id': chat_id})
+            self.archive_collection.delete_one({'_id': chat_id, 'archived_at': now})
+            return False
+        
+        self.messages_collection.delete_many({'chat_id': chat_id, 'seq': {'$lte': through_seq}})
+        # A reader may have rehydrated the chat before the messages were deleted
+        if not self.chats_collection.find_one({'_id': chat_id, 'archived_at': now}, {'_id': 1}):
+            self._restore_messages(user_id, chat_id, messages)
+        CHAT_ARCHIVE_OPERATIONS.inc('archived')
+        return True
+    
+    def rehydrate_chat(self, user_id, chat_id):
+        """Move an archived chat's messages back into the messages collection.
+        
+        Safe to call concurrently: messages are upserted on (chat_id, seq) and
+        the archive is only removed after the chat is marked hot again.
+        
+        Returns:
+            bool: True if the chat had an archive
+        """
+        archive = self.archive_collection.find_one({'_id': chat_id, 'user_id': user_id})
+        if not archive:
+            return False
+        messages = decompress_messages(archive['codec'], archive['messages'])
+        self._restore_messages(user_id, chat_id, messages)
+        # Messages added since archiving are already cached; the archived tail goes in front
+        result = self.chats_collection.update_one(
+            {'_id': chat_id, 'user_id': user_id, 'archived_at': {'$exists': True}},
+            {
+                '$set': {'rehydrated_at': datetime.now().isoformat()},
+                '$unset': {'archived_at': ""},
+                '$push': {'recent': {
+                    '$each': [recent_entry(message) for message in messages[-RECENT_MESSAGES:]],
+                    '$position': 0,
+                    '$slice': -RECENT_MESSAGES
+                }}
+            }
+        )
+        if not result.matched_count:
+            # An archiver has not marked the chat yet; it keeps or discards the archive itself
+            return True
+        self.archive_collection.delete_one({'_id': chat_id})
+        self.archive_search_collection.delete_many({'chat_id': chat_id})
+        CHAT_ARCHIVE_OPERATIONS.inc('rehydrated')
+        return True
+    
+    def _restore_messages(self, user_id, chat_id, messages):
+        operations = [
+            UpdateOne(
+                {'chat_id': chat_id, 'seq': message['seq']},
+                {'$setOnInsert': {'user_id': user_id, **{key: value for key, value in message.items() if key != 'seq'}}},
+                upsert=True
+            )
+            for message in messages
+        ]
+        if operations:
+            self.messages_collection.bulk_write(operations, ordered=False)
+    
     # Profile Methods
     def get_profile(self, user_id):
         """Get user profile."""
@@ -0,0 +1,62 @@
+"""gunicorn settings for production.
+
+Run from the backend directory with:
+    gunicorn -c gunicorn.conf.py "app:create_app()"
+
+Starts a single worker process serving requests on WEB_THREADS threads.
+Every open reply stream holds a thread for as long as the client reads it,
+so WEB_THREADS is also the number of streams that can be served at once.
+
+There is one worker by design: reply streams and their cancellation, the
+Ollama admission queue and the prompt catalog snapshot live in the worker
+process, and requests for a chat must reach the process that holds them.
+A chat spends its time waiting on Ollama and MongoDB, which threads handle.
+
+On SIGTERM (docker stop, or gunicorn reloading with SIGHUP) the worker stops
+accepting connections, lets the replies being generated finish for up to
+GRACEFUL_TIMEOUT seconds less DRAIN_MARGIN, then cancels the rest, keeping
+the part generated so far, and flushes its pending writes.
+"""
+import os
+import signal
+import threading
+
+bind = os.getenv('BIND', '0.0.0.0:5000')
+workers = 1
+worker_class = 'gthread'
+threads = int(os.getenv('WEB_THREADS', '64'))
+# Load the app once in the master and fork it; nothing in it holds connections
+# until a worker creates its managers (see app.create_app)
+preload_app = True
+graceful_timeout = int(os.getenv('GRACEFUL_TIMEOUT', '30'))
+# Seconds left after draining to save the cancelled replies and flush writes
+DRAIN_MARGIN = 5
+keepalive = int(os.getenv('KEEPALIVE', '5'))
+accesslog = '-' if os.getenv('ACCESS_LOG', 'false').lower() in ('1', 'true', 'yes') else None
+
+def post_worker_init(worker):
+    from app import shutdown, start_worker
+    start_worker()
+    handle_exit = worker.handle_exit
+
+    def drain_and_exit(sig, frame):
+        # gunicorn waits graceful_timeout for open connections; drain the
+        # reply streams meanwhile so they end with the reply saved
+        if getattr(worker, 'drain_thread', None) is None:
+            worker.drain_thread = threading.Thread(
+                target=shutdown, args=(max(graceful_timeout - DRAIN_MARGIN, 0),), daemon=True
+            )
+            worker.drain_thread.start()
+        handle_exit(sig, frame)
+
+    # The worker installed its SIGTERM handler before this hook runs
+    signal.signal(signal.SIGTERM, drain_and_exit)
+
+def worker_exit(server, worker):
+    from app import shutdown
+    drain_thread = getattr(worker, 'drain_thread', None)
+    if drain_thread is None:
+        # Exiting without SIGTERM (e.g. the master died): cancel what is left
+        shutdown(0)
+    else:
+        drain_thread.join(graceful_timeout)
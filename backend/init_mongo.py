@@ -1,26 +1,279 @@
+import argparse
+import gzip
 import json
 import os
-from pymongo import MongoClient
-from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor
+from bson import json_util
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
+from db_manager import DatabaseManager, get_mongo_client, close_mongo_client
 
-# Load environment variables
-load_dotenv()
+DATABASE_NAME = 'ai_chat_app'
+DEFAULT_BATCH_SIZE = 1000
+# Collections exported when none are named
+EXPORT_COLLECTIONS = ('chats', 'messages', 'chat_archive', 'chat_archive_search', 'deleted_chats', 'profiles', 'prompts', 'chat_history')
+DUPLICATE_KEY_ERROR = 11000
+JSON_OPTIONS = json_util.RELAXED_JSON_OPTIONS
+VALUE_DELIMITERS = ' \t\r\n,:]}'
 
-def get_mongo_client():
-    """Create and return a MongoDB client."""
-    mongo_uri = os.getenv('MONGO_URI', 'mongodb://localhost:27017/')
-    client = MongoClient(mongo_uri)
-    return client
+def open_data_file(path, mode='r'):
+    """Open a data file as text, transparently (de)compressing .gz files."""
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+class JsonStreamReader:
+    """Read the members of a top-level JSON array or object one at a time.
+    
+    Only the member being decoded is held in memory, so multi-GB exports
+    load in constant memory (bounded by the largest single member).
+    """
+    
+    def __init__(self, file, chunk_size=1 << 20):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder(object_hook=json_util.object_hook)
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+    
+    def _fill(self, size):
+        chunk = self.file.read(size)
+        if not chunk:
+            self.eof = True
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+    
+    def _peek(self):
+        """Next non-whitespace character, or '' at the end of the file."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer) or self.eof:
+                return self.buffer[self.pos:self.pos + 1]
+            self._fill(self.chunk_size)
+    
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError(f"Expected '{char}' at offset {self.pos} of the buffered input")
+        self.pos += 1
+    
+    def _decode(self):
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A value is complete once a delimiter follows; a number cut off by
+                # the end of the buffer (such as 22.5 of 22.5e3) may continue
+                if self.eof or (end < len(self.buffer) and self.buffer[end] in VALUE_DELIMITERS):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # Read ever larger chunks so a big member is not re-parsed too often
+            self._fill(size)
+            size *= 2
+    
+    def __iter__(self):
+        """Yield (key, value) for object members, or (None, value) for array items."""
+        opening = self._peek()
+        if opening not in ('[', '{'):
+            raise ValueError("Expected a JSON array or object")
+        closing = ']' if opening == '[' else '}'
+        self.pos += 1
+        if self._peek() == closing:
+            return
+        while True:
+            key = None
+            if opening == '{':
+                key = self._decode()
+                self._expect(':')
+                self._peek()
+            yield key, self._decode()
+            if self._peek() == closing:
+                return
+            self._expect(',')
+            self._peek()
+
+def iter_file_documents(path, keyed=False, skip=0, offset=0):
+    """Yield (documents read so far, byte offset or None, document) from an NDJSON or JSON file.
+    
+    NDJSON files (.ndjson/.jsonl) hold one document per line and report the
+    offset after each line, so an interrupted import can seek back to it.
+    JSON files hold an array of documents, or, when keyed, an object mapping
+    each _id to the rest of its document; the first `skip` are re-read and
+    dropped.
+    """
+    name = path[:-3] if path.endswith('.gz') else path
+    if name.endswith(('.ndjson', '.jsonl')):
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rb') as f:
+            f.seek(offset)
+            count = skip
+            for line in f:
+                offset += len(line)
+                if line.strip():
+                    count += 1
+                    yield count, offset, json_util.loads(line, json_options=JSON_OPTIONS)
+        return
+    
+    with open_data_file(path) as f:
+        count = 0
+        for key, value in JsonStreamReader(f):
+            count += 1
+            if count <= skip:
+                continue
+            if key is not None and keyed:
+                value = {'_id': key, **value}
+            yield count, None, value
+
+def write_batch(collection, batch, upsert=False):
+    """Write documents unordered; returns (written, duplicates skipped).
+    
+    Documents whose _id already exists are skipped (or replaced with
+    upsert), which makes re-running an import safe.
+    """
+    if upsert:
+        result = collection.bulk_write(
+            [ReplaceOne({'_id': document['_id']}, document, upsert=True) for document in batch],
+            ordered=False
+        )
+        return result.upserted_count + result.modified_count, 0
+    try:
+        return len(collection.insert_many(batch, ordered=False).inserted_ids), 0
+    except BulkWriteError as e:
+        errors = e.details.get('writeErrors', [])
+        if any(error.get('code') != DUPLICATE_KEY_ERROR for error in errors):
+            raise
+        return e.details.get('nInserted', 0), len(errors)
+
+def load_progress(progress_path):
+    try:
+        with open(progress_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_progress(progress_path, progress):
+    temporary_path = f"{progress_path}.tmp"
+    with open(temporary_path, 'w') as f:
+        json.dump(progress, f)
+    os.replace(temporary_path, progress_path)
+
+def import_file(db, path, collection_name=None, keyed=False, batch_size=DEFAULT_BATCH_SIZE, upsert=False, resume=True):
+    """Stream a data file into a collection in batches; returns the number of documents written.
+    
+    Progress is saved next to the file after every batch, and an interrupted
+    import continues from there.
+    """
+    collection_name = collection_name or os.path.basename(path).split('.')[0]
+    collection = db[collection_name]
+    progress_path = f"{path}.progress"
+    progress = load_progress(progress_path) if resume else None
+    if progress and progress.get('collection') != collection_name:
+        progress = None
+    if progress:
+        print(f"Resuming import of {path} into '{collection_name}' after {progress['documents']} documents")
+    else:
+        progress = {'collection': collection_name, 'documents': 0, 'offset': 0, 'written': 0}
+    documents = iter_file_documents(path, keyed=keyed, skip=progress['documents'], offset=progress['offset'] or 0)
+    
+    skipped = 0
+    batch = []
+    for count, offset, document in documents:
+        batch.append(document)
+        if len(batch) < batch_size:
+            continue
+        written, duplicates = write_batch(collection, batch, upsert)
+        batch = []
+        skipped += duplicates
+        progress.update(documents=count, offset=offset, written=progress['written'] + written)
+        save_progress(progress_path, progress)
+        print(f"'{collection_name}': {count} documents read, {progress['written']} written")
+    if batch:
+        written, duplicates = write_batch(collection, batch, upsert)
+        skipped += duplicates
+        progress['written'] += written
+    if os.path.exists(progress_path):
+        os.remove(progress_path)
+    
+    suffix = f" ({skipped} already present)" if skipped else ""
+    print(f"Imported {progress['written']} documents from {path} into '{collection_name}'{suffix}")
+    return progress['written']
+
+def export_collection(db, collection_name, directory, compress=False, batch_size=DEFAULT_BATCH_SIZE):
+    """Stream a collection to <directory>/<collection>.ndjson[.gz] as extended JSON lines."""
+    path = os.path.join(directory, f"{collection_name}.ndjson" + (".gz" if compress else ""))
+    count = 0
+    with open_data_file(path, 'w') as f:
+        for document in db[collection_name].find({}, batch_size=batch_size).sort('_id', 1):
+            f.write(json_util.dumps(document, json_options=JSON_OPTIONS))
+            f.write('\n')
+            count += 1
+    print(f"Exported {count} documents from '{collection_name}' to {path}")
+    return count
+
+def run_parallel(tasks, workers):
+    """Run (function, args) tasks on a thread pool; re-raises the first failure."""
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(function, *args) for function, args in tasks]
+        return [future.result() for future in futures]
+
+def import_files(paths, collection_name=None, batch_size=DEFAULT_BATCH_SIZE, workers=4, upsert=False, resume=True, drop=False):
+    """Import data files (or every .ndjson/.jsonl/.json file of a directory), one collection per file."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(
+                os.path.join(path, name) for name in sorted(os.listdir(path))
+                if name.split('.', 1)[-1] in ('ndjson', 'jsonl', 'json', 'ndjson.gz', 'jsonl.gz', 'json.gz')
+            )
+        else:
+            files.append(path)
+    db = get_mongo_client()[DATABASE_NAME]
+    if drop:
+        for path in files:
+            db[collection_name or os.path.basename(path).split('.')[0]].drop()
+    try:
+        run_parallel(
+            # Dropped collections start over
+            [(import_file, (db, path, collection_name, False, batch_size, upsert, resume and not drop)) for path in files],
+            workers
+        )
+    finally:
+        close_mongo_client()
+
+def export_collections(directory, collections=None, compress=False, batch_size=DEFAULT_BATCH_SIZE, workers=4):
+    os.makedirs(directory, exist_ok=True)
+    db = get_mongo_client()[DATABASE_NAME]
+    names = collections or [name for name in EXPORT_COLLECTIONS if name in db.list_collection_names()]
+    try:
+        run_parallel([(export_collection, (db, name, directory, compress, batch_size)) for name in names], workers)
+    finally:
+        close_mongo_client()
+
+def seed_chats(path):
+    """Load a chat_history export, mapping each user to their chats, as chats and messages documents."""
+    db_manager = DatabaseManager()
+    users = 0
+    chats = 0
+    for _, _, legacy_doc in iter_file_documents(path, keyed=True):
+        # Nothing is stored in chat_history, so there is no legacy document to remove
+        chats += db_manager.migrate_legacy_user(legacy_doc['_id'], legacy_doc, keep_legacy=True)
+        users += 1
+    print(f"Imported {chats} chats of {users} users from {path} into 'chats' and 'messages'")
+    return chats
 
 def init_mongodb():
     """Initialize MongoDB with data from JSON files."""
     # Connect to MongoDB
     client = get_mongo_client()
-    db = client['ai_chat_app']
+    db = client[DATABASE_NAME]
     
     # Initialize collections
     collections = {
-        'chat_history': '../data/chat_history.json',
+        'chats': '../data/chat_history.json',
         'profiles': '../data/profiles.json',
         'prompts': '../data/prompts.json'
     }
@@ -32,34 +285,30 @@ def init_mongodb():
         if collection.count_documents({}) > 0:
             print(f"Collection '{collection_name}' already has data. Skipping...")
             continue
-            
+        
         # Load data from JSON file if it exists
         if os.path.exists(file_path):
             try:
-                with open(file_path, 'r') as f:
-                    data = json.load(f)
-                
-                # For chat_history and profiles, each key is a document
-                if collection_name in ['chat_history', 'profiles']:
-                    documents = []
-                    for key, value in data.items():
-                        doc = {'_id': key, **value}
-                        documents.append(doc)
-                    
-                    if documents:
-                        collection.insert_many(documents)
-                        print(f"Inserted {len(documents)} documents into '{collection_name}' collection")
-                    else:
+                # The files are streamed so a large export does not have to fit in memory
+                if collection_name == 'chats':
+                    # chat_history.json is in the legacy layout, one object per user
+                    seed_chats(file_path)
+                elif collection_name == 'profiles':
+                    # Each key is a document
+                    written = import_file(db, file_path, collection_name, keyed=True, resume=False)
+                    if not written:
                         # Create empty collection with schema
                         collection.insert_one({'_id': 'placeholder', 'data': {}})
                         collection.delete_one({'_id': 'placeholder'})
                         print(f"Created empty '{collection_name}' collection")
                 else:
                     # For prompts, insert as a single document
+                    with open(file_path, 'r') as f:
+                        data = json.load(f)
                     collection.insert_one({'_id': 'prompts', 'data': data})
                     print(f"Inserted prompts data into '{collection_name}' collection")
-                    
-            except (FileNotFoundError, json.JSONDecodeError) as e:
+            
+            except (FileNotFoundError, ValueError) as e:
                 print(f"Error loading {file_path}: {e}")
                 # Create empty collection
                 collection.insert_one({'_id': 'placeholder', 'data': {}})
@@ -72,7 +321,35 @@ def init_mongodb():
             print(f"Created empty '{collection_name}' collection")
     
     print("MongoDB initialization completed!")
-    client.close()
+    close_mongo_client()
 
 if __name__ == "__main__":
-    init_mongodb()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Initialize, import into or export the ai_chat_app database")
+    subcommands = parser.add_subparsers(dest='command')
+    
+    import_parser = subcommands.add_parser('import', help="Stream NDJSON or JSON files into collections")
+    import_parser.add_argument('paths', nargs='+', help="Files or directories; <collection>.ndjson[.gz] goes into <collection>")
+    import_parser.add_argument('--collection', help="Import every file into this collection")
+    import_parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help="Documents per insert")
+    import_parser.add_argument('--workers', type=int, default=4, help="Files imported in parallel")
+    import_parser.add_argument('--upsert', action='store_true', help="Replace documents that already exist instead of skipping them")
+    import_parser.add_argument('--restart', action='store_true', help="Ignore saved progress and import from the start")
+    import_parser.add_argument('--drop', action='store_true', help="Drop the target collections first")
+    
+    export_parser = subcommands.add_parser('export', help="Stream collections to NDJSON files")
+    export_parser.add_argument('directory', help="Directory for the <collection>.ndjson files")
+    export_parser.add_argument('--collections', nargs='+', help="Collections to export (default: all app collections)")
+    export_parser.add_argument('--gzip', action='store_true', help="Compress the files")
+    export_parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help="Documents fetched per batch")
+    export_parser.add_argument('--workers', type=int, default=4, help="Collections exported in parallel")
+    
+    args = parser.parse_args()
+    if args.command == 'import':
+        import_files(
+            args.paths, args.collection, args.batch_size, args.workers,
+            upsert=args.upsert, resume=not args.restart, drop=args.drop
+        )
+    elif args.command == 'export':
+        export_collections(args.directory, args.collections, args.gzip, args.batch_size, args.workers)
+    else:
+        init_mongodb()
@@ -1,44 +1,147 @@
+import atexit
 import logging
 import os
+import queue
+import random
 from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 import json
 
+CATEGORIES = ('backend', 'frontend', 'chat')
+
+# Attributes every LogRecord has; anything else on a record came from `extra`
+STANDARD_ATTRS = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime', 'taskName'}
+
+class JsonFormatter(logging.Formatter):
+    """One compact JSON object per line, with `extra` fields such as user_id as keys."""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage()
+        }
+        for key, value in record.__dict__.items():
+            if key not in STANDARD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, separators=(',', ':'), default=str)
+
+class SamplingFilter(logging.Filter):
+    """Keep only a fraction of records below WARNING; warnings and errors are always kept."""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or self.rate >= 1 or random.random() < self.rate
+
+class DroppingQueueHandler(QueueHandler):
+    """Hands records to the listener thread; drops them rather than wait if the queue is full."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
 class CustomLogger:
+    """The backend, frontend and chat loggers.
+
+    Logging calls only format the record and put it on a queue; a listener
+    thread writes it to the rotating log files and the console, so log I/O
+    never delays a request. Each category has its own level
+    (LOG_LEVEL_CHAT=WARNING) and sampling rate for records below WARNING
+    (LOG_SAMPLE_CHAT=0.1).
+    """
+
     def __init__(self, log_dir="../logs"):
         self.log_dir = log_dir
         os.makedirs(log_dir, exist_ok=True)
         
         # Define log formats
-        log_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-        date_format = '%Y-%m-%d %H:%M:%S'
-        
-        # Backend logger
-        self.backend_logger = logging.getLogger('backend')
-        self.backend_logger.setLevel(logging.INFO)
-        backend_handler = logging.FileHandler(f'{log_dir}/backend.log')
-        backend_handler.setFormatter(logging.Formatter(log_format, date_format))
-        self.backend_logger.addHandler(backend_handler)
-        
-        # Frontend logger
-        self.frontend_logger = logging.getLogger('frontend')
-        self.frontend_logger.setLevel(logging.INFO)
-        frontend_handler = logging.FileHandler(f'{log_dir}/frontend.log')
-        frontend_handler.setFormatter(logging.Formatter(log_format, date_format))
-        self.frontend_logger.addHandler(frontend_handler)
-        
-        # Chat logger
-        self.chat_logger = logging.getLogger('chat')
-        self.chat_logger.setLevel(logging.INFO)
-        chat_handler = logging.FileHandler(f'{log_dir}/chat.log')
-        chat_handler.setFormatter(logging.Formatter(log_format, date_format))
-        self.chat_logger.addHandler(chat_handler)
+        if os.getenv('LOG_FORMAT', 'json').lower() == 'text':
+            formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s', '%Y-%m-%d %H:%M:%S')
+        else:
+            formatter = JsonFormatter()
+        self.formatter = formatter
+        self.max_bytes = int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+        self.backup_count = int(os.getenv('LOG_BACKUP_COUNT', '5'))
         
         # Console handler for all loggers
         console_handler = logging.StreamHandler()
-        console_handler.setFormatter(logging.Formatter(log_format, date_format))
-        self.backend_logger.addHandler(console_handler)
-        self.frontend_logger.addHandler(console_handler)
-        self.chat_logger.addHandler(console_handler)
+        console_handler.setFormatter(formatter)
+        self.console_handler = console_handler
+        self.handlers = [console_handler] + self._file_handlers()
+        
+        self.queue_size = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+        self.queue_handler = DroppingQueueHandler(None)
+        self._start_listener()
+        atexit.register(self.stop)
+        if hasattr(os, 'register_at_fork'):
+            # The listener thread does not exist in a forked worker; start another
+            os.register_at_fork(after_in_child=self._after_fork)
+        
+        self.backend_logger = self._category_logger('backend')
+        self.frontend_logger = self._category_logger('frontend')
+        self.chat_logger = self._category_logger('chat')
+    
+    def _file_handlers(self, suffix=""):
+        """One rotating file per category; the listener routes records by logger name."""
+        handlers = []
+        for category in CATEGORIES:
+            file_handler = RotatingFileHandler(
+                f'{self.log_dir}/{category}{suffix}.log', maxBytes=self.max_bytes, backupCount=self.backup_count,
+                encoding='utf-8'
+            )
+            file_handler.setFormatter(self.formatter)
+            file_handler.addFilter(logging.Filter(category))
+            handlers.append(file_handler)
+        return handlers
+    
+    def _after_fork(self):
+        # Two processes rotating the same file would lose records, so a forked
+        # worker writes files of its own, named after its pid
+        for handler in self.handlers[1:]:
+            if handler.stream is not None:
+                handler.stream.close()
+                handler.stream = None
+        self.handlers = [self.console_handler] + self._file_handlers(f'.{os.getpid()}')
+        self._start_listener()
+    
+    def _start_listener(self):
+        log_queue = queue.Queue(self.queue_size)
+        self.queue_handler.queue = log_queue
+        self.listener = QueueListener(log_queue, *self.handlers, respect_handler_level=True)
+        self.listener.start()
+    
+    def stop(self):
+        """Write out the queued records and stop the listener thread."""
+        self.listener.stop()
+    
+    def _category_logger(self, category):
+        category_logger = logging.getLogger(category)
+        category_logger.setLevel(os.getenv(f'LOG_LEVEL_{category.upper()}', 'INFO').upper())
+        category_logger.propagate = False
+        category_logger.addHandler(self.queue_handler)
+        rate = float(os.getenv(f'LOG_SAMPLE_{category.upper()}', '1'))
+        if rate < 1:
+            category_logger.addFilter(SamplingFilter(rate))
+        return category_logger
+    
+    @property
+    def dropped(self):
+        """Records dropped because the listener fell behind."""
+        return self.queue_handler.dropped
     
     def log_backend(self, level, message, extra=None):
         log_method = getattr(self.backend_logger, level)
@@ -68,4 +171,4 @@ class CustomLogger:
             log_method(message)
 
 # Create global logger instance
-logger = CustomLogger()
\ No newline at end of file
+logger = CustomLogger(os.getenv('LOG_DIR', '../logs'))
\ No newline at end of file
@@ -0,0 +1,231 @@
+"""In-process metrics exported at /metrics in the Prometheus text format.
+
+Recording a sample takes a lock and a few additions, cheap enough to leave
+on for every request. Values that already live elsewhere (queue depth,
+active streams) are read by collectors only when /metrics is scraped.
+Each worker process keeps its own metrics.
+"""
+import bisect
+import functools
+import inspect
+import threading
+import time
+from logger import logger
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200)
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = ('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in pairs)
+    return "{" + ",".join(escaped) + "}"
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for label_values, value in values.items():
+            yield self.name, _format_labels(self.labels, label_values), value
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [count per bucket (+Inf last), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def samples(self):
+        with self._lock:
+            series = {label_values: (list(counts), total) for label_values, (counts, total) in self._series.items()}
+        for label_values, (counts, total) in series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", _format_labels(self.labels, label_values, ('le', _format_value(float(bound)))), cumulative
+            yield f"{self.name}_sum", _format_labels(self.labels, label_values), total
+            yield f"{self.name}_count", _format_labels(self.labels, label_values), cumulative
+
+class Gauge:
+    """A value read from the application when metrics are scraped.
+
+    The collect function returns a number, or a dict of label values tuples
+    to numbers.
+    """
+    type = "gauge"
+
+    def __init__(self, name, help, collect, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.collect = collect
+
+    def samples(self):
+        values = self.collect()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in values.items():
+            yield self.name, _format_labels(self.labels, label_values), value
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, collect, labels=()):
+        return self.register(Gauge(name, help, collect, labels))
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                samples = list(metric.samples())
+            except Exception as e:
+                logger.log_backend("error", f"Error collecting metric {metric.name}: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in samples:
+                lines.append(f"{name}{labels} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+registry = MetricsRegistry()
+
+OLLAMA_TIME_TO_FIRST_TOKEN = registry.histogram(
+    'ollama_time_to_first_token_seconds', 'Seconds from sending a request to Ollama to its first token.', ('model',)
+)
+OLLAMA_GENERATION_SECONDS = registry.histogram(
+    'ollama_generation_seconds', 'Seconds from sending a request to Ollama to the end of its reply.', ('model',)
+)
+OLLAMA_TOKENS_PER_SECOND = registry.histogram(
+    'ollama_tokens_per_second', 'Tokens per second streamed by Ollama after the first token.', ('model',), RATE_BUCKETS
+)
+OLLAMA_TOKENS = registry.counter('ollama_generated_tokens_total', 'Tokens streamed from Ollama.', ('model',))
+QUEUE_WAIT_SECONDS = registry.histogram('ollama_queue_wait_seconds', 'Seconds a request waited for a slot on a backend.')
+MONGO_OPERATION_SECONDS = registry.histogram(
+    'mongo_operation_seconds', 'Latency of database manager operations.', ('method',)
+)
+CHAT_ARCHIVE_OPERATIONS = registry.counter(
+    'chat_archive_operations_total', 'Chats moved to the archive (archived) and back (rehydrated).', ('operation',)
+)
+REPLY_CANCELLATIONS = registry.counter(
+    'reply_cancellations_total', 'Replies cancelled before completion, by reason.', ('reason',)
+)
+ERRORS = registry.counter('app_errors_total', 'Errors by where they happened and their type.', ('source', 'type'))
+
+def record_error(source, error):
+    """Count an error; error is an exception or a short type name."""
+    ERRORS.inc(source, error if isinstance(error, str) else type(error).__name__)
+
+class GenerationTimer:
+    """Times one streamed generation: time to first token, duration and token rate."""
+    __slots__ = ('model', 'started', 'first_token_at', 'tokens')
+
+    def __init__(self, model):
+        self.model = model
+        self.started = time.monotonic()
+        self.first_token_at = None
+        self.tokens = 0
+
+    def token(self):
+        if self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+            OLLAMA_TIME_TO_FIRST_TOKEN.observe(self.first_token_at - self.started, self.model)
+        self.tokens += 1
+
+    def finish(self):
+        """Record a generation that ran to completion."""
+        now = time.monotonic()
+        OLLAMA_GENERATION_SECONDS.observe(now - self.started, self.model)
+        OLLAMA_TOKENS.inc(self.model, amount=self.tokens)
+        if self.first_token_at is not None and self.tokens > 1 and now > self.first_token_at:
+            OLLAMA_TOKENS_PER_SECOND.observe((self.tokens - 1) / (now - self.first_token_at), self.model)
+
+def timed_methods(histogram, exclude=()):
+    """Class decorator recording the latency of each public method in histogram, labelled by name.
+
+    Exceptions are counted in app_errors_total with source "mongo".
+    """
+    def decorate(cls):
+        for name, method in list(vars(cls).items()):
+            if name.startswith('_') or name in exclude or not inspect.isfunction(method):
+                continue
+            setattr(cls, name, _timed(method, histogram, name))
+        return cls
+    return decorate
+
+def _timed(method, histogram, name):
+    if inspect.iscoroutinefunction(method):
+        @functools.wraps(method)
+        async def timed_async(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                return await method(*args, **kwargs)
+            except Exception as e:
+                record_error('mongo', e)
+                raise
+            finally:
+                histogram.observe(time.monotonic() - started, name)
+        return timed_async
+
+    @functools.wraps(method)
+    def timed(*args, **kwargs):
+        started = time.monotonic()
+        try:
+            return method(*args, **kwargs)
+        except Exception as e:
+            record_error('mongo', e)
+            raise
+        finally:
+            histogram.observe(time.monotonic() - started, name)
+    return timed
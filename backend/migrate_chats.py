@@ -0,0 +1,32 @@
+import argparse
+from db_manager import DatabaseManager
+
+def migrate_chat_history(batch_size=100, keep_legacy=False):
+    """Move every chat_history document into the chats/messages collections.
+
+    The migration is online: each user is copied with idempotent upserts and
+    the app migrates any user it touches before this tool reaches them, so
+    the server can keep running while it executes.
+    """
+    db_manager = DatabaseManager()
+    users = 0
+    chats = 0
+
+    cursor = db_manager.chat_collection.find({}, batch_size=batch_size)
+    for legacy_doc in cursor:
+        user_id = legacy_doc['_id']
+        migrated = db_manager.migrate_legacy_user(user_id, legacy_doc, keep_legacy=keep_legacy)
+        users += 1
+        chats += migrated
+        print(f"Migrated {migrated} chats for user '{user_id}'")
+
+    print(f"Migration completed: {chats} chats from {users} users")
+    db_manager.close_connection()
+    return users, chats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate chat_history into the chats/messages layout")
+    parser.add_argument('--batch-size', type=int, default=100, help="Legacy documents fetched per batch")
+    parser.add_argument('--keep-legacy', action='store_true', help="Do not remove chat_history documents after copying")
+    args = parser.parse_args()
+    migrate_chat_history(batch_size=args.batch_size, keep_legacy=args.keep_legacy)
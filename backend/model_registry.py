@@ -0,0 +1,170 @@
+import json
+import os
+from logger import logger
+from ollama_pool import parse_backend_urls
+
+DEFAULT_MODEL = os.getenv('OLLAMA_MODEL', 'llama3.1:8b')
+# Share of a model's context size used for the chat history when no token budget is set;
+# the rest is left for the system prompt, summary and the reply
+BUDGET_SHARE_OF_CONTEXT = 0.75
+
+def parse_keep_alive(value):
+    """Ollama takes keep_alive as a duration string ("30m") or a number of seconds (-1 keeps the model loaded)."""
+    if value is None or isinstance(value, (int, float)):
+        return value
+    value = str(value).strip()
+    try:
+        return int(value)
+    except ValueError:
+        return value or None
+
+def parse_json_setting(name):
+    """Read an environment variable holding a JSON object; invalid values are ignored."""
+    value = os.getenv(name, '').strip()
+    if not value:
+        return {}
+    try:
+        parsed = json.loads(value)
+    except ValueError as e:
+        logger.log_backend("warning", f"Ignoring invalid {name}: {e}")
+        return {}
+    if not isinstance(parsed, dict):
+        logger.log_backend("warning", f"Ignoring {name}: expected a JSON object")
+        return {}
+    return parsed
+
+def ollama_model_name(name):
+    """Name of a model as Ollama lists it; an untagged name means the latest tag."""
+    return name if ':' in name else f"{name}:latest"
+
+def is_simple_message(message, max_chars):
+    """Whether a message is short, at most two lines and has no code."""
+    text = message.strip()
+    return len(text) <= max_chars and text.count('\n') < 2 and '```' not in text
+
+class ModelConfig:
+    """A model chats can use and how to run it."""
+
+    def __init__(self, name, context_size=None, token_budget=None, backends=None, keep_alive=None, options=None):
+        self.name = name
+        self.context_size = context_size
+        self.token_budget = token_budget
+        if token_budget is None and context_size:
+            self.token_budget = int(context_size * BUDGET_SHARE_OF_CONTEXT)
+        # URLs of the backends serving the model; None means every backend
+        if backends and not isinstance(backends, str):
+            backends = ",".join(backends)
+        self.backends = parse_backend_urls(backends) or None
+        self.keep_alive = parse_keep_alive(keep_alive)
+        self.options = dict(options or {})
+        if context_size:
+            self.options.setdefault('num_ctx', context_size)
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'context_size': self.context_size,
+            'token_budget': self.token_budget,
+            'backends': self.backends
+        }
+
+class ModelRegistry:
+    """The models /api/chat accepts, configured with OLLAMA_MODELS, e.g.
+
+        {"llama3.1:8b": {"context_size": 8192, "keep_alive": "1h"},
+         "llama3.2:1b": {"context_size": 4096, "backends": ["http://gpu-2:11434"]}}
+
+    Each model may set context_size (sent as num_ctx), token_budget (the
+    context window for its chats, 3/4 of context_size by default), backends
+    (the Ollama servers that serve it), keep_alive and options. The default
+    model (OLLAMA_MODEL) is always registered. OLLAMA_KEEP_ALIVE and
+    OLLAMA_OPTIONS apply to every model that does not set its own.
+
+    When OLLAMA_SMALL_MODEL is set, messages that do not ask for a model and
+    are simple (see is_simple_message) go to that model instead of the
+    default one.
+    """
+
+    def __init__(self, models=None, default_model=None, small_model=None, keep_alive=None, options=None):
+        self.default_model = default_model or DEFAULT_MODEL
+        if keep_alive is None:
+            keep_alive = os.getenv('OLLAMA_KEEP_ALIVE', '30m')
+        self.keep_alive = parse_keep_alive(keep_alive)
+        self.options = parse_json_setting('OLLAMA_OPTIONS') if options is None else options
+        if models is None:
+            models = parse_json_setting('OLLAMA_MODELS')
+        self.models = {}
+        for name, settings in models.items():
+            if not isinstance(settings, dict):
+                logger.log_backend("warning", f"Ignoring settings of model {name}: expected a JSON object")
+                continue
+            try:
+                self.models[name] = ModelConfig(
+                    name,
+                    context_size=settings.get('context_size'),
+                    token_budget=settings.get('token_budget'),
+                    backends=settings.get('backends'),
+                    keep_alive=settings.get('keep_alive'),
+                    options=settings.get('options')
+                )
+            except (TypeError, ValueError) as e:
+                logger.log_backend("warning", f"Ignoring settings of model {name}: {e}")
+        if small_model is None:
+            small_model = os.getenv('OLLAMA_SMALL_MODEL') or None
+        self.small_model = small_model
+        self.simple_max_chars = int(os.getenv('OLLAMA_SMALL_MODEL_MAX_CHARS', '160'))
+        for name in (self.default_model, self.small_model):
+            if name and name not in self.models:
+                self.models[name] = ModelConfig(name)
+
+    def __contains__(self, name):
+        return name in self.models
+
+    @property
+    def names(self):
+        return list(self.models)
+
+    def get(self, name):
+        return self.models.get(name)
+
+    def choose(self, message, requested=None):
+        """Model to answer a message: the requested one, else the small model for simple messages."""
+        if requested:
+            return requested
+        if self.small_model and is_simple_message(message, self.simple_max_chars):
+            return self.small_model
+        return self.default_model
+
+    def request_settings(self, name):
+        """keep_alive and options to add to every /api/chat request for a model.
+
+        Chats, summaries and warm-up all send these, because Ollama reloads a
+        model whose load options (such as num_ctx) change.
+        """
+        model = self.models.get(name)
+        settings = {}
+        keep_alive = model.keep_alive if model is not None and model.keep_alive is not None else self.keep_alive
+        if keep_alive is not None:
+            settings['keep_alive'] = keep_alive
+        options = {**self.options, **(model.options if model is not None else {})}
+        if options:
+            settings['options'] = options
+        return settings
+
+    def token_limit(self, name):
+        """The num_predict sent with a model's requests, or None when generation is unlimited."""
+        try:
+            limit = int(self.request_settings(name).get('options', {}).get('num_predict'))
+        except (TypeError, ValueError):
+            return None
+        # Ollama takes -1 (and -2, fill the context) for no fixed limit
+        return limit if limit > 0 else None
+
+    def backends_for(self, name):
+        """URLs of the backends serving a model, or None for all of them."""
+        model = self.models.get(name)
+        return model.backends if model is not None else None
+
+    def token_budgets(self):
+        """Context window budgets of the models that configure one."""
+        return {name: model.token_budget for name, model in self.models.items() if model.token_budget}
@@ -0,0 +1,174 @@
+import os
+import threading
+import time
+import requests
+from cache import TTLCache
+from logger import logger
+from scheduler import FairScheduler, QueueFullError
+
+DEFAULT_OLLAMA_URL = "http://localhost:11434"
+
+def parse_backend_urls(spec):
+    """Parse a comma-separated list of Ollama hosts or URLs into base URLs."""
+    urls = []
+    for entry in (spec or "").split(','):
+        entry = entry.strip().rstrip('/')
+        if not entry:
+            continue
+        if '://' not in entry:
+            entry = f"http://{entry}"
+        if entry not in urls:
+            urls.append(entry)
+    return urls
+
+def configured_backend_urls():
+    """Ollama base URLs from OLLAMA_URLS, OLLAMA_URL or OLLAMA_HOST, in that order."""
+    for name in ('OLLAMA_URLS', 'OLLAMA_URL', 'OLLAMA_HOST'):
+        urls = parse_backend_urls(os.getenv(name))
+        if urls:
+            return urls
+    return [DEFAULT_OLLAMA_URL]
+
+class OllamaBackend:
+    """One Ollama server: its own admission queue, health state and counters."""
+
+    def __init__(self, url, eject_after=2):
+        self.url = url
+        self.scheduler = FairScheduler()
+        self.eject_after = eject_after
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.requests = 0
+        self.failures = 0
+        self.ejections = 0
+        self.last_error = None
+        self.last_checked = None
+        self._lock = threading.Lock()
+
+    @property
+    def outstanding(self):
+        return self.scheduler.outstanding
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            if not self.healthy:
+                self.healthy = True
+                logger.log_backend("info", f"Ollama backend {self.url} reinstated")
+
+    def record_failure(self, error):
+        with self._lock:
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.last_error = str(error)
+            if self.healthy and self.consecutive_failures >= self.eject_after:
+                self.healthy = False
+                self.ejections += 1
+                logger.log_backend("warning", f"Ollama backend {self.url} ejected: {error}")
+
+    def stats(self):
+        return {
+            'url': self.url,
+            'healthy': self.healthy,
+            'requests': self.requests,
+            'failures': self.failures,
+            'ejections': self.ejections,
+            'last_error': self.last_error,
+            'last_checked': self.last_checked,
+            **self.scheduler.stats()
+        }
+
+class OllamaPool:
+    """Routes requests across Ollama backends.
+
+    A chat sticks to the backend that served its previous turn, so the
+    model's KV cache for the conversation stays warm there; other requests
+    go to the healthy backend with the fewest outstanding requests. Backends
+    are ejected after repeated failures and reinstated once a health probe
+    succeeds.
+    """
+
+    def __init__(self, urls=None, health_interval=None):
+        eject_after = int(os.getenv('OLLAMA_EJECT_AFTER', '2'))
+        self.backends = [OllamaBackend(url, eject_after) for url in (urls or configured_backend_urls())]
+        self.sticky_chats = TTLCache(
+            maxsize=int(os.getenv('OLLAMA_STICKY_CHATS', '10000')),
+            ttl=float(os.getenv('OLLAMA_STICKY_TTL', '1800'))
+        )
+        if health_interval is None:
+            health_interval = float(os.getenv('OLLAMA_HEALTH_INTERVAL', '10'))
+        self.health_interval = health_interval
+        self.health_timeout = float(os.getenv('OLLAMA_HEALTH_TIMEOUT', '2'))
+        if self.health_interval > 0:
+            threading.Thread(target=self._probe_periodically, daemon=True).start()
+
+    @property
+    def urls(self):
+        return [backend.url for backend in self.backends]
+
+    def choose(self, chat_id=None, urls=None):
+        """Pick the backend for a request: the chat's previous backend, else the least loaded.
+
+        urls limits the choice to the backends serving the requested model.
+        """
+        backends = [backend for backend in self.backends if backend.url in urls] if urls else self.backends
+        if not backends:
+            backends = self.backends
+        # If every backend is down, keep trying them rather than failing outright
+        candidates = [backend for backend in backends if backend.healthy] or backends
+        if chat_id:
+            url = self.sticky_chats.get(chat_id, None)
+            for backend in candidates:
+                if backend.url == url:
+                    return backend
+        return min(candidates, key=lambda backend: (backend.outstanding, backend.requests))
+
+    def admit(self, user_id, chat_id=None, urls=None):
+        """Queue a request on the chosen backend; the ticket records which one.
+
+        Raises:
+            QueueFullError: If the chosen backend and the least loaded one are both full
+        """
+        backend = self.choose(chat_id, urls)
+        try:
+            ticket = backend.scheduler.enqueue(user_id)
+        except QueueFullError:
+            # The chat's backend is saturated; a cold cache beats waiting
+            fallback = self.choose(urls=urls)
+            if fallback is backend:
+                raise
+            backend = fallback
+            ticket = backend.scheduler.enqueue(user_id)
+        ticket.backend = backend
+        backend.requests += 1
+        if chat_id:
+            self.pin(chat_id, backend)
+        return ticket
+
+    def pin(self, chat_id, backend):
+        """Route later turns of a chat to backend."""
+        self.sticky_chats.set(chat_id, backend.url)
+
+    def release(self, ticket):
+        ticket.backend.scheduler.release(ticket)
+
+    def probe(self, backend):
+        """Check that a backend answers; updates its health state."""
+        backend.last_checked = time.time()
+        try:
+            response = requests.get(f"{backend.url}/api/version", timeout=self.health_timeout)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            backend.record_failure(e)
+            return False
+        backend.record_success()
+        return True
+
+    def _probe_periodically(self):
+        while True:
+            time.sleep(self.health_interval)
+            for backend in self.backends:
+                self.probe(backend)
+
+    def stats(self):
+        return {'backends': [backend.stats() for backend in self.backends]}
@@ -0,0 +1,47 @@
+"""Objects created once per process, for servers that fork worker processes.
+
+A MongoClient, an HTTP session or a background thread created before a fork
+does not work in the forked child. The managers are wrapped in ProcessLocal
+so they are created on first use in each worker rather than at import time,
+which makes it safe to import the app in a pre-fork server's master process
+(gunicorn with preload_app).
+"""
+import os
+import threading
+
+class ProcessLocal:
+    """Create an object with factory() on first use in each process.
+
+    Attribute access is forwarded to the object, so a module-level
+    ProcessLocal stands in for the object it creates.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            # Another thread may have held the lock when the process forked
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._value = None
+
+    @property
+    def created(self):
+        """Whether the object exists in this process."""
+        return self._pid == os.getpid()
+
+    def get(self):
+        """The object of this process, creating it if needed."""
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._value = self._factory()
+                    self._pid = pid
+        return self._value
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
@@ -1,61 +1,114 @@
 import json
 import os
+import threading
+import time
 from datetime import datetime
+from pymongo.errors import OperationFailure, PyMongoError
+from cache import TTLCache, MISSING
 from db_manager import DatabaseManager
+from logger import logger
+
+TONE_INSTRUCTIONS = {
+    'professional': "Respond in a formal, business-like manner with complete sentences and proper grammar.",
+    'friendly': "Respond in a warm, approachable way, as if talking to a friend.",
+    'casual': "Respond in a relaxed, informal way, using casual language and contractions.",
+    'humorous': "Respond with a light-hearted, funny tone, including jokes or witty remarks when appropriate.",
+    'motivational': "Respond in an encouraging, uplifting way, providing positive reinforcement and motivation.",
+    'empathetic': "Respond with understanding and compassion, showing that you care about the user's feelings.",
+    'concise': "Keep responses brief and to the point, avoiding unnecessary details.",
+    'detailed': "Provide thorough, detailed responses with explanations and examples when helpful."
+}
+
+def render_profile_prompt(profile):
+    """Render the system prompt fragment describing a user profile."""
+    if not profile:
+        return ""
+    
+    prompt_parts = []
+    
+    # User information
+    if 'name' in profile:
+        prompt_parts.append(f"The user's name is {profile['name']}.")
+    if 'age' in profile:
+        prompt_parts.append(f"They are {profile['age']} years old.")
+    if 'goals' in profile and profile['goals']:
+        goals = ', '.join(profile['goals']) if isinstance(profile['goals'], list) else profile['goals']
+        prompt_parts.append(f"Their goals include: {goals}.")
+    if 'dietary_preferences' in profile and profile['dietary_preferences']:
+        prompt_parts.append(f"Their dietary preferences: {profile['dietary_preferences']}.")
+    if 'fitness_level' in profile and profile['fitness_level']:
+        prompt_parts.append(f"Their fitness level: {profile['fitness_level']}.")
+    if 'interests' in profile and profile['interests']:
+        interests = ', '.join(profile['interests']) if isinstance(profile['interests'], list) else profile['interests']
+        prompt_parts.append(f"Their interests: {interests}.")
+    
+    # AI Tone Instructions
+    ai_tone = profile.get('ai_tone', 'professional')
+    if ai_tone in TONE_INSTRUCTIONS:
+        prompt_parts.append(TONE_INSTRUCTIONS[ai_tone])
+    
+    return " ".join(prompt_parts)
 
 class ProfileManager:
-    def __init__(self):
+    def __init__(self, cache_size=None, cache_ttl=None, watch_changes=None):
         self.db_manager = DatabaseManager()
+        # Rendered profile prompts by user_id; profiles change rarely
+        self.prompt_cache = TTLCache(
+            maxsize=cache_size or int(os.getenv('PROFILE_CACHE_SIZE', '10000')),
+            ttl=cache_ttl or float(os.getenv('PROFILE_CACHE_TTL', '300'))
+        )
+        if watch_changes is None:
+            watch_changes = os.getenv('PROFILE_CACHE_WATCH', 'true').lower() in ('1', 'true', 'yes')
+        if watch_changes:
+            threading.Thread(target=self._watch_profile_changes, daemon=True).start()
     
     def create_profile(self, user_id, profile_data):
-        return self.db_manager.create_profile(user_id, profile_data)
+        profile = self.db_manager.create_profile(user_id, profile_data)
+        self.prompt_cache.invalidate(user_id)
+        return profile
     
     def get_profile(self, user_id):
         return self.db_manager.get_profile(user_id)
     
     def update_profile(self, user_id, updates):
-        return self.db_manager.update_profile(user_id, updates)
+        profile = self.db_manager.update_profile(user_id, updates)
+        self.prompt_cache.invalidate(user_id)
+        return profile
     
     def delete_profile(self, user_id):
-        return self.db_manager.delete_profile(user_id)
+        deleted = self.db_manager.delete_profile(user_id)
+        self.prompt_cache.invalidate(user_id)
+        return deleted
     
     def get_profile_prompt(self, user_id):
-        profile = self.get_profile(user_id)
-        if not profile:
-            return ""
-        
-        prompt_parts = []
-        
-        # User information
-        if 'name' in profile:
-            prompt_parts.append(f"The user's name is {profile['name']}.")
-        if 'age' in profile:
-            prompt_parts.append(f"They are {profile['age']} years old.")
-        if 'goals' in profile and profile['goals']:
-            goals = ', '.join(profile['goals']) if isinstance(profile['goals'], list) else profile['goals']
-            prompt_parts.append(f"Their goals include: {goals}.")
-        if 'dietary_preferences' in profile and profile['dietary_preferences']:
-            prompt_parts.append(f"Their dietary preferences: {profile['dietary_preferences']}.")
-        if 'fitness_level' in profile and profile['fitness_level']:
-            prompt_parts.append(f"Their fitness level: {profile['fitness_level']}.")
-        if 'interests' in profile and profile['interests']:
-            interests = ', '.join(profile['interests']) if isinstance(profile['interests'], list) else profile['interests']
-            prompt_parts.append(f"Their interests: {interests}.")
-        
-        # AI Tone Instructions
-        tone_instructions = {
-            'professional': "Respond in a formal, business-like manner with complete sentences and proper grammar.",
-            'friendly': "Respond in a warm, approachable way, as if talking to a friend.",
-            'casual': "Respond in a relaxed, informal way, using casual language and contractions.",
-            'humorous': "Respond with a light-hearted, funny tone, including jokes or witty remarks when appropriate.",
-            'motivational': "Respond in an encouraging, uplifting way, providing positive reinforcement and motivation.",
-            'empathetic': "Respond with understanding and compassion, showing that you care about the user's feelings.",
-            'concise': "Keep responses brief and to the point, avoiding unnecessary details.",
-            'detailed': "Provide thorough, detailed responses with explanations and examples when helpful."
-        }
-        
-        ai_tone = profile.get('ai_tone', 'professional')
-        if ai_tone in tone_instructions:
-            prompt_parts.append(tone_instructions[ai_tone])
+        prompt = self.prompt_cache.get(user_id)
+        if prompt is MISSING:
+            # A profile change during the read must not be overwritten by the old prompt
+            generation = self.prompt_cache.generation()
+            prompt = render_profile_prompt(self.get_profile(user_id))
+            self.prompt_cache.set(user_id, prompt, generation)
+        return prompt
+    
+    def _watch_profile_changes(self):
+        """Invalidate cached prompts when any worker changes a profile.
         
-        return " ".join(prompt_parts)
\ No newline at end of file
+        Uses a MongoDB change stream, which needs a replica set (Atlas always
+        has one). Without it, the cache TTL bounds how stale other workers get.
+        """
+        while True:
+            try:
+                with self.db_manager.profile_collection.watch() as stream:
+                    # Changes may have been missed while the stream was down
+                    self.prompt_cache.clear()
+                    for change in stream:
+                        user_id = change.get('documentKey', {}).get('_id')
+                        if user_id is None:
+                            self.prompt_cache.clear()
+                        else:
+                            self.prompt_cache.invalidate(user_id)
+            except OperationFailure as e:
+                logger.log_backend("warning", f"Profile change stream unavailable, relying on cache TTL: {e}")
+                return
+            except PyMongoError as e:
+                logger.log_backend("warning", f"Profile change stream interrupted: {e}")
+                time.sleep(5)
@@ -1,17 +1,71 @@
+import hashlib
 import json
 import os
+import threading
+import time
 from db_manager import DatabaseManager
+from logger import logger
+from response_cache import normalize_text
+
+class PromptCatalog:
+    """Immutable snapshot of the prompt catalog with pre-serialized responses."""
+
+    def __init__(self, prompts):
+        self.prompts = prompts
+        self.categories = list(prompts.keys())
+        self.all_json = json.dumps(prompts, sort_keys=True)
+        self.categories_json = json.dumps(self.categories)
+        self._category_json = {
+            category: json.dumps(items) for category, items in prompts.items()
+        }
+        self._prompt_texts = frozenset(
+            normalize_text(prompt) for items in prompts.values() for prompt in items
+        )
+        # Version hash used as the ETag of every catalog response
+        self.version = hashlib.sha256(self.all_json.encode('utf-8')).hexdigest()[:16]
+
+    def category_json(self, category):
+        return self._category_json.get(category, "[]")
+
+    def contains(self, text):
+        return normalize_text(text) in self._prompt_texts
 
 class PromptManager:
-    def __init__(self):
+    def __init__(self, refresh_interval=None):
         self.db_manager = DatabaseManager()
-        self.prompts = self.load_prompts()
-    
+        if refresh_interval is None:
+            refresh_interval = float(os.getenv('PROMPT_REFRESH_INTERVAL', '0'))
+        self.refresh_interval = refresh_interval
+        self.catalog = PromptCatalog(self.load_prompts())
+        if self.refresh_interval > 0:
+            threading.Thread(target=self._refresh_periodically, daemon=True).start()
+
+    @property
+    def prompts(self):
+        return self.catalog.prompts
+
     def load_prompts(self):
         return self.db_manager.get_prompts()
-    
+
+    def reload(self):
+        """Replace the catalog snapshot with the current database contents."""
+        self.catalog = PromptCatalog(self.load_prompts())
+        return self.catalog.version
+
+    def _refresh_periodically(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.reload()
+            except Exception as e:
+                logger.log_backend("error", f"Error refreshing prompt catalog: {e}")
+
     def get_prompts_by_category(self, category):
-        return self.db_manager.get_prompts_by_category(category)
-    
+        return self.catalog.prompts.get(category, [])
+
     def get_all_categories(self):
-        return self.db_manager.get_all_categories()
+        return self.catalog.categories
+
+    def is_catalog_prompt(self, text):
+        """Whether a message is one of the canned catalog prompts."""
+        return self.catalog.contains(text)
@@ -0,0 +1,346 @@
+import asyncio
+import os
+import threading
+import time
+import uuid
+from logger import logger
+from metrics import REPLY_CANCELLATIONS
+
+# Seconds a new turn waits for the chat's previous reply to stop and be saved
+SUPERSEDE_WAIT = 5
+
+class ReplyInProgressError(Exception):
+    """Raised when the reply being generated for a chat could not be stopped in time for a new turn."""
+
+    def __init__(self):
+        super().__init__("The previous reply is still being saved. Please retry.")
+
+class Cancellation:
+    """Set once to stop a generation; callbacks run when it is set."""
+
+    def __init__(self):
+        self.reason = None
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    @property
+    def is_set(self):
+        return self.reason is not None
+
+    def set(self, reason):
+        """Cancel with the given reason; returns False if already cancelled."""
+        with self._lock:
+            if self.reason is not None:
+                return False
+            self.reason = reason
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.log_backend("error", f"Error in cancellation callback: {e}")
+        return True
+
+    def add_callback(self, callback):
+        """Call callback() on cancellation, right away if already cancelled."""
+        with self._lock:
+            if self.reason is None:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+class ReplyStream:
+    """Buffered events of one assistant reply, readable by any number of clients.
+
+    The reply is generated in the background and every event is kept, so a
+    client that reconnects can continue from the last event it received.
+    Events are numbered from 1; event_id(n) is the SSE id of the n-th event.
+    
+    Once every client has left, the generation is cancelled after
+    disconnect_grace seconds unless one reconnects, so it stops using a
+    model slot; check_abandoned is called as events are generated.
+    """
+
+    def __init__(self, user_id, chat_id, disconnect_grace=0, token_limit=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.token_limit = token_limit  # num_predict of the request, None when unlimited
+        self.generated = 0  # content chunks received from the model, one token each
+        self.events = []
+        self.chars = 0
+        self.finished = False
+        self.finished_at = None
+        self.cancellation = Cancellation()
+        self.disconnect_grace = disconnect_grace
+        self.readers = 0
+        self._abandoned_since = None
+        self._cond = threading.Condition()
+        self._listeners = []
+
+    def cancel(self, reason):
+        """Stop the generation; returns False if it was already cancelled."""
+        return self.cancellation.set(reason)
+
+    def check_abandoned(self):
+        """Cancel if every client left more than disconnect_grace seconds ago; returns whether cancelled."""
+        abandoned_since = self._abandoned_since
+        if abandoned_since is not None and time.monotonic() - abandoned_since >= self.disconnect_grace:
+            self.cancel("disconnect")
+        return self.cancellation.is_set
+
+    def _attach(self):
+        with self._cond:
+            self.readers += 1
+            self._abandoned_since = None
+
+    def _detach(self):
+        with self._cond:
+            self.readers -= 1
+            if self.readers == 0 and not self.finished:
+                self._abandoned_since = time.monotonic()
+            abandoned = self._abandoned_since is not None
+        if abandoned and self.disconnect_grace <= 0:
+            self.cancel("disconnect")
+
+    def count_generated(self, events):
+        """Pass the model's events through, counting the content chunks in generated."""
+        try:
+            for event in events:
+                if event.type == "content":
+                    self.generated += 1
+                yield event
+        finally:
+            if hasattr(events, 'close'):
+                events.close()
+
+    async def acount_generated(self, events):
+        """Async version of count_generated."""
+        try:
+            async for event in events:
+                if event.type == "content":
+                    self.generated += 1
+                yield event
+        finally:
+            await events.aclose()
+
+    def event_id(self, index):
+        return f"{self.id}-{index}"
+
+    def publish(self, event):
+        with self._cond:
+            self.events.append(event)
+            if event.type == "content":
+                self.chars += len(event.content)
+            self._cond.notify_all()
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener()
+
+    def wait_finished(self, timeout=None):
+        """Wait until the reply has ended and been saved; returns False on timeout."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self.finished, timeout)
+
+    def finish(self):
+        with self._cond:
+            self.finished = True
+            self.finished_at = time.monotonic()
+            self._cond.notify_all()
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener()
+
+    def follow(self, after=0):
+        """Yield (event_id, event) for the events after the given index, until the reply ends."""
+        index = after
+        self._attach()
+        try:
+            while True:
+                with self._cond:
+                    while index >= len(self.events) and not self.finished:
+                        self._cond.wait()
+                    batch = self.events[index:]
+                    finished = self.finished
+                for event in batch:
+                    index += 1
+                    yield self.event_id(index), event
+                if finished:
+                    return
+        finally:
+            self._detach()
+
+    async def afollow(self, after=0):
+        """Async version of follow, for readers on an event loop."""
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+        listener = lambda: loop.call_soon_threadsafe(wakeup.set)
+        with self._cond:
+            self._listeners.append(listener)
+        self._attach()
+        try:
+            index = after
+            while True:
+                wakeup.clear()
+                with self._cond:
+                    batch = self.events[index:]
+                    finished = self.finished
+                for event in batch:
+                    index += 1
+                    yield self.event_id(index), event
+                if finished:
+                    return
+                if not batch:
+                    await wakeup.wait()
+        finally:
+            with self._cond:
+                self._listeners.remove(listener)
+            self._detach()
+
+def cancellation_message(stream):
+    """Log line for a cancelled reply: its reason and how much of it was generated."""
+    message = f"Reply for chat {stream.chat_id} cancelled ({stream.cancellation.reason}) after {stream.generated} tokens"
+    if stream.token_limit is not None:
+        message += f" of num_predict {stream.token_limit}"
+    return message
+
+class ReplyStreamRegistry:
+    """The latest reply stream of each chat, kept for a while after it ends for resumes."""
+
+    def __init__(self, retention=None, disconnect_grace=None):
+        self.retention = retention or float(os.getenv('STREAM_RESUME_TTL', '120'))
+        if disconnect_grace is None:
+            disconnect_grace = float(os.getenv('STREAM_DISCONNECT_GRACE', '15'))
+        self.disconnect_grace = disconnect_grace
+        self._streams = {}
+        self._lock = threading.Lock()
+        self.completed = 0
+        self.cancelled = {}  # reason -> count
+        self.tokens_generated_before_cancel = 0
+        # Of the cancelled replies whose request set num_predict: their limits and what was left of them
+        self.cancelled_token_limit = 0
+        self.tokens_left_of_limit = 0
+
+    def start(self, user_id, chat_id, token_limit=None):
+        stream = ReplyStream(user_id, chat_id, self.disconnect_grace, token_limit)
+        with self._lock:
+            self._prune()
+            previous = self._streams.get(chat_id)
+            self._streams[chat_id] = stream
+        # A new turn supersedes a reply still being generated for the chat
+        if previous is not None and not previous.finished:
+            previous.cancel("superseded")
+        return stream
+
+    def supersede(self, user_id, chat_id, timeout=SUPERSEDE_WAIT):
+        """Cancel the reply being generated for a chat and wait until it is saved.
+
+        A new turn calls this before storing its message, so the previous
+        reply keeps its place before it. Returns False if the reply did not
+        end within timeout.
+        """
+        stream = self.get(user_id, chat_id)
+        if stream is None or stream.finished:
+            return True
+        stream.cancel("superseded")
+        return stream.wait_finished(timeout)
+
+    def record_completion(self):
+        with self._lock:
+            self.completed += 1
+
+    def record_cancellation(self, stream):
+        """Count a cancelled reply and the tokens generated for it before the cancel.
+
+        Returns:
+            int: tokens of the request's num_predict that were not generated,
+                or None when the request had no limit
+        """
+        left = None
+        if stream.token_limit is not None:
+            left = max(0, stream.token_limit - stream.generated)
+        with self._lock:
+            reason = stream.cancellation.reason
+            self.cancelled[reason] = self.cancelled.get(reason, 0) + 1
+            self.tokens_generated_before_cancel += stream.generated
+            if left is not None:
+                self.cancelled_token_limit += stream.token_limit
+                self.tokens_left_of_limit += left
+        REPLY_CANCELLATIONS.inc(stream.cancellation.reason)
+        return left
+
+    def stats(self):
+        with self._lock:
+            return {
+                'active': sum(1 for stream in self._streams.values() if not stream.finished),
+                'readers': sum(stream.readers for stream in self._streams.values()),
+                'buffered': len(self._streams),
+                'completed': self.completed,
+                'cancelled': dict(self.cancelled),
+                'tokens_generated_before_cancel': self.tokens_generated_before_cancel,
+                'cancelled_token_limit': self.cancelled_token_limit,
+                'tokens_left_of_limit': self.tokens_left_of_limit
+            }
+
+    def active(self):
+        """The streams whose reply is still being generated."""
+        with self._lock:
+            return [stream for stream in self._streams.values() if not stream.finished]
+
+    def drain(self, timeout, cancel_wait=5):
+        """Wait up to timeout for the replies being generated to finish, then cancel the rest.
+
+        A cancelled reply keeps the part generated so far, and its clients
+        receive the cancelled event and the end of the stream. Returns the
+        number of replies cancelled.
+        """
+        deadline = time.monotonic() + timeout
+        while self.active() and time.monotonic() < deadline:
+            time.sleep(0.1)
+        remaining = self.active()
+        for stream in remaining:
+            stream.cancel("shutdown")
+        # Give the cancelled replies time to be saved
+        deadline = time.monotonic() + cancel_wait
+        while any(not stream.finished for stream in remaining) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return len(remaining)
+
+    def get(self, user_id, chat_id):
+        with self._lock:
+            stream = self._streams.get(chat_id)
+        if stream is None or stream.user_id != user_id:
+            return None
+        return stream
+
+    def resume_point(self, user_id, chat_id, last_event_id):
+        """Find the stream and index a Last-Event-ID refers to.
+
+        Returns:
+            tuple: (stream, index), or (None, 0) if the stream is no longer available
+        """
+        stream = self.get(user_id, chat_id)
+        if stream is None:
+            return None, 0
+        if not last_event_id:
+            # No event was received yet (or the client lost track): start over
+            return stream, 0
+        stream_id, _, index = last_event_id.rpartition('-')
+        if stream_id != stream.id or not index.isdigit():
+            return None, 0
+        return stream, min(int(index), len(stream.events))
+
+    def _prune(self):
+        """Drop finished streams past their retention. Must be called with the lock held."""
+        cutoff = time.monotonic() - self.retention
+        expired = [
+            chat_id for chat_id, stream in self._streams.items()
+            if stream.finished and stream.finished_at < cutoff
+        ]
+        for chat_id in expired:
+            del self._streams[chat_id]
@@ -0,0 +1,73 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from cache import TTLCache, MISSING
+
+def normalize_text(text):
+    """Collapse whitespace so trivially different prompts share a cache entry."""
+    return " ".join((text or "").split())
+
+def replay_chunks(text):
+    """Split a cached response into word-sized chunks, like a live token stream."""
+    return re.findall(r'\s*\S+', text) or [text]
+
+class ResponseCache:
+    """Cache of complete model responses, in memory with an optional SQLite file behind it."""
+
+    def __init__(self, maxsize=None, ttl=None, path=None):
+        self.ttl = ttl or float(os.getenv('RESPONSE_CACHE_TTL', '86400'))
+        self.memory = TTLCache(
+            maxsize=maxsize or int(os.getenv('RESPONSE_CACHE_SIZE', '1000')),
+            ttl=self.ttl
+        )
+        self.path = path or os.getenv('RESPONSE_CACHE_PATH')
+        self._db = None
+        self._db_lock = threading.Lock()
+        if self.path:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT, expires REAL)"
+            )
+            self._db.commit()
+
+    def key(self, model, system_prompt, messages):
+        """Cache key for a request: model, system prompt hash and message list hash."""
+        system_hash = hashlib.sha256(normalize_text(system_prompt).encode('utf-8')).hexdigest()
+        conversation = json.dumps([[m['role'], normalize_text(m['content'])] for m in messages])
+        messages_hash = hashlib.sha256(conversation.encode('utf-8')).hexdigest()
+        return f"{model}:{system_hash}:{messages_hash}"
+
+    def get(self, key):
+        response = self.memory.get(key)
+        if response is not MISSING:
+            return response
+        if self._db is None:
+            return None
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT response FROM responses WHERE key = ? AND expires > ?", (key, time.time())
+            ).fetchone()
+        if row is None:
+            return None
+        self.memory.set(key, row[0])
+        return row[0]
+
+    def set(self, key, response):
+        self.memory.set(key, response)
+        if self._db is None:
+            return
+        now = time.time()
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, response, expires) VALUES (?, ?, ?)",
+                (key, response, now + self.ttl)
+            )
+            self._db.execute("DELETE FROM responses WHERE expires <= ?", (now,))
+            self._db.commit()
+
+    def stats(self):
+        return self.memory.stats()
@@ -0,0 +1,174 @@
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+# How often a waiting request re-checks its queue position
+POSITION_POLL_INTERVAL = 1.0
+
+class QueueFullError(Exception):
+    """Raised when the queue in front of Ollama is too deep to accept a request."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"The server is busy. Please retry in {retry_after} seconds.")
+        self.retry_after = retry_after
+
+class Ticket:
+    """A request's place in the scheduler, from enqueue until release."""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.enqueued_at = time.monotonic()
+        self.granted_at = None
+        self.released = False
+        self.backend = None  # set by OllamaPool to the backend the ticket is queued on
+        self._event = threading.Event()
+        self._callbacks = []
+
+    @property
+    def granted(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        """Block until the ticket is granted; returns False on timeout."""
+        return self._event.wait(timeout)
+
+class FairScheduler:
+    """Admission control for requests to a model server.
+
+    At most max_in_flight requests run at once. Waiting requests are queued
+    per user and granted round-robin across users, so one user with many
+    open tabs cannot starve the others. When the queue is full, enqueue
+    fails fast with QueueFullError instead of holding the caller.
+    """
+
+    def __init__(self, max_in_flight=None, max_queue=None, max_queued_per_user=None, queue_timeout=None):
+        self.max_in_flight = max_in_flight or int(os.getenv('OLLAMA_MAX_IN_FLIGHT', '4'))
+        self.max_queue = max_queue if max_queue is not None else int(os.getenv('OLLAMA_MAX_QUEUE', '64'))
+        if max_queued_per_user is None:
+            max_queued_per_user = int(os.getenv('OLLAMA_MAX_QUEUED_PER_USER', '4'))
+        self.max_queued_per_user = max_queued_per_user
+        self.queue_timeout = queue_timeout or float(os.getenv('OLLAMA_QUEUE_TIMEOUT', '120'))
+        self._lock = threading.Lock()
+        self._queues = OrderedDict()  # user_id -> deque of waiting tickets, in round-robin order
+        self._queued = 0
+        self.in_flight = 0
+        self._service_time = None  # moving average of seconds a request holds a slot
+        self.admitted = 0
+        self.rejected = 0
+        self.completed = 0
+
+    @property
+    def outstanding(self):
+        """Requests running or waiting."""
+        return self.in_flight + self._queued
+
+    def enqueue(self, user_id):
+        """Queue a request for user_id and grant it at once if a slot is free.
+
+        Raises:
+            QueueFullError: If the queue (or the user's share of it) is full
+        """
+        ticket = Ticket(user_id)
+        with self._lock:
+            if self.in_flight >= self.max_in_flight:
+                user_queue = self._queues.get(user_id, ())
+                if self._queued >= self.max_queue or len(user_queue) >= self.max_queued_per_user:
+                    self.rejected += 1
+                    raise QueueFullError(self._retry_after())
+            self._queues.setdefault(user_id, deque()).append(ticket)
+            self._queued += 1
+            self.admitted += 1
+            granted = self._dispatch()
+        self._notify(granted)
+        return ticket
+
+    def release(self, ticket):
+        """Give back a ticket's slot, or drop it from the queue if it was never granted."""
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            if ticket.granted_at is not None:
+                self.in_flight -= 1
+                self.completed += 1
+                duration = time.monotonic() - ticket.granted_at
+                if self._service_time is None:
+                    self._service_time = duration
+                else:
+                    self._service_time = 0.8 * self._service_time + 0.2 * duration
+            else:
+                user_queue = self._queues[ticket.user_id]
+                user_queue.remove(ticket)
+                if not user_queue:
+                    del self._queues[ticket.user_id]
+                self._queued -= 1
+            granted = self._dispatch()
+        self._notify(granted)
+
+    def on_grant(self, ticket, callback):
+        """Call callback() once the ticket is granted, right away if it already is."""
+        with self._lock:
+            if ticket.granted_at is None:
+                ticket._callbacks.append(callback)
+                return
+        callback()
+
+    def position(self, ticket):
+        """1-based number of requests that will be granted up to and including this one, 0 once granted."""
+        with self._lock:
+            if ticket.granted_at is not None or ticket.released:
+                return 0
+            index = self._queues[ticket.user_id].index(ticket)
+            position = index + 1
+            before = True
+            for user_id, user_queue in self._queues.items():
+                if user_id == ticket.user_id:
+                    before = False
+                    continue
+                # Round-robin: users ahead in the rotation get one more turn first
+                position += min(len(user_queue), index + 1 if before else index)
+            return position
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': self.in_flight,
+                'queued': self._queued,
+                'users_waiting': len(self._queues),
+                'max_in_flight': self.max_in_flight,
+                'max_queue': self.max_queue,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'completed': self.completed,
+                'avg_service_seconds': round(self._service_time or 0.0, 3)
+            }
+
+    def _dispatch(self):
+        """Grant free slots round-robin across users. Must be called with the lock held."""
+        granted = []
+        while self.in_flight < self.max_in_flight and self._queues:
+            user_id, user_queue = next(iter(self._queues.items()))
+            ticket = user_queue.popleft()
+            if user_queue:
+                self._queues.move_to_end(user_id)
+            else:
+                del self._queues[user_id]
+            self._queued -= 1
+            self.in_flight += 1
+            ticket.granted_at = time.monotonic()
+            granted.append(ticket)
+        return granted
+
+    def _notify(self, granted):
+        for ticket in granted:
+            ticket._event.set()
+            for callback in ticket._callbacks:
+                callback()
+            ticket._callbacks = []
+
+    def _retry_after(self):
+        """Seconds until a slot is likely to free up for a new request."""
+        service_time = self._service_time or 10.0
+        return max(1, math.ceil(service_time * (self._queued + 1) / self.max_in_flight))
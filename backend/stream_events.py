@@ -0,0 +1,242 @@
+"""Typed events passed from the chat managers to the /api/chat routes.
+
+Events stay Python objects until the route frames them for the client, so
+each token is JSON-encoded exactly once. Consecutive content events can be
+coalesced into larger frames to cut per-token overhead.
+"""
+import asyncio
+import json
+import os
+import queue
+import threading
+import time
+
+try:
+    import orjson
+except ImportError:  # optional; the standard library encoder is used instead
+    orjson = None
+
+if orjson is not None:
+    def json_dumps(value):
+        return orjson.dumps(value).decode('utf-8')
+    json_loads = orjson.loads
+else:
+    json_dumps = json.JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+    json_loads = json.loads
+
+class ContentEvent:
+    type = "content"
+    __slots__ = ('content',)
+
+    def __init__(self, content):
+        self.content = content
+
+    def to_dict(self):
+        return {'type': self.type, 'content': self.content}
+
+class QueuedEvent:
+    type = "queued"
+    __slots__ = ('position',)
+
+    def __init__(self, position):
+        self.position = position
+
+    def to_dict(self):
+        return {'type': self.type, 'position': self.position}
+
+class ErrorEvent:
+    type = "error"
+    __slots__ = ('content',)
+
+    def __init__(self, content):
+        self.content = content
+
+    def to_dict(self):
+        return {'type': self.type, 'content': self.content}
+
+class CancelledEvent:
+    type = "cancelled"
+    __slots__ = ('reason',)
+
+    def __init__(self, reason):
+        self.reason = reason
+
+    def to_dict(self):
+        return {'type': self.type, 'reason': self.reason}
+
+class DoneEvent:
+    type = "done"
+    __slots__ = ()
+
+    def to_dict(self):
+        return {'type': self.type}
+
+def sse_frame(event, event_id=None):
+    """Encode an event as a server-sent events frame, with an id clients can resume from."""
+    if event_id is None:
+        return f"data: {json_dumps(event.to_dict())}\n\n"
+    return f"id: {event_id}\ndata: {json_dumps(event.to_dict())}\n\n"
+
+def coalesce_settings():
+    """Coalescing window from STREAM_COALESCE_MS and STREAM_COALESCE_CHARS (0 disables)."""
+    return (
+        float(os.getenv('STREAM_COALESCE_MS', '30')) / 1000,
+        int(os.getenv('STREAM_COALESCE_CHARS', '64'))
+    )
+
+class ContentBuffer:
+    """Joins content events until the window has passed or enough text is buffered.
+
+    A token that comes after a pause is sent at once; only bursts of tokens
+    are merged. Buffered text is held for at most the window: due() says when
+    it must be sent even if no further token arrives.
+    """
+
+    def __init__(self, window, max_chars):
+        self.window = window
+        self.max_chars = max_chars
+        self.parts = []
+        self.size = 0
+        self.last_flush = time.monotonic()
+
+    def add(self, content):
+        """Buffer content; returns a merged event when it is time to send one."""
+        self.parts.append(content)
+        self.size += len(content)
+        now = time.monotonic()
+        if self.size >= self.max_chars or now - self.last_flush >= self.window:
+            return self.flush(now)
+        return None
+
+    def due(self):
+        """Seconds until the buffered content must be sent, or None if nothing is buffered."""
+        if not self.parts:
+            return None
+        return max(0.0, self.last_flush + self.window - time.monotonic())
+
+    def flush(self, now=None):
+        """Return the buffered content as one event, or None if there is none."""
+        self.last_flush = now or time.monotonic()
+        if not self.parts:
+            return None
+        event = ContentEvent(self.parts[0] if len(self.parts) == 1 else "".join(self.parts))
+        self.parts = []
+        self.size = 0
+        return event
+
+# Put on a coalesce read-ahead queue when the source stream ends
+_END = object()
+
+def _read_ahead(events, items, stop):
+    """Move events to a queue on a separate thread, so coalesce can wait with a timeout."""
+    try:
+        for event in events:
+            items.put(event)
+            if stop.is_set():
+                break
+    except Exception as e:
+        items.put(e)
+    finally:
+        # Closed here because the source cannot be closed from another thread while it runs
+        if hasattr(events, 'close'):
+            events.close()
+        items.put(_END)
+
+def coalesce(events, window=None, max_chars=None):
+    """Merge bursts of content events from a stream of events.
+
+    The source is read on its own thread, so content held in the buffer is
+    sent when the window ends even while the next token is still awaited.
+    Closing the result stops the reader after its current event.
+    """
+    if window is None or max_chars is None:
+        window, max_chars = coalesce_settings()
+    if window <= 0:
+        # Every token is sent on its own: nothing is ever held
+        try:
+            yield from events
+        finally:
+            if hasattr(events, 'close'):
+                events.close()
+        return
+    buffer = ContentBuffer(window, max_chars)
+    items = queue.Queue()
+    stop = threading.Event()
+    threading.Thread(target=_read_ahead, args=(events, items, stop), daemon=True).start()
+    try:
+        while True:
+            try:
+                event = items.get(timeout=buffer.due())
+            except queue.Empty:
+                yield buffer.flush()
+                continue
+            if event is _END:
+                break
+            if isinstance(event, Exception):
+                raise event
+            if event.type == "content":
+                merged = buffer.add(event.content)
+                if merged is not None:
+                    yield merged
+                continue
+            pending = buffer.flush()
+            if pending is not None:
+                yield pending
+            yield event
+        pending = buffer.flush()
+        if pending is not None:
+            yield pending
+    finally:
+        stop.set()
+
+async def _apump(events, items):
+    """Move events to a queue in a separate task, so acoalesce can wait with a timeout."""
+    try:
+        async for event in events:
+            items.put_nowait(event)
+    except Exception as e:
+        items.put_nowait(e)
+    finally:
+        await events.aclose()
+        items.put_nowait(_END)
+
+async def acoalesce(events, window=None, max_chars=None):
+    """Async version of coalesce; the source is read by a task of its own."""
+    if window is None or max_chars is None:
+        window, max_chars = coalesce_settings()
+    buffer = ContentBuffer(window, max_chars)
+    items = asyncio.Queue()
+    pump = asyncio.ensure_future(_apump(events, items))
+    try:
+        while True:
+            if items.empty():
+                try:
+                    event = await asyncio.wait_for(items.get(), buffer.due())
+                except asyncio.TimeoutError:
+                    yield buffer.flush()
+                    continue
+            else:
+                event = items.get_nowait()
+            if event is _END:
+                break
+            if isinstance(event, Exception):
+                raise event
+            if event.type == "content":
+                merged = buffer.add(event.content)
+                if merged is not None:
+                    yield merged
+                continue
+            pending = buffer.flush()
+            if pending is not None:
+                yield pending
+            yield event
+        pending = buffer.flush()
+        if pending is not None:
+            yield pending
+    finally:
+        # Cancelling the task closes the source, which stops the generation
+        pump.cancel()
+        try:
+            await pump
+        except asyncio.CancelledError:
+            pass
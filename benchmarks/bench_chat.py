@@ -0,0 +1,264 @@
+"""Load test for the chat server, against local stand-ins for Ollama and MongoDB.
+
+Starts a fake Ollama server (fake_ollama.py), serves the Flask app from
+backend/app.py on a local port with an in-memory MongoDB (mongomock, or a
+real server given with --mongo-uri), and drives concurrent simulated users.
+Each user loads the prompt catalog, creates a chat and sends --turns
+messages to /api/chat, refreshing the chat list after each reply.
+
+Reports time to first token and turn time percentiles, throughput, memory
+per open stream and the database operations per turn (from /metrics).
+
+Usage:
+    pip install -r benchmarks/requirements.txt
+    python benchmarks/bench_chat.py --users 20 --turns 3 --token-rate 50
+
+Server settings (OLLAMA_MAX_IN_FLIGHT, STREAM_COALESCE_MS, ...) are read from
+the environment as usual.
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import requests
+from fake_ollama import FakeOllama
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend')
+MESSAGES = [
+    "Can you help me plan my week?",
+    "What should I cook for dinner tonight?",
+    "Summarize the main points of our conversation so far.",
+    "Give me three ideas for a weekend trip."
+]
+BENCH_PROMPTS = {
+    'daily_life': ["What are some productive habits I can develop?"],
+    'qna': ["Explain quantum computing in simple terms"]
+}
+METRIC_LINE = re.compile(r'^mongo_operation_seconds_count\{method="([^"]+)"\} (\S+)$')
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+def rss_bytes():
+    """Resident memory of this process."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def load_app(args, ollama_url):
+    """Import the Flask app configured for the stand-ins; returns the app module."""
+    os.environ['OLLAMA_URL'] = ollama_url
+    os.environ.setdefault('PROFILE_CACHE_WATCH', 'false')
+    for category in ('BACKEND', 'FRONTEND', 'CHAT'):
+        os.environ.setdefault(f'LOG_LEVEL_{category}', 'WARNING')
+    # The logger writes to ../logs; keep benchmark logs out of the repo
+    run_dir = os.path.join(tempfile.mkdtemp(prefix='bench-chat-'), 'run')
+    os.makedirs(run_dir)
+    os.chdir(run_dir)
+    sys.path.insert(0, os.path.abspath(BACKEND_DIR))
+
+    import db_manager
+    if args.mongo_uri:
+        os.environ['MONGO_URI'] = args.mongo_uri
+    else:
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit("mongomock is required for the in-memory database: pip install -r benchmarks/requirements.txt")
+        client = mongomock.MongoClient()
+        db_manager.MongoClient = lambda *args, **kwargs: client
+
+    prompts = db_manager.get_mongo_client()['ai_chat_app']['prompts']
+    if prompts.count_documents({}) == 0:
+        prompts.insert_one({'_id': 'prompts', 'data': BENCH_PROMPTS})
+
+    import app
+    return app
+
+def serve(flask_app):
+    """Serve the app on a free local port in a background thread; returns its base URL."""
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)  # no access log line per request
+    server = make_server('127.0.0.1', 0, flask_app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+def mongo_operation_counts(base_url):
+    counts = {}
+    for line in requests.get(f"{base_url}/metrics", timeout=10).text.splitlines():
+        match = METRIC_LINE.match(line)
+        if match:
+            counts[match.group(1)] = int(float(match.group(2)))
+    return counts
+
+class Results:
+    def __init__(self):
+        self.ttft = []
+        self.turn_seconds = []
+        self.chars = 0
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def record_turn(self, ttft, seconds, chars):
+        with self._lock:
+            self.ttft.append(ttft)
+            self.turn_seconds.append(seconds)
+            self.chars += chars
+
+    def record_error(self, kind):
+        with self._lock:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+
+def chat_turn(session, base_url, user_id, chat_id, message, results):
+    """Send one message and read the reply stream to the end."""
+    started = time.monotonic()
+    ttft = None
+    chars = 0
+    with session.post(
+        f"{base_url}/api/chat", json={'user_id': user_id, 'chat_id': chat_id, 'message': message}, stream=True, timeout=300
+    ) as response:
+        if response.status_code != 200:
+            results.record_error(f"http_{response.status_code}")
+            return
+        for line in response.iter_lines():
+            if not line.startswith(b'data: '):
+                continue
+            data = line[6:]
+            if data == b'[DONE]':
+                break
+            event = json.loads(data)
+            if event['type'] == 'content':
+                if ttft is None:
+                    ttft = time.monotonic() - started
+                chars += len(event['content'])
+            elif event['type'] == 'error':
+                results.record_error('stream_error')
+                return
+    if ttft is None:
+        results.record_error('empty_reply')
+        return
+    results.record_turn(ttft, time.monotonic() - started, chars)
+
+def simulate_user(base_url, index, turns, results):
+    user_id = f"bench_user_{index}"
+    session = requests.Session()
+    try:
+        session.get(f"{base_url}/api/prompts", timeout=30).raise_for_status()
+        response = session.post(f"{base_url}/api/chats", json={'user_id': user_id, 'title': 'Benchmark'}, timeout=30)
+        response.raise_for_status()
+        chat_id = response.json()['chat_id']
+        for turn in range(turns):
+            chat_turn(session, base_url, user_id, chat_id, MESSAGES[(index + turn) % len(MESSAGES)], results)
+            session.get(f"{base_url}/api/chats", params={'user_id': user_id, 'summary': 1}, timeout=30).raise_for_status()
+    except requests.RequestException as e:
+        results.record_error(type(e).__name__)
+    finally:
+        session.close()
+
+def sample_memory(app_module, stop, samples):
+    """Record (rss, open streams) until stop is set."""
+    while not stop.is_set():
+        samples.append((rss_bytes(), app_module.chat_manager.streams.stats()['readers']))
+        stop.wait(0.05)
+
+def run(args):
+    ollama = FakeOllama(args.tokens, args.token_rate, args.first_token_latency)
+    app_module = load_app(args, ollama.start())
+    base_url = serve(app_module.app)
+    requests.get(f"{base_url}/api/prompts", timeout=30).raise_for_status()
+
+    ops_before = mongo_operation_counts(base_url)
+    results = Results()
+    stop = threading.Event()
+    samples = [(rss_bytes(), 0)]
+    sampler = threading.Thread(target=sample_memory, args=(app_module, stop, samples), daemon=True)
+    sampler.start()
+
+    started = time.monotonic()
+    users = []
+    for index in range(args.users):
+        user = threading.Thread(target=simulate_user, args=(base_url, index, args.turns, results))
+        user.start()
+        users.append(user)
+        if args.ramp:
+            time.sleep(args.ramp / args.users)
+    for user in users:
+        user.join()
+    elapsed = time.monotonic() - started
+    stop.set()
+    sampler.join()
+
+    # Let the background message writer finish before counting operations
+    app_module.chat_manager.db_manager.message_writer.flush()
+    ops_after = mongo_operation_counts(base_url)
+    operations = {
+        method: count - ops_before.get(method, 0)
+        for method, count in ops_after.items() if count - ops_before.get(method, 0)
+    }
+    turns = len(results.ttft)
+    baseline_rss = samples[0][0]
+    peak_rss, _ = max(samples)
+    peak_streams = max(streams for _, streams in samples)
+
+    return {
+        'users': args.users,
+        'turns': turns,
+        'errors': results.errors,
+        'elapsed_seconds': round(elapsed, 3),
+        'ttft_p50_ms': round(percentile(results.ttft, 0.5) * 1000, 1),
+        'ttft_p99_ms': round(percentile(results.ttft, 0.99) * 1000, 1),
+        'turn_p50_ms': round(percentile(results.turn_seconds, 0.5) * 1000, 1),
+        'turn_p99_ms': round(percentile(results.turn_seconds, 0.99) * 1000, 1),
+        'turns_per_second': round(turns / elapsed, 2) if elapsed else 0.0,
+        'tokens_per_second': round(ollama.tokens_sent / elapsed, 1) if elapsed else 0.0,
+        'peak_open_streams': peak_streams,
+        'memory_per_stream_kb': round((peak_rss - baseline_rss) / peak_streams / 1024, 1) if peak_streams else 0.0,
+        'ollama_requests': ollama.requests,
+        'db_operations': operations,
+        'db_operations_per_turn': round(sum(operations.values()) / turns, 2) if turns else 0.0
+    }
+
+def print_report(report):
+    print(f"Users: {report['users']}  turns: {report['turns']}  errors: {report['errors'] or 'none'}  time: {report['elapsed_seconds']}s")
+    print(f"Time to first token: p50 {report['ttft_p50_ms']} ms, p99 {report['ttft_p99_ms']} ms")
+    print(f"Turn time:           p50 {report['turn_p50_ms']} ms, p99 {report['turn_p99_ms']} ms")
+    print(f"Throughput:          {report['turns_per_second']} turns/s, {report['tokens_per_second']} tokens/s")
+    print(f"Memory per stream:   {report['memory_per_stream_kb']} KB (RSS growth over {report['peak_open_streams']} open streams)")
+    print(f"Ollama requests:     {report['ollama_requests']}")
+    print(f"DB operations:       {report['db_operations_per_turn']} per turn")
+    for method, count in sorted(report['db_operations'].items(), key=lambda item: -item[1]):
+        print(f"  {method:<32} {count}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test /api/chat against a fake Ollama and an in-memory MongoDB.")
+    parser.add_argument('--users', type=int, default=10, help='concurrent simulated users')
+    parser.add_argument('--turns', type=int, default=3, help='messages each user sends')
+    parser.add_argument('--tokens', type=int, default=64, help='tokens per reply')
+    parser.add_argument('--token-rate', type=float, default=50.0, help='tokens per second per reply, 0 for no delay')
+    parser.add_argument('--first-token-latency', type=float, default=0.2, help='seconds the fake Ollama waits before the first token')
+    parser.add_argument('--ramp', type=float, default=0.0, help='seconds over which to start the users')
+    parser.add_argument('--mongo-uri', help='use this MongoDB server instead of the in-memory one')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""A stand-in for the Ollama HTTP API, for benchmarks.
+
+/api/chat streams NDJSON like Ollama: after first_token_latency seconds it
+sends `tokens` message chunks at token_rate per second, then a done line.
+Requests with "stream": false get the whole reply at once (used for chat
+summaries), and requests without messages only "load" the model, as the
+server's warm-up sends.
+
+Run on its own with:
+    python benchmarks/fake_ollama.py --port 11435 --token-rate 50
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == '/api/version':
+            self._send_json({'version': 'fake'})
+        elif self.path == '/api/tags':
+            self._send_json({'models': []})
+        elif self.path == '/api/ps':
+            self._send_json({'models': [{'name': name, 'model': name} for name in sorted(self.server.loaded_models)]})
+        else:
+            self._send_json({'error': 'not found'}, status=404)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if self.path != '/api/chat':
+            self._send_json({'error': 'not found'}, status=404)
+            return
+        server = self.server
+        model = body.get('model', 'fake')
+        server.loaded_models.add(model if ':' in model else f"{model}:latest")
+        if not body.get('messages'):
+            server.record_load()
+            self._send_json({'model': model, 'message': {'role': 'assistant', 'content': ''}, 'done_reason': 'load', 'done': True})
+            return
+        server.record_request()
+        if not body.get('stream', True):
+            time.sleep(server.first_token_latency)
+            self._send_json({'model': model, 'message': {'role': 'assistant', 'content': 'Summary of the conversation.'}, 'done': True})
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        interval = 1.0 / server.token_rate if server.token_rate > 0 else 0
+        try:
+            time.sleep(server.first_token_latency)
+            next_at = time.monotonic()
+            for index in range(server.tokens):
+                self._send_chunk({'model': model, 'message': {'role': 'assistant', 'content': f"token{index} "}, 'done': False})
+                server.record_token()
+                next_at += interval
+                delay = next_at - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            self._send_chunk({'model': model, 'message': {'role': 'assistant', 'content': ''}, 'done': True, 'eval_count': server.tokens})
+            self.wfile.write(b'0\r\n\r\n')
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            server.record_abort()
+
+    def _send_chunk(self, data):
+        line = (json.dumps(data) + '\n').encode('utf-8')
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(line), line))
+        self.wfile.flush()
+
+    def _send_json(self, data, status=200):
+        payload = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+class FakeOllama(ThreadingHTTPServer):
+    """Fake Ollama server; counts requests, model loads, streamed tokens and aborted streams."""
+    daemon_threads = True
+
+    def __init__(self, tokens=64, token_rate=50.0, first_token_latency=0.2, host='127.0.0.1', port=0):
+        super().__init__((host, port), FakeOllamaHandler)
+        self.tokens = tokens
+        self.token_rate = token_rate
+        self.first_token_latency = first_token_latency
+        self.requests = 0
+        self.loads = 0
+        self.loaded_models = set()
+        self.tokens_sent = 0
+        self.aborted = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def record_load(self):
+        with self._lock:
+            self.loads += 1
+
+    def record_token(self):
+        with self._lock:
+            self.tokens_sent += 1
+
+    def record_abort(self):
+        with self._lock:
+            self.aborted += 1
+
+    def start(self):
+        """Serve in a background thread; returns the base URL."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.url
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11435)
+    parser.add_argument('--tokens', type=int, default=64, help='tokens per reply')
+    parser.add_argument('--token-rate', type=float, default=50.0, help='tokens per second, 0 for no delay')
+    parser.add_argument('--first-token-latency', type=float, default=0.2, help='seconds before the first token')
+    args = parser.parse_args()
+    server = FakeOllama(args.tokens, args.token_rate, args.first_token_latency, args.host, args.port)
+    print(f"Fake Ollama listening on {server.url}")
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,6 @@
+// Longest Retry-After the page waits out before sending a busy chat request again
+const MAX_RETRY_AFTER_SECONDS = 10;
+
 class ChatApp {
   constructor() {
     this.userId = this.getUserId();
@@ -5,6 +8,10 @@ class ChatApp {
     this.isWaitingForResponse = false;
     this.abortController = null;
     this.chatTitleMap = {};
+    this.messagesCursor = null;
+    this.isLoadingOlderMessages = false;
+    this.chatSummaries = {};
+    this.lastChatSync = null;
     this.initializeEventListeners();
     this.initializeApp();
   }
@@ -84,6 +91,15 @@ class ChatApp {
       .getElementById("stop-btn")
       .addEventListener("click", () => this.stopGeneration());
 
+    // Load older messages when scrolling to the top of the chat
+    document
+      .getElementById("chat-messages")
+      .addEventListener("scroll", (e) => {
+        if (e.target.scrollTop < 50) {
+          this.loadOlderMessages();
+        }
+      });
+
     // Mobile menu toggle
     const menuToggle = document.getElementById("menuToggle");
     menuToggle.addEventListener("click", () => this.toggleSidebar());
@@ -204,21 +220,39 @@ class ChatApp {
     let wasAborted = false;
 
     try {
-      const response = await fetch("/api/chat", {
-        method: "POST",
-        headers: {
-          "Content-Type": "application/json",
-          Accept: "text/event-stream",
-          "Cache-Control": "no-cache",
-          Connection: "keep-alive",
-        },
-        signal, // Pass the signal to the fetch request
-        body: JSON.stringify({
-          user_id: this.userId,
-          chat_id: this.currentChatId,
-          message,
-        }),
-      });
+      const send = () =>
+        fetch("/api/chat", {
+          method: "POST",
+          headers: {
+            "Content-Type": "application/json",
+            Accept: "text/event-stream",
+            "Cache-Control": "no-cache",
+            Connection: "keep-alive",
+          },
+          signal, // Pass the signal to the fetch request
+          body: JSON.stringify({
+            user_id: this.userId,
+            chat_id: this.currentChatId,
+            message,
+          }),
+        });
+      const isBusy = (status) => status === 429 || status === 503;
+
+      let response = await send();
+      // The model server queue is full, the server is restarting or the previous
+      // reply is still being saved; the message was not stored, so send it once more
+      const retryAfter = Number(response.headers.get("Retry-After"));
+      if (isBusy(response.status) && retryAfter > 0 && retryAfter <= MAX_RETRY_AFTER_SECONDS) {
+        await this.sleep(retryAfter * 1000, signal);
+        response = await send();
+      }
+
+      if (isBusy(response.status)) {
+        // Tell the user when to retry
+        const retryAfter = response.headers.get("Retry-After") || "a few";
+        messageElement.innerHTML = `<div class="error-message">The server is busy. Please try again in ${retryAfter} seconds.</div>`;
+        return;
+      }
 
       if (!response.ok) {
         const errorText = await response.text();
@@ -231,9 +265,12 @@ class ChatApp {
         throw new Error("ReadableStream not supported in this browser");
       }
 
-      const reader = response.body.getReader();
+      let reader = response.body.getReader();
       const decoder = new TextDecoder("utf-8");
       let buffer = "";
+      let lastEventId = null;
+      let resumeAttempts = 0;
+      let reloadedChat = false;
       let assistantMessage = "";
       let isProcessing = true;
 
@@ -257,18 +294,34 @@ class ChatApp {
       });
       contentContainer.appendChild(loadingIndicator);
 
+      // Reconnect to the reply after a dropped connection; the server keeps
+      // generating and replays the events after the last one we received
+      const resume = async () => {
+        if (resumeAttempts >= 3 || !this.currentChatId) return false;
+        resumeAttempts++;
+        const resumed = await this.resumeStream(lastEventId, signal);
+        if (!resumed) return false;
+        if (resumed.status === 404) {
+          // The reply is no longer buffered; it is saved in the chat history
+          reloadedChat = true;
+          await this.loadChat(this.currentChatId);
+          return false;
+        }
+        reader = resumed.body.getReader();
+        buffer = "";
+        return true;
+      };
+
       const processChunk = async () => {
         try {
           while (isProcessing) {
             const { done, value } = await reader.read();
 
             if (done) {
+              // The stream ended before [DONE]; the connection was cut
+              if (await resume()) continue;
               isProcessing = false;
               this.isWaitingForResponse = false;
-              // Save the complete message to chat history
-              if (this.currentChatId) {
-                await this.saveMessageToHistory("assistant", assistantMessage);
-              }
               // Remove loading indicator when done
               if (loadingIndicator.parentNode === contentContainer) {
                 contentContainer.removeChild(loadingIndicator);
@@ -291,6 +344,9 @@ class ChatApp {
               let eventData = "";
 
               for (const line of lines) {
+                if (line.startsWith("id: ")) {
+                  lastEventId = line.substring(4).trim();
+                }
                 if (line.startsWith("data: ")) {
                   const data = line.substring(6).trim();
                   if (data === "[DONE]") {
@@ -319,6 +375,13 @@ class ChatApp {
                   return;
                 }
 
+                // Waiting for a free slot on the model server
+                if (parsedData.type === "queued") {
+                  loadingIndicator.title = `Queued (position ${parsedData.position})`;
+                  loadingIndicator.dataset.queuePosition = parsedData.position;
+                  continue;
+                }
+
                 // Handle content chunk
                 if (parsedData.content) {
                   assistantMessage += parsedData.content;
@@ -355,6 +418,8 @@ class ChatApp {
             console.log("Request was aborted by user");
             return;
           }
+          if (await resume()) return processChunk();
+          if (reloadedChat) return;
           console.error("Error in processChunk:", error);
           contentContainer.innerHTML =
             '<div class="error-message">Error receiving response. Please try again.</div>';
@@ -379,6 +444,37 @@ class ChatApp {
     }
   }
 
+  sleep(ms, signal) {
+    // Resolves after ms, or rejects with an AbortError when the request is stopped
+    return new Promise((resolve, reject) => {
+      const timer = setTimeout(resolve, ms);
+      signal.addEventListener("abort", () => {
+        clearTimeout(timer);
+        reject(new DOMException("Aborted", "AbortError"));
+      }, { once: true });
+    });
+  }
+
+  async resumeStream(lastEventId, signal) {
+    // Give the network a moment to come back before reconnecting
+    await new Promise((resolve) => setTimeout(resolve, 1000));
+    try {
+      const headers = { Accept: "text/event-stream" };
+      if (lastEventId) headers["Last-Event-ID"] = lastEventId;
+      const response = await fetch(
+        `/api/chat/${this.currentChatId}/stream?user_id=${encodeURIComponent(this.userId)}`,
+        { headers, signal }
+      );
+      if ((response.ok && response.body) || response.status === 404) {
+        return response;
+      }
+    } catch (error) {
+      if (error.name === "AbortError") throw error;
+      console.error("Error resuming stream:", error);
+    }
+    return null;
+  }
+
   addMessageToUI(role, content) {
     const messagesContainer = document.getElementById("chat-messages");
     const messageElement = this.createMessageElement(role, content);
@@ -412,34 +508,6 @@ class ChatApp {
     return formatted;
   }
 
-  async saveMessageToHistory(role, content) {
-    if (!this.currentChatId) return;
-
-    try {
-      const response = await fetch(
-        `/api/chats/${this.currentChatId}/messages`,
-        {
-          method: "POST",
-          headers: { "Content-Type": "application/json" },
-          body: JSON.stringify({
-            user_id: this.userId,
-            role,
-            content,
-          }),
-        }
-      );
-
-      if (!response.ok) {
-        throw new Error(`Failed to save message: ${response.status}`);
-      }
-
-      return await response.json();
-    } catch (error) {
-      console.error("Error saving message to history:", error);
-      throw error;
-    }
-  }
-
   createMessageElement(role, content) {
     const messageDiv = document.createElement("div");
     messageDiv.className = `message ${role}-message`;
@@ -564,12 +632,32 @@ class ChatApp {
     }
   }
 
+  async syncChatSummaries() {
+    // Fetch only the chats changed since the last sync
+    let url = `/api/chats?user_id=${this.userId}&summary=1`;
+    if (this.lastChatSync) {
+      url += `&since=${encodeURIComponent(this.lastChatSync)}`;
+    }
+    const response = await fetch(url);
+    if (!response.ok) throw new Error("Failed to load chat history");
+
+    const delta = await response.json();
+    for (const chat of delta.chats) {
+      this.chatSummaries[chat.chat_id] = chat;
+    }
+    for (const chatId of delta.deleted) {
+      delete this.chatSummaries[chatId];
+    }
+    this.lastChatSync = delta.synced_at;
+
+    return Object.values(this.chatSummaries).sort((a, b) =>
+      (b.updated_at || "").localeCompare(a.updated_at || "")
+    );
+  }
+
   async loadChatHistory() {
     try {
-      const response = await fetch(`/api/chats?user_id=${this.userId}`);
-      if (!response.ok) throw new Error("Failed to load chat history");
-
-      const chats = await response.json();
+      const chats = await this.syncChatSummaries();
       const chatList = document.getElementById("chat-list");
       if (!chatList) return;
 
@@ -586,7 +674,8 @@ class ChatApp {
       const historyItems = document.createElement("div");
       historyItems.className = "chat-history-items";
 
-      for (const [chatId, chatData] of Object.entries(chats)) {
+      for (const chatData of chats) {
+        const chatId = chatData.chat_id;
         const chatItem = document.createElement("div");
         chatItem.className = `chat-item ${
           this.currentChatId === chatId ? "active" : ""
@@ -717,25 +806,37 @@ class ChatApp {
     }
   }
 
+  async fetchMessagesPage(chatId, before = null) {
+    let url = `/api/chats/${chatId}/messages?user_id=${this.userId}`;
+    if (before !== null) {
+      url += `&before=${before}`;
+    }
+    const response = await fetch(url);
+    if (!response.ok) throw new Error("Failed to load messages");
+    return response.json();
+  }
+
   async loadChat(chatId) {
     try {
-      const response = await fetch(`/api/chats?user_id=${this.userId}`);
-      const chats = await response.json();
-      const chat = chats[chatId];
+      const chatItem = document.querySelector(
+        `.chat-item[data-chat-id="${chatId}"]`
+      );
+      const titleElement = chatItem?.querySelector(".chat-title");
 
-      if (!chat) return;
+      const page = await this.fetchMessagesPage(chatId);
 
       this.currentChatId = chatId;
+      this.messagesCursor = page.next_cursor;
 
       // Update UI
       document.getElementById("current-chat-title").textContent =
-        chat.title || "Untitled Chat";
+        titleElement?.textContent || "Untitled Chat";
 
       const messagesContainer = document.getElementById("chat-messages");
       messagesContainer.innerHTML = "";
 
       // Add messages to UI
-      chat.messages.forEach((message) => {
+      page.messages.forEach((message) => {
         this.addMessageToUI(message.role, message.content);
       });
 
@@ -745,9 +846,9 @@ class ChatApp {
       document.querySelectorAll(".chat-item").forEach((item) => {
         item.classList.remove("active");
       });
-      document
-        .querySelector(`.chat-item[data-chat-id="${chatId}"]`)
-        .classList.add("active");
+      if (chatItem) {
+        chatItem.classList.add("active");
+      }
 
       // Hide welcome message and show prompt suggestions
       const welcomeMessage = document.querySelector(".welcome-message");
@@ -759,6 +860,47 @@ class ChatApp {
     }
   }
 
+  async loadOlderMessages() {
+    if (
+      !this.currentChatId ||
+      this.messagesCursor === null ||
+      this.isLoadingOlderMessages
+    ) {
+      return;
+    }
+
+    this.isLoadingOlderMessages = true;
+    const chatId = this.currentChatId;
+
+    try {
+      const page = await this.fetchMessagesPage(chatId, this.messagesCursor);
+
+      // Ignore the page if the user switched chats while it was loading
+      if (chatId !== this.currentChatId) return;
+
+      this.messagesCursor = page.next_cursor;
+
+      const messagesContainer = document.getElementById("chat-messages");
+      const previousHeight = messagesContainer.scrollHeight;
+
+      const fragment = document.createDocumentFragment();
+      page.messages.forEach((message) => {
+        fragment.appendChild(
+          this.createMessageElement(message.role, message.content)
+        );
+      });
+      messagesContainer.insertBefore(fragment, messagesContainer.firstChild);
+
+      // Keep the viewport on the message the user was reading
+      messagesContainer.scrollTop +=
+        messagesContainer.scrollHeight - previousHeight;
+    } catch (error) {
+      console.error("Error loading older messages:", error);
+    } finally {
+      this.isLoadingOlderMessages = false;
+    }
+  }
+
   async deleteChat(chatId = null) {
     const targetChatId = chatId || this.currentChatId;
     if (!targetChatId) return;
@@ -810,6 +952,7 @@ class ChatApp {
 
   newChat() {
     this.currentChatId = null;
+    this.messagesCursor = null;
     document.getElementById("current-chat-title").textContent = "New Chat";
 
     const messagesContainer = document.getElementById("chat-messages");
@@ -1087,6 +1230,15 @@ class ChatApp {
         // Abort the request
         controller.abort();
 
+        // Aborting only closes our connection; ask the server to stop the model too
+        if (this.currentChatId) {
+          fetch(`/api/chat/${this.currentChatId}/cancel`, {
+            method: "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify({ user_id: this.userId }),
+          }).catch((error) => console.error("Error cancelling reply:", error));
+        }
+
         // Show a message indicating the generation was stopped
         const messagesContainer = document.getElementById("chat-messages");
         const stopMessage = document.createElement("div");
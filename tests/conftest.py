@@ -0,0 +1,47 @@
+"""Shared fixtures for the backend tests.
+
+The backend modules are imported the way app.py imports them, from the
+backend directory. Tests run against an in-memory mongomock client. Tests
+marked mongo_server need features mongomock does not have (text search)
+and only run when TEST_MONGO_URI points at a disposable MongoDB server;
+its ai_chat_app database is dropped after each of them.
+"""
+import os
+import sys
+import tempfile
+import pytest
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend')
+sys.path.insert(0, os.path.abspath(BACKEND_DIR))
+os.environ.setdefault('LOG_DIR', tempfile.mkdtemp(prefix='chat-tests-logs-'))
+os.environ.setdefault('PROFILE_CACHE_WATCH', 'false')
+os.environ.setdefault('OLLAMA_WARMUP', 'false')
+os.environ.setdefault('CHAT_ARCHIVE_INTERVAL', '0')
+
+import db_manager
+
+@pytest.fixture
+def mongo_client(request, monkeypatch):
+    uri = os.getenv('TEST_MONGO_URI')
+    if request.node.get_closest_marker('mongo_server'):
+        if not uri:
+            pytest.skip("needs a MongoDB server in TEST_MONGO_URI")
+        from pymongo import MongoClient
+        client = MongoClient(uri)
+    else:
+        import mongomock
+        client = mongomock.MongoClient()
+    monkeypatch.setattr(db_manager, 'MongoClient', lambda *args, **kwargs: client)
+    monkeypatch.setattr(db_manager, '_client', None)
+    monkeypatch.setattr(db_manager, '_message_writer', None)
+    monkeypatch.setattr(db_manager, '_legacy_layout', db_manager.LegacyLayout())
+    yield client
+    if uri and request.node.get_closest_marker('mongo_server'):
+        client.drop_database('ai_chat_app')
+        client.close()
+
+@pytest.fixture
+def db(mongo_client):
+    manager = db_manager.DatabaseManager()
+    yield manager
+    manager.message_writer.flush()
@@ -0,0 +1,54 @@
+import pytest
+
+def archived_chat(db, user_id, messages):
+    """Create a chat with the given messages and archive it."""
+    chat_id = db.create_chat(user_id, "Trip planning")
+    for role, content in messages:
+        db.add_message(user_id, chat_id, role, content)
+    chat = db.chats_collection.find_one({'_id': chat_id})
+    assert db.archive_chat(user_id, chat_id, chat['updated_at'])
+    return chat_id
+
+MESSAGES = [
+    ("user", "Where should we go hiking in the Dolomites?"),
+    ("assistant", "The Seceda ridge is a good day hike.")
+]
+
+def test_archive_moves_messages_to_blob_and_search_copy(db):
+    chat_id = archived_chat(db, "u1", MESSAGES)
+
+    assert db.messages_collection.count_documents({'chat_id': chat_id}) == 0
+    assert db.archive_collection.count_documents({'_id': chat_id}) == 1
+    copies = list(db.archive_search_collection.find({'chat_id': chat_id}, {'_id': 0}).sort('seq', 1))
+    assert [(copy['seq'], copy['role'], copy['content']) for copy in copies] == [
+        (1, "user", MESSAGES[0][1]), (2, "assistant", MESSAGES[1][1])
+    ]
+    assert all(copy['user_id'] == "u1" for copy in copies)
+
+def test_rehydrate_restores_messages_and_drops_search_copy(db):
+    chat_id = archived_chat(db, "u1", MESSAGES)
+
+    assert [message['content'] for message in db.get_chat_messages("u1", chat_id)] == [content for _, content in MESSAGES]
+    assert db.archive_collection.count_documents({'_id': chat_id}) == 0
+    assert db.archive_search_collection.count_documents({'chat_id': chat_id}) == 0
+
+def test_delete_chat_drops_search_copy(db):
+    chat_id = archived_chat(db, "u1", MESSAGES)
+
+    assert db.delete_chat("u1", chat_id)
+    assert db.archive_search_collection.count_documents({}) == 0
+
+@pytest.mark.mongo_server
+def test_search_finds_archived_chat(db):
+    archived = archived_chat(db, "u1", MESSAGES)
+    hot = db.create_chat("u1", "Hot chat")
+    db.add_message("u1", hot, "user", "Any hiking boots you recommend?")
+    other_user = archived_chat(db, "u2", [("user", "Hiking near Seceda")])
+
+    results = db.search_messages("u1", "hiking")['results']
+
+    assert {(hit['chat_id'], hit['seq']) for hit in results} == {(archived, 1), (hot, 1)}
+    assert other_user not in {hit['chat_id'] for hit in results}
+    archived_hit = next(hit for hit in results if hit['chat_id'] == archived)
+    assert archived_hit['title'] == "Trip planning"
+    assert "hiking" in archived_hit['snippet'].lower()
@@ -0,0 +1,23 @@
+def test_since_sync_picks_up_finished_reply(db):
+    chat_id = db.create_chat("u1", "Recipes")
+    db.add_message("u1", chat_id, "user", "What can I cook with leeks?")
+    seq = db.begin_reply("u1", chat_id, "stream1", "Leek")
+    # The reply started well before the client's last sync
+    db.chats_collection.update_one({'_id': chat_id}, {'$set': {'updated_at': '2000-01-01T00:00:00'}})
+    since = '2000-01-02T00:00:00'
+    assert db.get_chat_summaries("u1", since=since)['chats'] == []
+
+    db.update_reply("u1", chat_id, seq, "stream1", "Leek and potato soup.", final=True)
+
+    chats = db.get_chat_summaries("u1", since=since)['chats']
+    assert [(chat['chat_id'], chat['last_message']) for chat in chats] == [(chat_id, "Leek and potato soup.")]
+
+def test_since_sync_reports_deleted_chats(db):
+    chat_id = db.create_chat("u1", "Temporary")
+    since = db.get_chat_summaries("u1")['synced_at']
+
+    db.delete_chat("u1", chat_id)
+
+    changes = db.get_chat_summaries("u1", since=since)
+    assert changes['chats'] == []
+    assert changes['deleted'] == [chat_id]
@@ -0,0 +1,59 @@
+from context_builder import ContextBuilder
+
+# Each message costs 10 tokens with the per-message overhead
+def chat(count, tokens=6):
+    messages = [{'role': 'user', 'content': f"message {seq}", 'seq': seq, 'tokens': tokens} for seq in range(1, count + 1)]
+    return list(reversed(messages))
+
+def seqs(window):
+    return [int(message['content'].split()[1]) for message in window]
+
+def builder():
+    return ContextBuilder(default_budget=50, model_budgets={}, refill=0.6)
+
+def test_window_keeps_its_start_while_it_fits():
+    window, evicted_through, _ = builder().build(chat(4), "llama3", start_seq=2)
+    assert seqs(window) == [2, 3, 4]
+    assert evicted_through == 1
+
+    window, evicted_through, _ = builder().build(chat(6), "llama3", start_seq=2)
+    assert seqs(window) == [2, 3, 4, 5, 6]
+    assert evicted_through == 1
+
+def test_window_moves_forward_by_a_chunk_when_full():
+    window, evicted_through, _ = builder().build(chat(6), "llama3", start_seq=1)
+    # Refilled to 60% of the budget rather than dropping only message 1
+    assert seqs(window) == [4, 5, 6]
+    assert evicted_through == 3
+
+    # The next turns start at the new window again
+    window, evicted_through, _ = builder().build(chat(8), "llama3", start_seq=evicted_through + 1)
+    assert seqs(window) == [4, 5, 6, 7, 8]
+    assert evicted_through == 3
+
+def test_reserved_tokens_shrink_the_budget():
+    window, evicted_through, _ = builder().build(chat(3), "llama3", reserved_tokens=20, start_seq=1)
+    assert seqs(window) == [1, 2, 3]
+
+    # 30 tokens left, refilled to 18
+    window, evicted_through, _ = builder().build(chat(4), "llama3", reserved_tokens=20, start_seq=1)
+    assert seqs(window) == [4]
+    assert evicted_through == 3
+
+def test_newest_message_is_kept_even_over_budget():
+    messages = chat(3)
+    messages[0]['tokens'] = 100
+    window, evicted_through, _ = builder().build(messages, "llama3", start_seq=1)
+    assert seqs(window) == [3]
+    assert evicted_through == 2
+
+def test_stale_start_falls_back_to_a_fresh_window():
+    window, evicted_through, _ = builder().build(chat(3), "llama3", start_seq=9)
+    assert seqs(window) == [1, 2, 3]
+    assert evicted_through is None
+
+def test_uncached_counts_are_reported():
+    messages = chat(2)
+    del messages[0]['tokens']
+    _, _, uncached = builder().build(messages, "llama3")
+    assert uncached == {2: 3}
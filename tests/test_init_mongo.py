@@ -0,0 +1,51 @@
+import json
+import os
+import pytest
+import init_mongo
+
+DOCUMENTS = [{'_id': f"m{number}", 'content': f"message {number}"} for number in range(1, 6)]
+
+@pytest.fixture
+def data_file(tmp_path):
+    path = tmp_path / "messages.ndjson"
+    path.write_text("".join(json.dumps(document) + "\n" for document in DOCUMENTS))
+    return str(path)
+
+def test_interrupted_import_resumes_from_saved_offset(mongo_client, data_file, monkeypatch):
+    db = mongo_client[init_mongo.DATABASE_NAME]
+    write_batch = init_mongo.write_batch
+    batches = []
+
+    def interrupted_write(collection, batch, upsert=False):
+        if batches:
+            raise KeyboardInterrupt
+        batches.append([document['_id'] for document in batch])
+        return write_batch(collection, batch, upsert)
+
+    monkeypatch.setattr(init_mongo, 'write_batch', interrupted_write)
+    with pytest.raises(KeyboardInterrupt):
+        init_mongo.import_file(db, data_file, batch_size=2)
+
+    with open(data_file, 'rb') as f:
+        first_two_lines = len(f.readline()) + len(f.readline())
+    progress = init_mongo.load_progress(f"{data_file}.progress")
+    assert progress == {'collection': 'messages', 'documents': 2, 'offset': first_two_lines, 'written': 2}
+
+    def recorded_write(collection, batch, upsert=False):
+        batches.append([document['_id'] for document in batch])
+        return write_batch(collection, batch, upsert)
+
+    monkeypatch.setattr(init_mongo, 'write_batch', recorded_write)
+    assert init_mongo.import_file(db, data_file, batch_size=2) == 5
+
+    # Only the documents after the saved offset were read again
+    assert batches == [["m1", "m2"], ["m3", "m4"], ["m5"]]
+    assert sorted(db.messages.distinct('_id')) == ["m1", "m2", "m3", "m4", "m5"]
+    assert not os.path.exists(f"{data_file}.progress")
+
+def test_restart_ignores_saved_progress(mongo_client, data_file):
+    db = mongo_client[init_mongo.DATABASE_NAME]
+    init_mongo.save_progress(f"{data_file}.progress", {'collection': 'messages', 'documents': 4, 'offset': 10, 'written': 4})
+
+    assert init_mongo.import_file(db, data_file, resume=False) == 5
+    assert db.messages.count_documents({}) == 5
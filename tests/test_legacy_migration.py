@@ -0,0 +1,40 @@
+import json
+import db_manager
+from init_mongo import seed_chats
+
+LEGACY_CHATS = {
+    "c1": {
+        "title": "Packing list",
+        "created_at": "2024-01-01T10:00:00",
+        "updated_at": "2024-01-01T10:05:00",
+        "messages": [
+            {"role": "user", "content": "What should I pack for Oslo?"},
+            {"role": "assistant", "content": "Layers and a rain jacket."}
+        ]
+    }
+}
+
+def test_init_seeds_chats_and_messages(db, tmp_path):
+    path = tmp_path / "chat_history.json"
+    path.write_text(json.dumps({"u1": LEGACY_CHATS}))
+
+    assert seed_chats(str(path)) == 1
+
+    assert db.chat_collection.count_documents({}) == 0
+    assert [chat['title'] for chat in db.get_chat_summaries("u1")['chats']] == ["Packing list"]
+    messages = db.get_chat_messages("u1", "c1")
+    assert [message['content'] for message in messages] == [
+        "What should I pack for Oslo?", "Layers and a rain jacket."
+    ]
+
+def test_user_check_is_skipped_once_legacy_layout_is_empty(db):
+    db.get_chat_summaries("u1")
+    assert db_manager.get_legacy_layout().empty
+
+    # Not looked for until the legacy collection is checked again
+    db.chat_collection.insert_one({'_id': "u2", **LEGACY_CHATS})
+    assert db.get_chat_summaries("u2")['chats'] == []
+
+    db_manager.get_legacy_layout().checked_at = None
+    assert [chat['chat_id'] for chat in db.get_chat_summaries("u2")['chats']] == ["c1"]
+    assert db.chat_collection.count_documents({}) == 0
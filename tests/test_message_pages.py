@@ -0,0 +1,47 @@
+import pytest
+import app as app_module
+
+@pytest.fixture
+def chat(db):
+    chat_id = db.create_chat("u1", "Counting")
+    for number in range(1, 6):
+        db.add_message("u1", chat_id, "user", f"message {number}")
+    db.message_writer.flush()
+    return chat_id
+
+def contents(page):
+    return [message['content'] for message in page['messages']]
+
+def test_pages_walk_back_to_the_first_message(db, chat):
+    page = db.get_chat_messages_page("u1", chat, limit=2)
+    assert contents(page) == ["message 4", "message 5"]
+
+    page = db.get_chat_messages_page("u1", chat, before=page['next_cursor'], limit=2)
+    assert contents(page) == ["message 2", "message 3"]
+
+    page = db.get_chat_messages_page("u1", chat, before=page['next_cursor'], limit=2)
+    assert contents(page) == ["message 1"]
+    assert page['next_cursor'] is None
+
+def test_last_page_that_fills_the_limit_has_no_cursor(db, chat):
+    page = db.get_chat_messages_page("u1", chat, limit=5)
+    assert len(page['messages']) == 5
+    assert page['next_cursor'] is None
+
+def test_cursor_excludes_its_own_message(db, chat):
+    first = db.get_chat_messages_page("u1", chat, limit=5)['messages'][0]
+    page = db.get_chat_messages_page("u1", chat, before=first['seq'], limit=5)
+    assert page == {'messages': [], 'next_cursor': None}
+
+def test_messages_route_pages_with_before_cursor(db, chat, monkeypatch):
+    monkeypatch.setattr(app_module, 'chat_manager', db)
+    client = app_module.app.test_client()
+
+    page = client.get(f'/api/chats/{chat}/messages?user_id=u1&limit=3').get_json()
+    assert contents(page) == ["message 3", "message 4", "message 5"]
+
+    page = client.get(f"/api/chats/{chat}/messages?user_id=u1&limit=3&before={page['next_cursor']}").get_json()
+    assert contents(page) == ["message 1", "message 2"]
+    assert page['next_cursor'] is None
+
+    assert client.get(f'/api/chats/{chat}/messages').status_code == 400
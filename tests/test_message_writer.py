@@ -0,0 +1,27 @@
+import functools
+import pytest
+from db_manager import PendingWritesError
+
+def test_turn_waits_for_queued_reply(db):
+    chat_id = db.create_chat("u1", "Stories")
+    db.message_writer.submit_append("u1", chat_id, "assistant", "Once upon a time.")
+    db.append_message_with_context("u1", chat_id, "user", "And then?")
+    db.message_writer.flush()
+
+    messages = db.get_chat_messages("u1", chat_id)
+    assert [message['content'] for message in messages] == ["Once upon a time.", "And then?"]
+
+def test_turn_fails_when_queued_reply_is_not_written(db, monkeypatch):
+    writer = db.message_writer
+    chat_id = db.create_chat("u1", "Stories")
+    # An append the writer has not picked up yet
+    with writer._pending_changed:
+        writer._pending[chat_id] = 1
+    monkeypatch.setattr(writer, 'wait_for_chat', functools.partial(writer.wait_for_chat, timeout=0.05))
+
+    with pytest.raises(PendingWritesError):
+        db.append_message_with_context("u1", chat_id, "user", "And then?")
+    assert db.chats_collection.find_one({'_id': chat_id})['message_count'] == 0
+
+    with writer._pending_changed:
+        del writer._pending[chat_id]
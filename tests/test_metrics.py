@@ -0,0 +1,28 @@
+import db_manager
+from metrics import REPLY_CANCELLATIONS, registry
+from reply_streams import ReplyStreamRegistry
+
+def cancellations(reason):
+    return dict(((labels, value) for _, labels, value in REPLY_CANCELLATIONS.samples())).get(f'{{reason="{reason}"}}', 0)
+
+def test_reply_cancellations_are_a_counter():
+    before = cancellations("user")
+    streams = ReplyStreamRegistry(retention=60, disconnect_grace=0)
+    stream = streams.start("u1", "c1")
+    stream.cancel("user")
+    streams.record_cancellation(stream)
+
+    assert cancellations("user") == before + 1
+    assert "# TYPE reply_cancellations_total counter" in registry.render()
+
+def test_each_client_has_its_own_pool_stats(monkeypatch):
+    monkeypatch.setattr(db_manager, '_pool_stats', {'sync': db_manager.PoolStatsListener()})
+    sync_listener = db_manager.mongo_client_options()['event_listeners'][0]
+    async_listener = db_manager.mongo_client_options('async')['event_listeners'][0]
+    assert sync_listener is not async_listener
+
+    async_listener.connection_checked_out(None)
+
+    stats = db_manager.get_pool_stats()
+    assert stats['sync']['in_use'] == 0
+    assert stats['async']['in_use'] == 1
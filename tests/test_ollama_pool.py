@@ -0,0 +1,73 @@
+import pytest
+import requests
+import ollama_pool
+from ollama_pool import OllamaPool
+
+URLS = ["http://ollama-a:11434", "http://ollama-b:11434"]
+
+class FakeServers:
+    """Stands in for requests.get on the health probe; servers in `down` refuse connections."""
+
+    def __init__(self):
+        self.down = set()
+
+    def __call__(self, url, timeout=None):
+        if any(url.startswith(server) for server in self.down):
+            raise requests.exceptions.ConnectionError(f"{url} refused")
+        response = requests.Response()
+        response.status_code = 200
+        return response
+
+@pytest.fixture
+def servers(monkeypatch):
+    fake = FakeServers()
+    monkeypatch.setattr(ollama_pool.requests, 'get', fake)
+    return fake
+
+@pytest.fixture
+def pool():
+    return OllamaPool(URLS, health_interval=0)
+
+def test_chat_sticks_to_its_backend(pool):
+    first = pool.admit("u1", "c1")
+    # A second chat goes to the less loaded backend
+    second = pool.admit("u2", "c2")
+    assert first.backend is not second.backend
+    pool.release(first)
+    pool.release(second)
+
+    for _ in range(3):
+        ticket = pool.admit("u1", "c1")
+        assert ticket.backend is first.backend
+        pool.release(ticket)
+
+def test_failed_backend_is_ejected_and_chat_moves(pool, servers):
+    sticky = pool.admit("u1", "c1").backend
+    servers.down.add(sticky.url)
+
+    assert pool.probe(sticky) is False
+    assert sticky.healthy
+    assert pool.probe(sticky) is False
+    assert not sticky.healthy and sticky.ejections == 1
+
+    moved = pool.admit("u1", "c1").backend
+    assert moved is not sticky
+    # Later turns stay on the new backend
+    assert pool.choose("c1") is moved
+
+def test_backend_is_reinstated_after_a_successful_probe(pool, servers):
+    backend = pool.backends[0]
+    servers.down.add(backend.url)
+    pool.probe(backend)
+    pool.probe(backend)
+    assert not backend.healthy
+
+    servers.down.clear()
+    assert pool.probe(backend) is True
+    assert backend.healthy and backend.consecutive_failures == 0
+    assert backend.stats()['ejections'] == 1
+
+def test_all_backends_down_still_routes(pool):
+    for backend in pool.backends:
+        backend.healthy = False
+    assert pool.choose("c1") in pool.backends
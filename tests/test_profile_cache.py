@@ -0,0 +1,40 @@
+from cache import MISSING, TTLCache
+from profile_manager import ProfileManager
+
+def test_set_skips_value_read_before_invalidation():
+    cache = TTLCache(maxsize=10, ttl=60)
+    generation = cache.generation()
+    cache.invalidate("u1")
+
+    assert cache.set("u1", "stale", generation) is False
+    assert cache.get("u1") is MISSING
+    assert cache.set("u1", "fresh", cache.generation()) is True
+    assert cache.get("u1") == "fresh"
+
+def test_set_after_other_keys_fall_out_of_invalidation_history():
+    cache = TTLCache(maxsize=2, ttl=60)
+    generation = cache.generation()
+    for key in ("u1", "u2", "u3"):
+        cache.invalidate(key)
+
+    # u1's invalidation is no longer tracked; it is treated as possibly invalidated
+    assert cache.set("u1", "stale", generation) is False
+    assert cache.set("u9", "value", cache.generation()) is True
+
+def test_profile_update_during_prompt_read_is_not_overwritten(db, monkeypatch):
+    profiles = ProfileManager(watch_changes=False)
+    profiles.db_manager = db
+    profiles.create_profile("u1", {'name': "Ada"})
+    read_profile = profiles.get_profile
+
+    def racing_read(user_id):
+        profile = read_profile(user_id)
+        # The profile changes after it was read, before the prompt is cached
+        profiles.update_profile(user_id, {'name': "Grace"})
+        return profile
+
+    monkeypatch.setattr(profiles, 'get_profile', racing_read)
+    assert "Ada" in profiles.get_profile_prompt("u1")
+    monkeypatch.setattr(profiles, 'get_profile', read_profile)
+
+    assert "Grace" in profiles.get_profile_prompt("u1")
@@ -0,0 +1,45 @@
+import pytest
+import app as app_module
+from prompt_manager import PromptManager
+
+PROMPTS = {"Cooking": ["What can I cook with leeks?"], "Travel": ["Plan a weekend in Oslo"]}
+
+@pytest.fixture
+def client(db, monkeypatch):
+    db.prompt_collection.insert_one({'_id': 'prompts', 'data': PROMPTS})
+    monkeypatch.setattr(app_module, 'prompt_manager', PromptManager(refresh_interval=0))
+    return app_module.app.test_client()
+
+def test_reload_needs_admin_token(client, monkeypatch):
+    monkeypatch.setattr(app_module, 'ADMIN_TOKEN', "s3cret")
+
+    assert client.post('/api/prompts/reload').status_code == 403
+    assert client.post('/api/prompts/reload', headers={'Authorization': "Bearer wrong"}).status_code == 403
+    assert client.post('/api/prompts/reload', headers={'Authorization': "Bearer s3cret"}).status_code == 200
+
+def test_reload_is_disabled_without_admin_token(client, monkeypatch):
+    monkeypatch.setattr(app_module, 'ADMIN_TOKEN', "")
+
+    assert client.post('/api/prompts/reload', headers={'Authorization': "Bearer "}).status_code == 403
+
+def test_unchanged_catalog_answers_not_modified(client):
+    response = client.get('/api/prompts?category=Cooking')
+    assert response.status_code == 200
+    assert response.get_json() == PROMPTS["Cooking"]
+    etag = response.headers['ETag']
+
+    response = client.get('/api/prompts?category=Cooking', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b""
+
+def test_reload_changes_the_etag(client, db, monkeypatch):
+    monkeypatch.setattr(app_module, 'ADMIN_TOKEN', "s3cret")
+    etag = client.get('/api/prompts/categories').headers['ETag']
+
+    db.prompt_collection.update_one({'_id': 'prompts'}, {'$set': {'data.Garden': ["When do I plant garlic?"]}})
+    client.post('/api/prompts/reload', headers={'Authorization': "Bearer s3cret"})
+
+    response = client.get('/api/prompts/categories', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert response.get_json() == ["Cooking", "Travel", "Garden"]
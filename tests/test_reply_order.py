@@ -0,0 +1,47 @@
+import threading
+import pytest
+from chat_manager import ChatManager
+from stream_events import ContentEvent, DoneEvent
+
+@pytest.fixture
+def chat_manager(db, monkeypatch):
+    manager = ChatManager(ollama_url="http://127.0.0.1:9")
+    manager.db_manager = db
+    manager.checkpoint_interval = 60
+    manager.response_cache = None
+    yield manager
+    manager.close()
+
+def slow_reply(started):
+    """A fake Ollama stream: one token, then nothing until the request is cancelled."""
+    def send_to_ollama(messages, model=None, profile_context="", cache=False, ticket=None, cancel=None):
+        yield ContentEvent("Leeks are")
+        started.set()
+        stopped = threading.Event()
+        cancel.add_callback(stopped.set)
+        if not stopped.wait(5):
+            yield DoneEvent()
+    return send_to_ollama
+
+def test_second_send_keeps_previous_reply_before_it(chat_manager, monkeypatch):
+    started = threading.Event()
+    monkeypatch.setattr(chat_manager, 'send_to_ollama', slow_reply(started))
+
+    chat_id, messages = chat_manager.start_turn("u1", None, "What can I cook with leeks?")
+    stream = chat_manager.start_reply("u1", chat_id, messages)
+    assert started.wait(5)
+
+    # Sent again before the first reply was checkpointed
+    _, messages = chat_manager.start_turn("u1", chat_id, "Anything vegan?")
+
+    assert stream.finished and stream.cancellation.reason == "superseded"
+    chat_manager.db_manager.message_writer.flush()
+    stored = chat_manager.get_chat_messages("u1", chat_id)
+    assert [(message['role'], message['content']) for message in stored] == [
+        ("user", "What can I cook with leeks?"),
+        ("assistant", "Leeks are"),
+        ("user", "Anything vegan?")
+    ]
+    assert [message['content'] for message in messages if message['role'] != "system"] == [
+        "What can I cook with leeks?", "Leeks are", "Anything vegan?"
+    ]
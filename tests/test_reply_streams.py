@@ -0,0 +1,42 @@
+from model_registry import ModelRegistry
+from reply_streams import ReplyStreamRegistry
+from stream_events import ContentEvent, DoneEvent
+
+def generate(stream, pieces):
+    events = stream.count_generated(iter([ContentEvent(piece) for piece in pieces] + [DoneEvent()]))
+    return [event for event in events if event.type == "content"]
+
+def test_cancellation_records_tokens_generated_against_limit():
+    streams = ReplyStreamRegistry(retention=60, disconnect_grace=0)
+    stream = streams.start("u1", "c1", token_limit=100)
+    generate(stream, ["Once", " upon", " a", " time"])
+    stream.cancel("user")
+
+    assert streams.record_cancellation(stream) == 96
+    stats = streams.stats()
+    assert stats['cancelled'] == {'user': 1}
+    assert stats['tokens_generated_before_cancel'] == 4
+    assert stats['cancelled_token_limit'] == 100
+    assert stats['tokens_left_of_limit'] == 96
+
+def test_cancellation_without_limit_reports_no_saving():
+    streams = ReplyStreamRegistry(retention=60, disconnect_grace=0)
+    streams.record_completion()
+    stream = streams.start("u1", "c1")
+    generate(stream, ["Hello", " there"])
+    stream.cancel("disconnect")
+
+    assert streams.record_cancellation(stream) is None
+    stats = streams.stats()
+    assert stats['tokens_generated_before_cancel'] == 2
+    assert stats['cancelled_token_limit'] == 0
+    assert stats['tokens_left_of_limit'] == 0
+
+def test_token_limit_comes_from_num_predict():
+    models = ModelRegistry(
+        models={"small": {"options": {"num_predict": 256}}, "open": {"options": {"num_predict": -1}}},
+        default_model="big", options={}
+    )
+    assert models.token_limit("small") == 256
+    assert models.token_limit("open") is None
+    assert models.token_limit("big") is None
@@ -0,0 +1,54 @@
+import cache as cache_module
+import response_cache as response_cache_module
+from response_cache import ResponseCache
+
+MESSAGES = [{'role': 'user', 'content': "What can I cook with leeks?"}]
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def test_key_ignores_whitespace_differences():
+    cache = ResponseCache(maxsize=10, ttl=60)
+    assert cache.key("llama3", "Be brief.", MESSAGES) == cache.key(
+        "llama3", " Be  brief. ", [{'role': 'user', 'content': "What can I cook  with leeks?\n"}]
+    )
+    assert cache.key("llama3", "Be brief.", MESSAGES) != cache.key("mistral", "Be brief.", MESSAGES)
+
+def test_entries_expire_after_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_module.time, 'monotonic', clock)
+    cache = ResponseCache(maxsize=10, ttl=60)
+    cache.set("k", "Leek soup.")
+
+    clock.now += 59
+    assert cache.get("k") == "Leek soup."
+    clock.now += 2
+    assert cache.get("k") is None
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResponseCache(maxsize=2, ttl=60)
+    cache.set("a", "A")
+    cache.set("b", "B")
+    cache.get("a")
+    cache.set("c", "C")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "A"
+    assert cache.get("c") == "C"
+
+def test_responses_survive_in_sqlite(tmp_path, monkeypatch):
+    path = str(tmp_path / "responses.db")
+    ResponseCache(maxsize=10, ttl=60, path=path).set("k", "Leek soup.")
+
+    reopened = ResponseCache(maxsize=10, ttl=60, path=path)
+    assert reopened.get("k") == "Leek soup."
+    assert reopened.stats()['size'] == 1
+
+    clock = Clock()
+    clock.now = response_cache_module.time.time() + 61
+    monkeypatch.setattr(response_cache_module.time, 'time', clock)
+    assert ResponseCache(maxsize=10, ttl=60, path=path).get("k") is None
@@ -0,0 +1,65 @@
+import pytest
+from scheduler import FairScheduler, QueueFullError
+
+def scheduler(**kwargs):
+    settings = {'max_in_flight': 1, 'max_queue': 10, 'max_queued_per_user': 4, 'queue_timeout': 5, **kwargs}
+    return FairScheduler(**settings)
+
+def grant_order(scheduler, running, tickets):
+    """Release each granted ticket in turn and record who ran next."""
+    order = []
+    while running is not None:
+        scheduler.release(running)
+        running = next((ticket for ticket in tickets if ticket.granted and ticket not in order), None)
+        if running is not None:
+            order.append(running)
+    return order
+
+def test_users_are_served_round_robin():
+    fair = scheduler()
+    running = fair.enqueue("alice")
+    a1, a2, a3 = (fair.enqueue("alice") for _ in range(3))
+    b1 = fair.enqueue("bob")
+    c1 = fair.enqueue("carol")
+
+    assert running.granted and not a1.granted
+    assert grant_order(fair, running, [a1, a2, a3, b1, c1]) == [a1, b1, c1, a2, a3]
+
+def test_positions_match_grant_order():
+    fair = scheduler()
+    running = fair.enqueue("alice")
+    a1, a2 = fair.enqueue("alice"), fair.enqueue("alice")
+    b1 = fair.enqueue("bob")
+    c1 = fair.enqueue("carol")
+
+    assert [fair.position(ticket) for ticket in (a1, b1, c1, a2)] == [1, 2, 3, 4]
+    assert fair.position(running) == 0
+
+    fair.release(running)
+    assert [fair.position(ticket) for ticket in (a1, b1, c1, a2)] == [0, 1, 2, 3]
+
+def test_cancelled_waiter_leaves_the_queue():
+    fair = scheduler()
+    running = fair.enqueue("alice")
+    b1 = fair.enqueue("bob")
+    c1 = fair.enqueue("carol")
+
+    fair.release(b1)
+    assert fair.position(c1) == 1
+    fair.release(running)
+    assert c1.granted and not b1.granted
+    assert fair.stats()['queued'] == 0
+
+def test_full_queue_is_rejected_with_retry_after():
+    fair = scheduler(max_queue=2, max_queued_per_user=1)
+    fair.enqueue("alice")
+    fair.enqueue("bob")
+
+    # Bob's share of the queue is taken
+    with pytest.raises(QueueFullError):
+        fair.enqueue("bob")
+    fair.enqueue("carol")
+    with pytest.raises(QueueFullError) as error:
+        fair.enqueue("dave")
+    assert error.value.retry_after >= 1
+    assert fair.stats()['rejected'] == 2
@@ -0,0 +1,48 @@
+import asyncio
+import time
+from stream_events import ContentEvent, DoneEvent, acoalesce, coalesce
+
+PAUSE = 0.5
+
+def test_coalesce_sends_held_content_before_next_token():
+    def source():
+        yield ContentEvent("a")
+        yield ContentEvent("b")  # within the window, so it is held
+        time.sleep(PAUSE)
+        yield ContentEvent("c")
+        yield DoneEvent()
+
+    started = time.monotonic()
+    received = []
+    for event in coalesce(source(), 0.05, 64):
+        received.append((time.monotonic() - started, getattr(event, 'content', event.type)))
+
+    assert "".join(content for _, content in received[:-1]) == "abc"
+    held = [at for at, content in received if "b" in content][0]
+    assert held < PAUSE
+
+def test_acoalesce_sends_held_content_before_next_token():
+    async def source():
+        yield ContentEvent("a")
+        yield ContentEvent("b")
+        await asyncio.sleep(PAUSE)
+        yield ContentEvent("c")
+        yield DoneEvent()
+
+    async def run():
+        started = time.monotonic()
+        return [
+            (time.monotonic() - started, getattr(event, 'content', event.type))
+            async for event in acoalesce(source(), 0.05, 64)
+        ]
+
+    received = asyncio.run(run())
+    assert "".join(content for _, content in received[:-1]) == "abc"
+    held = [at for at, content in received if "b" in content][0]
+    assert held < PAUSE
+
+def test_coalesce_merges_bursts():
+    events = [ContentEvent("ab")] * 1000 + [DoneEvent()]
+    merged = list(coalesce(iter(events), 10, 64))
+    assert "".join(event.content for event in merged[:-1]) == "ab" * 1000
+    assert len(merged) < 100